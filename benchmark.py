@@ -0,0 +1,370 @@
+#!/usr/bin/python
+
+
+from __future__ import print_function
+import os
+import re
+import sys
+import ssl
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import integration_webserver as intweb
+
+BENCH_HOST = '127.0.0.1'
+BENCH_PORT = 48100
+SLOW_DELAY = 0.01
+
+# endpoint type -> path served by the in-process benchmark server
+ENDPOINTS = {
+    'static':   '/bench/static',
+    'callback': '/bench/callback',
+    'slow':     '/bench/slow',
+    'notfound': '/bench/missing',
+}
+
+# endpoint type -> path registered by `integration_webserver.py start`
+DAEMON_ENDPOINTS = {
+    'static':   '/twiddle/get.op?objectName=bean:name=datasource&attributeName=MaxPoolSize',
+    'callback': '/twiddle/get.op?objectName=bean:name=datasource&attributeName=NumBusyConnections',
+    'notfound': '/bench/missing',
+}
+
+def percentile(samples, pct):
+    if not samples: return None
+    ordered = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def summarize(latencies, errors, elapsed):
+    to_ms = lambda v: None if v is None else round(v * 1000.0, 3)
+    return {
+        'requests': len(latencies),
+        'errors':   errors,
+        'elapsed':  round(elapsed, 3),
+        'rps':      round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms':   to_ms(percentile(latencies, 50)),
+        'p95_ms':   to_ms(percentile(latencies, 95)),
+        'p99_ms':   to_ms(percentile(latencies, 99)),
+        'max_ms':   to_ms(max(latencies) if latencies else None),
+    }
+
+class BenchClient(object):
+    # A minimal HTTP/1.1 client on a raw socket, so the numbers measure the
+    # server and not httplib.
+    # With a client tls context every connection starts with a handshake.
+    def __init__(self, host, port, keepalive=True, timeout=10, tls=None):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.tls = tls
+        self.sock = None
+        self.buf = ''
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls is not None:
+            self.sock = self.tls.wrap_socket(self.sock)
+        self.buf = ''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def recv(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise socket.error('connection closed by server')
+        self.buf += chunk
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def request(self, method, path, headers=(), body=None):
+        # headers are (name, value) pairs sent besides Host, Content-Length
+        # and Connection, which the client sets itself.
+        if self.sock is None:
+            self.connect()
+        request = '%s %s HTTP/1.1\r\nHost: %s\r\n' %(method, path, self.host)
+        for header in headers:
+            request += '%s: %s\r\n' %(header)
+        if body is not None:
+            request += 'Content-Length: %d\r\n' %(len(body))
+        if not self.keepalive:
+            request += 'Connection: close\r\n'
+        try:
+            self.sock.sendall(request + '\r\n' + (body or ''))
+            status, headers = self.read_head()
+            while status == 100:
+                status, headers = self.read_head()
+            if method == 'HEAD' or status in (204, 304):
+                pass
+            elif 'chunked' in headers.get('transfer-encoding', '').lower():
+                self.read_chunked()
+            elif 'content-length' in headers:
+                self.read_exactly(int(headers['content-length']))
+            else:
+                self.read_until_close()
+                headers['connection'] = 'close'
+        except Exception:
+            self.close()
+            raise
+        if not self.keepalive or headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status
+
+    def read_head(self):
+        while '\r\n\r\n' not in self.buf:
+            self.recv()
+        head, sep, self.buf = self.buf.partition('\r\n\r\n')
+        lines = head.split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return int(lines[0].split()[1]), headers
+
+    def read_exactly(self, length):
+        while len(self.buf) < length:
+            self.recv()
+        data, self.buf = self.buf[:length], self.buf[length:]
+        return data
+
+    def read_until_close(self):
+        while self.sock.recv(65536):
+            pass
+        self.buf = ''
+
+    def read_line(self):
+        while '\r\n' not in self.buf:
+            self.recv()
+        line, sep, self.buf = self.buf.partition('\r\n')
+        return line
+
+    def read_chunked(self):
+        while True:
+            size = int(self.read_line().split(';')[0], 16)
+            if size == 0: break
+            self.read_exactly(size + 2)
+        while self.read_line():
+            pass
+
+def drive(host, port, path, clients, requests, keepalive, tls=None):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_client = max(1, requests // clients)
+
+    def client():
+        conn = BenchClient(host, port, keepalive, tls=tls)
+        samples = []
+        failed = 0
+        for i in range(per_client):
+            start = time.time()
+            try:
+                conn.get(path)
+            except Exception:
+                failed += 1
+                continue
+            samples.append(time.time() - start)
+        conn.close()
+        with lock:
+            latencies.extend(samples)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return summarize(latencies, errors[0], time.time() - start)
+
+def tls_client_context(certfile=intweb.TLS_CERT):
+    # Trusts the server's self-signed certificate and nothing else.
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(certfile)
+    return context
+
+def measure_handshakes(host, port, path, seconds=2):
+    # Connections/sec of `openssl s_time` fetching path with a full
+    # handshake every time and with a resumed session, a single client
+    # either way.  Python 2 clients can not resume a session, so this needs
+    # the openssl command line tool and is None without it.
+    rates = {}
+    for kind, flag in (('full', '-new'), ('resumed', '-reuse')):
+        command = ['openssl', 's_time', '-connect', '%s:%s' %(host, port), '-www', path,
+                   '-time', str(seconds), flag]
+        start = time.time()
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        elapsed = time.time() - start
+        match = re.search(r'(\d+) connections in [\d.]+s', output)
+        if match is None:
+            return None
+        connections = int(match.group(1))
+        rates[kind] = {
+            'connections': connections,
+            'elapsed':     round(elapsed, 3),
+            'rate':        round(connections / elapsed, 1),
+        }
+    return rates
+
+def slow_callback():
+    time.sleep(SLOW_DELAY)
+    return 'slow'
+
+def start_inprocess(host, port, mode, workers, access_log=None, tls=False,
+                    certfile=intweb.TLS_CERT, keyfile=intweb.TLS_KEY):
+    rundir = tempfile.mkdtemp(prefix='intweb-bench-')
+    server = intweb.MyHTTPServer(host, port, mode=mode, workers=workers,
+                                 lockfile=os.path.join(rundir, 'webserver.lock'),
+                                 control_socket=os.path.join(rundir, 'webserver.sock'))
+    server.access_log_path = access_log
+    if tls:
+        server.enable_tls(certfile, keyfile)
+    server.register_endpoint(ENDPOINTS['static'], 55)
+    server.register_endpoint(ENDPOINTS['callback'], callback=intweb.random_busy)
+    server.register_endpoint(ENDPOINTS['slow'], callback=slow_callback)
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def stop_inprocess(server):
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(os.path.dirname(server.lockfile), ignore_errors=True)
+
+def control_daemon(*args):
+    script = os.path.join(intweb.get_execution_path(), 'integration_webserver.py')
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call([sys.executable, script] + list(args), stdout=devnull)
+
+def time_command(*args):
+    # Wall time of one `integration_webserver.py <args>` run, interpreter
+    # startup and imports included.
+    start = time.time()
+    control_daemon(*args)
+    return time.time() - start
+
+def measure_startup(start_server, host, port, runs=5):
+    # Seconds from starting the server until its port accepts connections,
+    # and the median wall time of a `status` command.
+    start = time.time()
+    server = start_server()
+    if not intweb.wait_ready([port], host):
+        raise RuntimeError('server did not start listening on %s:%s' %(host, port))
+    ready = time.time() - start
+    status = sorted(time_command('status') for i in range(runs))[runs // 2]
+    return server, {'ready_ms': round(ready * 1000.0, 3), 'status_ms': round(status * 1000.0, 3)}
+
+def run_benchmark(mode='threaded', workers=intweb.WORKERS, clients=16, requests=2000,
+                  daemon=False, host=BENCH_HOST, port=BENCH_PORT, access_log=None, tls=False,
+                  certfile=intweb.TLS_CERT, keyfile=intweb.TLS_KEY):
+    # Per-request logging is off unless access_log names a file to log to,
+    # the daemon's default access log is switched off for the run.  Over
+    # TLS keep-alive results are request throughput with one handshake per
+    # client, close results pay a full handshake per request and
+    # handshakes reports connection setup alone.  An in-process server
+    # uses certfile and keyfile, the daemon always the default ones.
+    if daemon:
+        port = intweb.PORT
+        endpoints = DAEMON_ENDPOINTS
+        args = ('start', mode, str(workers)) + (('tls',) if tls else ())
+        certfile = intweb.TLS_CERT
+        server, startup = measure_startup(lambda: control_daemon(*args), host, port)
+        intweb.control_command('access', os.path.abspath(access_log) if access_log else '')
+    else:
+        endpoints = ENDPOINTS
+        server, startup = measure_startup(lambda: start_inprocess(host, port, mode, workers, access_log, tls,
+                                                                  certfile, keyfile),
+                                          host, port)
+    client_tls = tls_client_context(certfile) if tls else None
+    results = {}
+    handshakes = None
+    try:
+        for keepalive in (True, False):
+            connection = 'keepalive' if keepalive else 'close'
+            results[connection] = {}
+            for kind, path in sorted(endpoints.items()):
+                results[connection][kind] = drive(host, port, path, clients, requests, keepalive, client_tls)
+        if tls:
+            handshakes = measure_handshakes(host, port, endpoints['static'])
+    finally:
+        if daemon:
+            control_daemon('stop')
+        else:
+            stop_inprocess(server)
+    return {
+        'config': {
+            'mode':     mode,
+            'workers':  workers,
+            'clients':  clients,
+            'requests': requests,
+            'daemon':   daemon,
+            'access_log': access_log,
+            'tls':      tls,
+        },
+        'timestamp': time.time(),
+        'startup':   startup,
+        'handshakes': handshakes,
+        'results':   results,
+    }
+
+def format_results(report):
+    columns = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+    lines = ['startup: ready in %(ready_ms)sms, status command %(status_ms)sms' %(report['startup']),
+             '%-10s %-9s ' %('conn', 'endpoint') + ' '.join('%9s' %(c) for c in columns)]
+    for connection, kinds in sorted(report['results'].items()):
+        for kind, summary in sorted(kinds.items()):
+            lines.append('%-10s %-9s ' %(connection, kind) +
+                         ' '.join('%9s' %(summary[c]) for c in columns))
+    handshakes = report.get('handshakes')
+    if handshakes:
+        lines.append('handshakes/sec: full %s, resumed %s' %(handshakes['full']['rate'],
+                                                             handshakes['resumed']['rate']))
+    elif report['config'].get('tls'):
+        lines.append('handshakes/sec: not measured, needs `openssl s_time`')
+    return '\n'.join(lines)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load test MyHTTPServer with '
+            'concurrent local clients.  In-process runs share the GIL with '
+            'the clients, use --daemon for numbers closer to production.')
+    parser.add_argument('--mode', default='threaded', choices=intweb.SERVE_MODES)
+    parser.add_argument('--workers', type=int, default=intweb.WORKERS)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000,
+            help='requests per endpoint type and connection type')
+    parser.add_argument('--daemon', action='store_true',
+            help='benchmark a daemonized `integration_webserver.py start`')
+    parser.add_argument('--access-log', help='log every request to this file, '
+            'by default nothing is logged per request')
+    parser.add_argument('--tls', action='store_true',
+            help='serve HTTPS and report handshake and request throughput separately')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report = run_benchmark(args.mode, args.workers, args.clients, args.requests, args.daemon,
+                           access_log=args.access_log, tls=args.tls)
+    print(format_results(report))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
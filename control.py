@@ -0,0 +1,358 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import errno
+import fcntl
+import signal
+import socket
+import ConfigParser
+
+# What the command line needs to find and talk to a running server: its
+# paths, pid discovery, the control socket client and the manifest readers
+# `load` sends specs with.  Nothing here imports the server stack,
+# integration_webserver.py answers control commands from this module before
+# importing the rest of itself.
+
+def get_execution_path():
+    abs_path = os.path.abspath(__file__)
+    root_dir = os.path.dirname(abs_path)
+    return root_dir
+
+LISTEN     = '0.0.0.0'
+PORT       = 48000
+PIDFILE    = get_execution_path() + '/webserver.pid'
+STDOUT_LOG = get_execution_path() + '/stdout.log'
+STDERR_LOG = get_execution_path() + '/stderr.log'
+LOCKFILE   = PIDFILE + '.lock'
+ACCESS_LOG = get_execution_path() + '/access.log'
+CONTROL_SOCKET = get_execution_path() + '/webserver.sock'
+
+READY_TIMEOUT = 10.0
+DRAIN_TIMEOUT = 10.0
+
+def read_pid(path):
+    try:
+        with open(path) as pidfile:
+            return int(pidfile.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def lock_held(path):
+    # The running server holds an exclusive flock on its lockfile, a stale
+    # pidfile or a recycled pid never does.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        return e.errno in (errno.EAGAIN, errno.EACCES)
+    finally:
+        os.close(fd)
+    return False
+
+def control_request(command, path=CONTROL_SOCKET, timeout=2.0):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(command + '\n')
+        reply = ''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk: break
+            reply += chunk
+        return reply
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+def control_command(command, payload=None, control_socket=CONTROL_SOCKET):
+    # Sends command with a JSON payload to a running server, for example
+    #   control_command('load', [{'path': '/max', 'value': 55}])
+    #   control_command('delete', ['/max'])
+    if payload is not None:
+        command = '%s %s' %(command, json.dumps(payload))
+    reply = control_request(command, control_socket, timeout=30.0)
+    if reply is None:
+        raise RuntimeError('no server is listening on %s' %(control_socket))
+    if not reply:
+        raise RuntimeError('%s got no reply from %s' %(command.split(' ')[0], control_socket))
+    if reply.startswith('error'):
+        raise RuntimeError(reply[len('error '):])
+    return reply
+
+def status_server(pidfile=PIDFILE, lockfile=LOCKFILE, control_socket=CONTROL_SOCKET):
+    # Constant time discovery: while the lock is held the pid the holder
+    # wrote into the lockfile is the server, and the pidfile counts only
+    # when it names that same pid.  Otherwise ask the control socket.
+    locked = read_pid(lockfile) if lock_held(lockfile) else None
+    for pid in (read_pid(pidfile), locked):
+        if pid and pid == locked and pid_alive(pid):
+            return pid if pid != os.getpid() else None
+    reply = control_request('pid', control_socket)
+    if reply and reply.isdigit() and int(reply) != os.getpid():
+        return int(reply)
+    return None
+
+def stop_server():
+    # Returns the pid that was sent a SIGTERM, False without a server.
+    pid = status_server()
+    if pid is not None:
+        os.kill(pid, signal.SIGTERM)
+        return pid
+    return False
+
+def reload_server():
+    pid = status_server()
+    if pid:
+        os.kill(pid, signal.SIGHUP)
+        return True
+    return False
+
+def list_endpoints():
+    pid = status_server()
+    if pid:
+        os.kill(pid, signal.SIGUSR1)
+        return True
+    return False
+
+def wait_ready(ports=(PORT,), host=None, timeout=READY_TIMEOUT):
+    # Blocks until every port accepts connections, False if that takes
+    # longer than timeout seconds.  A server listening on every address is
+    # reached through loopback.
+    if host is None:
+        host = '127.0.0.1' if LISTEN == '0.0.0.0' else LISTEN
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection((host, port), 0.5).close()
+                break
+            except socket.error:
+                if time.time() >= deadline:
+                    return False
+                time.sleep(0.02)
+    return True
+
+def wait_exit(pid, timeout=DRAIN_TIMEOUT):
+    # Blocks until pid has exited, False if that takes longer than timeout
+    # seconds.
+    deadline = time.time() + timeout
+    while pid_alive(pid):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def parse_ports(value):
+    # "48001" or an inclusive range "48001-48020"
+    first, sep, last = value.partition('-')
+    first, last = int(first), int(last or first)
+    if first < 1 or last > 65535 or first > last:
+        raise ValueError('invalid port range %s' %(value))
+    return range(first, last + 1)
+
+def read_manifest(path):
+    # Yields endpoint specs from a manifest.  The format follows the file
+    # extension:
+    #   .json        a list of specs, or {"endpoints": [...]}
+    #   .jsonl       one spec per line, read as a stream
+    #   .yaml/.yml   same layout as .json, needs PyYAML
+    #   .ini/.cfg    one section per path with value/callback/file/ttl/content_type/methods,
+    #                and script as JSON
+    # Relative file bodies are resolved against the manifest's directory.
+    base = os.path.dirname(os.path.abspath(path))
+    extension = os.path.splitext(path)[1].lower()
+    readers = {
+        '.json':  read_json_manifest,
+        '.jsonl': read_jsonl_manifest,
+        '.yaml':  read_yaml_manifest,
+        '.yml':   read_yaml_manifest,
+        '.ini':   read_ini_manifest,
+        '.cfg':   read_ini_manifest,
+    }
+    if extension not in readers:
+        raise ValueError('unsupported manifest format %s, expected one of %s' %(extension, sorted(readers)))
+    for spec in readers[extension](path):
+        if isinstance(spec, dict) and spec.get('file') is not None:
+            spec['file'] = os.path.join(base, spec['file'])
+        yield spec
+
+def manifest_entries(document, path):
+    if isinstance(document, dict) and 'endpoints' in document:
+        document = document['endpoints']
+    if not isinstance(document, list):
+        raise ValueError('manifest %s must hold a list of endpoints' %(path))
+    return document
+
+def read_json_manifest(path):
+    with open(path) as manifest:
+        return manifest_entries(json.load(manifest), path)
+
+def read_jsonl_manifest(path):
+    with open(path) as manifest:
+        for lineno, line in enumerate(manifest, 1):
+            line = line.strip()
+            if not line or line.startswith('#'): continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError('%s:%s: %s' %(path, lineno, e))
+
+def read_yaml_manifest(path):
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('PyYAML is required to load the YAML manifest %s' %(path))
+    with open(path) as manifest:
+        return manifest_entries(yaml.safe_load(manifest), path)
+
+def read_ini_manifest(path):
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    if not parser.read(path):
+        raise ValueError('unable to read manifest %s' %(path))
+    for section in parser.sections():
+        spec = dict(parser.items(section))
+        spec['path'] = section
+        if 'ttl' in spec:
+            try:
+                spec['ttl'] = float(spec['ttl'])
+            except ValueError:
+                raise ValueError('ttl for %s must be a number, not %s' %(section, spec['ttl']))
+        for key in ('script', 'faults'):
+            if key in spec:
+                try:
+                    spec[key] = json.loads(spec[key])
+                except ValueError:
+                    raise ValueError('%s for %s must be JSON, not %s' %(key, section, spec[key]))
+        yield spec
+
+def usage():
+    print('USAGE: %s [start [single|threaded|prefork|eventloop] [workers] [manifest] [tls]|supervise <port>[-<port>] [workers] [manifest] [tls]|instances|load <manifest> [replace]|record [<log>]|access [<log> [sample]]|status|wait [timeout] [<port>[-<port>]]|endpoints|reload|stop]' %(sys.argv[0]))
+    sys.exit(0)
+
+def command_status(argv):
+    pid = status_server()
+    if pid:
+        print('server running on port %s, pid %s' %(PORT, pid))
+        return 0
+    print('server is not running.')
+    return 2
+
+def command_wait(argv):
+    try:
+        timeout = float(argv[2]) if argv[2:] else READY_TIMEOUT
+        ports = parse_ports(argv[3]) if argv[3:] else [PORT]
+    except ValueError as e:
+        print('unable to wait: %s' %(e))
+        return 1
+    if wait_ready(ports, timeout=timeout):
+        return 0
+    print('server is not accepting connections after %ss' %(timeout))
+    return 1
+
+def command_endpoints(argv):
+    if list_endpoints():
+        print('check your stdout.log')
+    else:
+        print('unable to list endpoints, server not runnin?')
+    return 0
+
+def command_stop(argv):
+    # The server drains for up to DRAIN_TIMEOUT seconds before it exits.
+    pid = stop_server()
+    if pid is False:
+        print('server is not running, nothing to stop')
+        return 1
+    if not wait_exit(pid, DRAIN_TIMEOUT + READY_TIMEOUT):
+        print('server %s is still running' %(pid))
+        return 1
+    print('stopped server')
+    return 0
+
+def command_reload(argv):
+    if not reload_server():
+        print('server is not running, nothing to reload')
+        return 1
+    print('reloading server')
+    return 0
+
+def command_instances(argv):
+    try:
+        for instance in json.loads(control_command('status')):
+            print('port %(port)s: endpoints=%(endpoints)s requests=%(requests)s '
+                  'not_found=%(not_found)s connections=%(connections)s' %(instance))
+    except (ValueError, RuntimeError) as e:
+        print('unable to list instances: %s' %(e))
+        return 1
+    return 0
+
+def command_access(argv):
+    spec = {'path': os.path.abspath(argv[2]) if argv[2:] else ''}
+    try:
+        if argv[3:]:
+            spec['sample'] = float(argv[3])
+        print(control_command('access', spec))
+    except (ValueError, RuntimeError) as e:
+        print('unable to change the access log: %s' %(e))
+        return 1
+    return 0
+
+def command_load(argv):
+    # Only reads the manifest, the server builds the endpoints.
+    if not argv[2:]:
+        usage()
+    command = 'replace' if argv[3:] == ['replace'] else 'load'
+    try:
+        print(control_command(command, list(read_manifest(argv[2]))))
+    except (ValueError, RuntimeError) as e:
+        print('unable to load %s: %s' %(argv[2], e))
+        return 1
+    return 0
+
+def command_record(argv):
+    path = os.path.abspath(argv[2]) if argv[2:] else ''
+    try:
+        print(control_command('record', path))
+    except (ValueError, RuntimeError) as e:
+        print('unable to record: %s' %(e))
+        return 1
+    return 0
+
+COMMANDS = {
+    'status':    command_status,
+    'wait':      command_wait,
+    'endpoints': command_endpoints,
+    'stop':      command_stop,
+    'reload':    command_reload,
+    'instances': command_instances,
+    'access':    command_access,
+    'record':    command_record,
+    'load':      command_load,
+}
+
+# actions integration_webserver.py handles itself, with the server stack
+SERVER_ACTIONS = ('start', 'supervise')
+
+def main(argv):
+    # Exits after a control command, returns for a server action.
+    if not argv[1:]:
+        usage()
+    action = argv[1]
+    if action in COMMANDS:
+        sys.exit(COMMANDS[action](argv))
+    if action not in SERVER_ACTIONS:
+        usage()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+import integration_webserver as intweb
+from benchmark import BenchClient, BENCH_HOST, summarize
+
+# Recorded headers that belonged to the original connection, the replaying
+# client sets its own.
+HOP_HEADERS = frozenset(('host', 'connection', 'keep-alive', 'proxy-connection', 'content-length',
+                         'transfer-encoding', 'te', 'expect', 'upgrade'))
+
+def read_log(path):
+    # Yields the entries of a request log written by MyHTTPServer.start_recording
+    with open(path) as log:
+        for lineno, line in enumerate(log, 1):
+            line = line.strip()
+            if not line: continue
+            try:
+                yield intweb.decode_record(line)
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError('%s:%s: %s' %(path, lineno, e))
+
+def prepare(entries):
+    # Returns (offset, method, path, headers, body) tuples in the order the
+    # requests arrived, offsets in seconds from the first.  Everything is
+    # decoded up front so the replay loop only sends.
+    requests = []
+    for entry in entries:
+        headers = [(key, value) for key, value in sorted(entry['headers'].items())
+                   if key.lower() not in HOP_HEADERS]
+        requests.append((entry['time'], entry['method'], entry['path'], headers, entry['body']))
+    requests.sort(key=lambda request: request[0])
+    if not requests:
+        return []
+    first = requests[0][0]
+    return [(request[0] - first,) + request[1:] for request in requests]
+
+def replay(requests, host=BENCH_HOST, port=intweb.PORT, connections=4, speed=1.0, keepalive=True):
+    # Re-issues prepared requests over `connections` concurrent clients.
+    # With a speed each request waits for its recorded offset (divided by
+    # speed) and max_lag_ms reports how far behind schedule the clients
+    # fell, speed=None sends as fast as the server answers.
+    pending = iter(requests)
+    lock = threading.Lock()
+    latencies = []
+    statuses = collections.Counter()
+    errors = [0]
+    lag = [0.0]
+    start = time.time()
+
+    def client():
+        conn = BenchClient(host, port, keepalive)
+        samples = []
+        counts = collections.Counter()
+        failed = 0
+        late = 0.0
+        while True:
+            with lock:
+                request = next(pending, None)
+            if request is None: break
+            offset, method, path, headers, body = request
+            if speed:
+                wait = start + offset / speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    late = max(late, -wait)
+            sent = time.time()
+            try:
+                counts[conn.request(method, path, headers, body)] += 1
+            except Exception:
+                failed += 1
+                continue
+            samples.append(time.time() - sent)
+        conn.close()
+        with lock:
+            latencies.extend(samples)
+            statuses.update(counts)
+            errors[0] += failed
+            lag[0] = max(lag[0], late)
+
+    threads = [threading.Thread(target=client) for i in range(connections)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    report = summarize(latencies, errors[0], time.time() - start)
+    report['statuses'] = dict((str(status), count) for status, count in statuses.items())
+    report['max_lag_ms'] = round(lag[0] * 1000.0, 3) if speed else None
+    return report
+
+def format_report(report):
+    columns = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'max_lag_ms')
+    lines = [' '.join('%10s' %(c) for c in columns),
+             ' '.join('%10s' %(report[c]) for c in columns)]
+    for status, count in sorted(report['statuses'].items()):
+        lines.append('status %s: %s' %(status, count))
+    return '\n'.join(lines)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Replay a request log recorded with '
+            '`integration_webserver.py record <log>` against this server or a real backend.')
+    parser.add_argument('log')
+    parser.add_argument('--host', default=BENCH_HOST)
+    parser.add_argument('--port', type=int, default=intweb.PORT)
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--speed', type=float, default=1.0,
+            help='replay at this multiple of the recorded pacing')
+    parser.add_argument('--max-speed', action='store_true',
+            help='ignore the recorded pacing and send as fast as possible')
+    parser.add_argument('--close', action='store_true',
+            help='open a new connection for every request')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    requests = prepare(read_log(args.log))
+    report = replay(requests, args.host, args.port, args.connections,
+                    None if args.max_speed else args.speed, not args.close)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import os
+import integration_webserver.benchmark as bench
+from nose.tools import istest
+from nose_parameterized import parameterized
+
+@parameterized.expand([
+    (50, 5),
+    (95, 10),
+    (99, 10),
+    (0, 1),
+])
+def test_percentile_uses_nearest_rank(pct, expected):
+    samples = range(10, 0, -1)
+    actual = bench.percentile(samples, pct)
+    assert actual == expected, 'Expected percentile(%s) to be "%s" not ' \
+            '"%s"' %(pct, expected, actual)
+
+def test_percentile_returns_None_without_samples():
+    assert bench.percentile([], 50) is None
+
+def test_summarize_reports_rps_and_latencies_in_milliseconds():
+    actual = bench.summarize([0.001, 0.002, 0.003, 0.004], 1, 2.0)
+    assert actual['requests'] == 4
+    assert actual['errors'] == 1
+    assert actual['rps'] == 2.0, 'Expected rps to be 2.0 not "%s"' %(actual['rps'])
+    assert actual['p50_ms'] == 2.0, 'Expected p50 to be 2.0ms not "%s"' %(actual['p50_ms'])
+    assert actual['max_ms'] == 4.0, 'Expected max to be 4.0ms not "%s"' %(actual['max_ms'])
+
+def test_run_benchmark_reports_every_endpoint_type_per_connection_type():
+    report = bench.run_benchmark(mode='threaded', workers=2, clients=2,
+                                 requests=10, port=48101)
+    for connection in ('keepalive', 'close'):
+        actual = report['results'].get(connection)
+        assert actual, 'Expected results for "%s" connections' %(connection)
+        assert sorted(actual) == sorted(bench.ENDPOINTS), 'Expected a ' \
+                'summary per endpoint type, got "%s"' %(actual.keys())
+        for kind, summary in actual.items():
+            assert summary['errors'] == 0, 'Expected no errors for "%s", ' \
+                    'got "%s"' %(kind, summary)
+            assert summary['requests'] == 10, 'Expected 10 requests for ' \
+                    '"%s", got "%s"' %(kind, summary)
+
+def test_run_benchmark_reports_startup_times():
+    report = bench.run_benchmark(mode='threaded', workers=2, clients=1,
+                                 requests=1, port=48102)
+    for key in ('ready_ms', 'status_ms'):
+        actual = report['startup'].get(key)
+        assert actual > 0, 'Expected a positive "%s", got "%s"' %(key, actual)
+
+@istest
+class TLSBenchmark():
+
+    def setup(self):
+        import tempfile
+        self.rundir = tempfile.mkdtemp()
+        self.certfile = os.path.join(self.rundir, 'webserver.crt')
+        self.keyfile = os.path.join(self.rundir, 'webserver.key')
+
+    def teardown(self):
+        import shutil
+        shutil.rmtree(self.rundir)
+
+    def test_run_benchmark_reports_handshakes_apart_from_requests_over_tls(self):
+        report = bench.run_benchmark(mode='eventloop', workers=2, clients=2,
+                                     requests=10, port=48103, tls=True,
+                                     certfile=self.certfile, keyfile=self.keyfile)
+        for connection in ('keepalive', 'close'):
+            for kind, summary in report['results'][connection].items():
+                assert summary['errors'] == 0, 'Expected no errors for "%s" over TLS, ' \
+                        'got "%s"' %(kind, summary)
+        handshakes = report['handshakes']
+        if handshakes is not None:
+            for kind in ('full', 'resumed'):
+                actual = handshakes[kind]['rate']
+                assert actual > 0, 'Expected a positive %s handshake rate, got "%s"' %(kind, actual)
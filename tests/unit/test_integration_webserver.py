@@ -200,14 +200,14 @@ class MyHTTPServer():
                 'endpoint callback to be "%s" not "%s"' \
                 %(callback, actual_endpoint.callback)
 
-    def test_register_default_sig_handlers_to_register_three_default_SignalHandler_instaces(self):
+    def test_register_default_sig_handlers_to_register_four_default_SignalHandler_instaces(self):
         # register_default_sig_handlers is called by the constructor so this method
         # should have already been called, but we will invoke it anyway just to be
         # safe.
         srv = intweb.MyHTTPServer()
         srv.register_default_sig_handlers()
         srv.server_close()
-        expected_reg_count = 3
+        expected_reg_count = 4
         actual_actions = srv._sig_handler.getActions()
         actual_reg_count = len(actual_actions)
         assert actual_reg_count == expected_reg_count, 'Expected that ' \
@@ -219,6 +219,7 @@ class MyHTTPServer():
         should_find_actions = {
             str(signal.SIGTERM) : 0,
             str(signal.SIGINT)  : 0,
+            str(signal.SIGHUP)  : 0,
             str(signal.SIGUSR1) : 0
         }
         # loop through all the defualt registered signals and updated the 
@@ -300,3 +301,1890 @@ class MyHTTPServer():
         actual_callback = actual_endpoint.callback
         assert actual_callback == callback, 'Expected register_endpoint(%s, %s, %s) callback to be "%s" not "%s"' %(path, value, callback, callback, actual_callback)
 
+
+    def test_constructor_defaults_to_single_serve_mode(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        assert srv.mode == intweb.SERVE_MODE == 'single', 'Expected that ' \
+                'mode default to "single" not "%s"' %(srv.mode)
+        assert srv.queue_depth() == 0, 'Expected that queue_depth() be 0 ' \
+                'when server is not running, not "%s"' %(srv.queue_depth())
+
+    @raises(ValueError)
+    def test_set_serve_mode_should_raise_ValueError_when_mode_is_unknown(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.set_serve_mode('forking')
+
+    @parameterized.expand([
+        (0, ),
+        ('4', ),
+    ])
+    @raises(ValueError)
+    def test_set_serve_mode_should_raise_ValueError_when_workers_is_not_a_positive_integer(self, workers):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.set_serve_mode('threaded', workers)
+
+    def test_start_workers_starts_a_bounded_pool_in_threaded_mode(self):
+        srv = intweb.MyHTTPServer(mode='threaded', workers=3)
+        srv.server_close()
+        srv.start_workers()
+        actual = len(srv._pool)
+        srv.stop_workers()
+        assert actual == 3, 'Expected that start_workers() start "%s" ' \
+                'worker threads not "%s"' %(3, actual)
+        assert not srv._pool, 'Expected that stop_workers() empty the pool'
+
+    def test_process_request_rejects_requests_beyond_max_in_flight(self):
+        srv = intweb.MyHTTPServer(mode='threaded', workers=1, max_in_flight=1)
+        srv.server_close()
+        srv._pool = ['busy']
+        srv._in_flight = 1
+        with patch.object(srv, 'reject_request') as mock_reject:
+            srv.process_request(object(), ('127.0.0.1', 0))
+        assert mock_reject.call_count == 1, 'Expected that a request beyond ' \
+                'max_in_flight be rejected'
+        assert srv.rejected == 1, 'Expected rejected counter to be 1 not ' \
+                '"%s"' %(srv.rejected)
+        assert srv.queue_depth() == 0, 'Expected that a rejected request ' \
+                'is not queued'
+
+@nottest
+def make_handler(request_version='HTTP/1.1', close_connection=0):
+    from StringIO import StringIO
+    class UnconnectedHandler(intweb.MyHandler):
+        def __init__(self):
+            pass
+    handler = UnconnectedHandler()
+    handler.wfile = StringIO()
+    handler.client_address = ('127.0.0.1', 0)
+    handler.command = 'GET'
+    handler.path = '/'
+    handler.request_version = request_version
+    handler.requestline = 'GET / %s' %(request_version)
+    handler.close_connection = close_connection
+    handler.requests_served = 0
+    handler.headers = {}
+    handler.log_message = lambda *args: None
+    handler.log_request = lambda *args: None
+    return handler
+
+@nottest
+def read_until_close(sock):
+    data = ''
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk: break
+            data += chunk
+    finally:
+        sock.close()
+    return data
+
+@nottest
+class ServingTest:
+    # For test classes that run a MyHTTPServer on a thread: its lockfile
+    # and control socket go to a temporary rundir, serve() starts it on
+    # the class's port and teardown() stops it again.
+    port = None
+
+    def setup(self):
+        import tempfile
+        self.rundir = tempfile.mkdtemp()
+        self.srv = None
+        self.thread = None
+
+    def teardown(self):
+        import shutil
+        if self.srv is not None:
+            self.srv.shutdown()
+            self.srv.server_close()
+        shutil.rmtree(self.rundir)
+
+    def make_server(self, mode=None, workers=2):
+        return intweb.MyHTTPServer('127.0.0.1', self.port, mode=mode, workers=workers,
+                                   lockfile=os.path.join(self.rundir, 'webserver.lock'),
+                                   control_socket=os.path.join(self.rundir, 'webserver.sock'))
+
+    def serve(self, mode, workers=2):
+        return self.run_server(self.make_server(mode, workers))
+
+    def run_server(self, srv):
+        import time
+        import threading
+        self.srv = srv
+        self.thread = threading.Thread(target=srv.run)
+        self.thread.daemon = True
+        self.thread.start()
+        # the port listens from the constructor on, the control socket once
+        # run() has started
+        assert intweb.wait_ready([self.port], '127.0.0.1', timeout=2.0)
+        deadline = time.time() + 2.0
+        while intweb.control_request('pid', srv.control_socket) is None:
+            assert time.time() < deadline, 'Expected the control socket to be listening'
+            time.sleep(0.01)
+        return srv
+
+    def connect(self, *parts):
+        import socket
+        sock = socket.create_connection(('127.0.0.1', self.port), 10)
+        for part in parts:
+            sock.sendall(part)
+        return sock
+
+    def request(self, *parts):
+        return read_until_close(self.connect(*parts))
+
+@istest
+class MyHandler():
+
+    def test_protocol_version_is_HTTP_1_1(self):
+        actual = intweb.MyHandler.protocol_version
+        assert actual == 'HTTP/1.1', 'Expected that MyHandler speak ' \
+                'HTTP/1.1 not "%s"' %(actual)
+
+    def test_send_valid_response_sends_content_length(self):
+        handler = make_handler()
+        handler.send_valid_response('55')
+        actual = handler.wfile.getvalue()
+        assert 'Content-Length: 2\r\n' in actual, 'Expected that response ' \
+                'contain a Content-Length header, got "%s"' %(actual)
+        assert actual.endswith('\r\n\r\n55'), 'Expected that response end ' \
+                'with body "55", got "%s"' %(actual)
+        assert 'Connection: close' not in actual, 'Expected that connection ' \
+                'be kept alive, got "%s"' %(actual)
+
+    def test_send_invalid_response_sends_zero_content_length(self):
+        handler = make_handler()
+        handler.send_invalid_response()
+        actual = handler.wfile.getvalue()
+        assert actual.startswith('HTTP/1.1 404'), 'Expected a 404 status ' \
+                'line, got "%s"' %(actual)
+        assert 'Content-Length: 0\r\n' in actual, 'Expected that 404 ' \
+                'response contain "Content-Length: 0", got "%s"' %(actual)
+
+    def test_send_body_closes_connection_after_max_requests(self):
+        handler = make_handler()
+        handler.max_requests = 2
+        handler.send_body(200, 'a')
+        assert not handler.close_connection, 'Expected that connection stay ' \
+                'open after the first request'
+        handler.send_body(200, 'b')
+        actual = handler.wfile.getvalue()
+        assert handler.close_connection, 'Expected that connection be ' \
+                'closed after max_requests'
+        assert actual.endswith('Connection: close\r\n\r\nb'), 'Expected ' \
+                'that last response announce "Connection: close", got "%s"' %(actual)
+
+    def test_send_body_announces_keep_alive_to_HTTP_1_0_clients(self):
+        handler = make_handler('HTTP/1.0')
+        handler.send_body(200, 'a')
+        actual = handler.wfile.getvalue()
+        assert 'Connection: keep-alive\r\n' in actual, 'Expected that ' \
+                'HTTP/1.0 keep-alive clients get "Connection: keep-alive", ' \
+                'got "%s"' %(actual)
+
+@istest
+class Router():
+
+    def test_match_ignores_query_parameter_order(self):
+        router = intweb.Router()
+        router.add('/twiddle/get.op?objectName=bean:name=datasource&attributeName=MaxPoolSize', 'max')
+        router.add('/twiddle/get.op?objectName=bean:name=datasource&attributeName=MinPoolSize', 'min')
+        actual, params = router.match('/twiddle/get.op?attributeName=MinPoolSize&objectName=bean%3Aname%3Ddatasource')
+        assert actual == 'min', 'Expected that query parameters match in ' \
+                'any order and encoding, got "%s"' %(actual)
+
+    def test_match_returns_None_when_query_predicate_does_not_match(self):
+        router = intweb.Router()
+        router.add('/get.op?attributeName=MaxPoolSize', 'max')
+        actual, params = router.match('/get.op?attributeName=Other')
+        assert actual is None, 'Expected no match, got "%s"' %(actual)
+        actual, params = router.match('/get.op')
+        assert actual is None, 'Expected no match without the query ' \
+                'parameter, got "%s"' %(actual)
+
+    def test_match_captures_path_and_query_parameters(self):
+        router = intweb.Router()
+        router.add('/users/{id}/roles?scope={scope}', 'roles')
+        actual, params = router.match('/users/42/roles?scope=admin&x=1')
+        assert actual == 'roles', 'Expected template route to match, ' \
+                'got "%s"' %(actual)
+        assert params == {'id': '42', 'scope': 'admin'}, 'Expected captured ' \
+                'parameters, got "%s"' %(params)
+
+    def test_match_prefers_literal_segments_and_falls_back_to_wildcard(self):
+        router = intweb.Router()
+        router.add('/static/*', 'prefix')
+        router.add('/static/{name}', 'template')
+        router.add('/static/index.html', 'literal')
+        assert router.match('/static/index.html')[0] == 'literal'
+        assert router.match('/static/app.js')[0] == 'template'
+        actual, params = router.match('/static/js/app.js')
+        assert actual == 'prefix', 'Expected wildcard route to match, ' \
+                'got "%s"' %(actual)
+        assert params == {'*': 'js/app.js'}, 'Expected wildcard remainder, ' \
+                'got "%s"' %(params)
+
+    def test_match_prefers_the_most_specific_query_predicates(self):
+        router = intweb.Router()
+        router.add('/get.op', 'any')
+        router.add('/get.op?attributeName=MaxPoolSize', 'max')
+        assert router.match('/get.op?attributeName=MaxPoolSize')[0] == 'max'
+        assert router.match('/get.op?attributeName=Other')[0] == 'any'
+
+    def test_remove_unregisters_route(self):
+        router = intweb.Router()
+        router.add('/users/{id}', 'user')
+        router.remove('/users/{id}')
+        actual, params = router.match('/users/1')
+        assert actual is None, 'Expected removed route to not match, ' \
+                'got "%s"' %(actual)
+        assert len(router) == 0
+
+    @raises(ValueError)
+    def test_add_should_raise_ValueError_when_wildcard_is_not_last(self):
+        intweb.Router().add('/static/*/foo', 'bad')
+
+    @raises(ValueError)
+    def test_add_should_raise_ValueError_for_equivalent_routes(self):
+        router = intweb.Router()
+        router.add('/get.op?a=1&b=2', 'first')
+        router.add('/get.op?b=2&a=1', 'second')
+
+def test_callback_body_renders_values_and_callables_as_strings():
+    assert intweb.callback_body(None) == '20'
+    assert intweb.callback_body(55) == '55'
+    assert intweb.callback_body(lambda: 31) == '31'
+
+def test_format_response_builds_a_complete_http_response():
+    actual = intweb.format_response(200, '55', close=True)
+    assert actual.startswith('HTTP/1.1 200 OK\r\n'), 'Expected status ' \
+            'line "HTTP/1.1 200 OK", got "%s"' %(actual)
+    assert 'Content-Length: 2\r\nConnection: close\r\n\r\n55' in actual, \
+            'Expected Content-Length, Connection and body, got "%s"' %(actual)
+
+def test_nonblocking_marks_callback():
+    callback = intweb.nonblocking(lambda: 1)
+    assert callback.nonblocking is True, 'Expected that nonblocking() ' \
+            'marks the callback'
+
+@istest
+class EventLoop():
+
+    def setup(self):
+        import threading
+        self.srv = intweb.MyHTTPServer('127.0.0.1', 48003, mode='eventloop', workers=2)
+        self.thread = threading.Thread(target=self.srv.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+
+    def request(self, raw):
+        import socket
+        sock = socket.create_connection(('127.0.0.1', 48003))
+        sock.sendall(raw)
+        data = ''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk: break
+            data += chunk
+        sock.close()
+        return data
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        import time
+        def slow():
+            time.sleep(0.2)
+            return 'slow'
+        self.srv.register_endpoint('/slow', None, slow)
+        self.srv.register_endpoint('/fast', None, intweb.nonblocking(lambda: 'fast'))
+        actual = self.request('GET /slow HTTP/1.1\r\n\r\n'
+                              'GET /missing HTTP/1.1\r\n\r\n'
+                              'GET /fast HTTP/1.1\r\nConnection: close\r\n\r\n')
+        import re
+        statuses = re.findall('HTTP/1.1 (\d+)', actual)
+        assert statuses == ['200', '404', '200'], \
+                'Expected three responses in request order, got "%s"' %(actual)
+        assert actual.find('slow') < actual.find('fast'), 'Expected slow ' \
+                'response before fast response, got "%s"' %(actual)
+
+    def test_callbacks_beyond_max_in_flight_get_503(self):
+        import threading
+        import time
+        release = threading.Event()
+        self.srv.max_in_flight = 1
+        self.srv.register_endpoint('/block', None, lambda *body: release.wait(5) and 'done',
+                                   methods=('GET', 'POST'))
+        results = []
+        first = threading.Thread(target=lambda: results.append(
+                self.request('GET /block HTTP/1.1\r\nConnection: close\r\n\r\n')))
+        first.start()
+        deadline = time.time() + 2.0
+        while self.srv.in_flight() < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        actual = self.request('POST /block HTTP/1.1\r\nContent-Length: 2\r\n\r\nhi')
+        assert actual.startswith('HTTP/1.1 503'), 'Expected a 503 past max_in_flight, got "%s"' %(actual)
+        actual = self.request('GET /block HTTP/1.1\r\n\r\n')
+        assert actual.startswith('HTTP/1.1 503'), 'Expected a 503 past max_in_flight, got "%s"' %(actual)
+        release.set()
+        first.join(5)
+        assert results and results[0].endswith('done'), 'Expected the admitted request ' \
+                'to be answered, got "%s"' %(results)
+        metrics = self.srv.render_metrics()
+        for line in ('intweb_rejected_total 2', 'intweb_in_flight 0'):
+            assert line in metrics, 'Expected "%s" in "%s"' %(line, metrics)
+
+    def test_unsupported_method_gets_501_and_connection_is_closed(self):
+        actual = self.request('BREW /foo HTTP/1.1\r\n\r\n')
+        assert actual.startswith('HTTP/1.1 501'), 'Expected 501 for ' \
+                'unsupported method, got "%s"' %(actual)
+
+@istest
+class KeepAlive(ServingTest):
+    port = 48016
+
+    @parameterized.expand([
+        ('single', 1),
+        ('threaded', 2),
+    ])
+    def test_idle_keepalive_clients_do_not_hold_up_other_clients(self, mode, idle):
+        import time
+        import socket
+        self.serve(mode, workers=2).register_endpoint('/max', 55)
+        clients = []
+        try:
+            for i in range(idle):
+                sock = self.connect('GET /max HTTP/1.1\r\n\r\n')
+                sock.settimeout(2.0)
+                assert sock.recv(4096).startswith('HTTP/1.1 200')
+                clients.append(sock)
+            start = time.time()
+            sock = self.connect('GET /max HTTP/1.1\r\nConnection: close\r\n\r\n')
+            sock.settimeout(3.0)
+            try:
+                actual = read_until_close(sock)
+            except socket.timeout:
+                actual = ''
+            elapsed = time.time() - start
+        finally:
+            for sock in clients:
+                sock.close()
+        assert actual.startswith('HTTP/1.1 200'), 'Expected an answer while %s client(s) ' \
+                'idled on keep-alive, got "%s" after %.2fs' %(idle, actual, elapsed)
+        assert elapsed < 1.0, 'Expected an answer without waiting for the idle ' \
+                'client(s), took %.2fs' %(elapsed)
+
+    def test_threaded_pool_keeps_connections_open_while_a_worker_is_free(self):
+        self.serve('threaded', workers=2).register_endpoint('/max', 55)
+        sock = self.connect('GET /max HTTP/1.1\r\n\r\n')
+        sock.settimeout(2.0)
+        first = sock.recv(4096)
+        sock.sendall('GET /max HTTP/1.1\r\nConnection: close\r\n\r\n')
+        second = read_until_close(sock)
+        assert 'Connection: close' not in first, 'Expected the connection to be ' \
+                'kept open, got "%s"' %(first)
+        assert second.startswith('HTTP/1.1 200'), 'Expected a second response on ' \
+                'the same connection, got "%s"' %(second)
+
+    @parameterized.expand([
+        ('single', 1),
+        ('prefork', 2),
+    ])
+    def test_pipelined_requests_are_answered_before_closing(self, mode, workers):
+        srv = self.make_server(mode, workers=workers)
+        srv.register_endpoint('/max', 55)
+        self.run_server(srv)
+        sock = self.connect('GET /max HTTP/1.1\r\n\r\n' * 3)
+        sock.settimeout(2.0)
+        actual = read_until_close(sock)
+        assert actual.count('HTTP/1.1 200') == 3, 'Expected all 3 pipelined requests answered in ' \
+                '%s mode, got "%s"' %(mode, actual)
+        assert actual.count('Connection: close') == 1, 'Expected only the last ' \
+                'response to close the connection, got "%s"' %(actual)
+
+    def test_register_endpoint_prerenders_static_values(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/max', 55)
+        endpoint = srv.endpoints().get('/max')
+        actual = endpoint.cached()
+        assert actual is not None, 'Expected that a static endpoint is ' \
+                'rendered at register_endpoint time'
+        assert actual.wire().endswith('Content-Length: 2\r\n\r\n55'), \
+                'Expected pre-rendered body "55", got "%s"' %(actual.wire())
+
+    def test_callback_endpoints_are_not_cached_without_ttl(self):
+        calls = []
+        endpoint = intweb.Endpoint('/busy', callback=lambda: calls.append(1) or len(calls))
+        endpoint.render()
+        actual = endpoint.render()
+        assert actual.body == '2', 'Expected callback to run on every ' \
+                'render, got "%s"' %(actual.body)
+        assert endpoint.cached() is None
+
+    def test_callback_endpoints_are_cached_for_ttl_until_invalidated(self):
+        calls = []
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/busy', callback=lambda: calls.append(1) or len(calls), ttl=60)
+        endpoint = srv.endpoints().get('/busy')
+        endpoint.render()
+        actual = endpoint.render()
+        assert actual.body == '1', 'Expected cached body "1" within ttl, ' \
+                'got "%s"' %(actual.body)
+        srv.invalidate('/busy')
+        actual = endpoint.render()
+        assert actual.body == '2', 'Expected callback to run again after ' \
+                'invalidate(), got "%s"' %(actual.body)
+
+    def test_rendered_response_adds_connection_header_variants(self):
+        rendered = intweb.RenderedResponse(200, 'ok')
+        assert 'Connection' not in rendered.wire()
+        assert rendered.wire('close').endswith('Connection: close\r\n\r\nok')
+        assert rendered.wire('keep-alive').endswith('Connection: keep-alive\r\n\r\nok')
+
+@istest
+class Metrics():
+
+    def test_endpoint_metrics_record_hits_bytes_and_histogram_bucket(self):
+        metrics = intweb.EndpointMetrics()
+        metrics.record(0.002, 10)
+        metrics.record(10.0, 5)
+        actual = metrics.snapshot()
+        assert actual['hits'] == 2
+        assert actual['bytes_sent'] == 15
+        assert actual['buckets'][intweb.LATENCY_BUCKETS.index(0.0025)] == 1, \
+                'Expected 2ms to land in the 2.5ms bucket, got "%s"' %(actual['buckets'])
+        assert actual['buckets'][-1] == 1, 'Expected 10s to land in the ' \
+                '+Inf bucket, got "%s"' %(actual['buckets'])
+
+    def test_route_serves_reserved_metrics_path(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        endpoint, params = srv.route(intweb.METRICS_PATH)
+        assert endpoint is not None, 'Expected "%s" to be served without ' \
+                'registering it' %(intweb.METRICS_PATH)
+        assert not srv.endpoints(), 'Expected metrics endpoint to not be ' \
+                'listed in endpoints()'
+
+    def test_render_metrics_reports_prometheus_text_per_endpoint(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/max', 55)
+        srv.endpoints().get('/max').metrics.record(0.001, 100)
+        srv.metrics.record_not_found()
+        actual = srv.render_metrics()
+        for line in ('# TYPE intweb_requests_total counter',
+                     'intweb_requests_total{path="/max"} 1',
+                     'intweb_response_bytes_total{path="/max"} 100',
+                     'intweb_request_duration_seconds_bucket{path="/max",le="0.001"} 1',
+                     'intweb_request_duration_seconds_bucket{path="/max",le="+Inf"} 1',
+                     'intweb_request_duration_seconds_count{path="/max"} 1',
+                     'intweb_not_found_total 1'):
+            assert line in actual.split('\n'), 'Expected "%s" in metrics ' \
+                    'output, got "%s"' %(line, actual)
+
+    def test_do_GET_counts_hits_and_not_found(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/max', 55)
+        handler = make_handler()
+        handler.server = srv
+        handler.path = '/max'
+        handler.do_GET()
+        handler.path = '/missing'
+        handler.do_GET()
+        actual = srv.endpoints().get('/max').metrics.snapshot()
+        assert actual['hits'] == 1, 'Expected 1 hit not "%s"' %(actual['hits'])
+        assert actual['bytes_sent'] > 0
+        assert srv.metrics.not_found == 1, 'Expected 1 not found, got ' \
+                '"%s"' %(srv.metrics.not_found)
+
+    def test_do_GET_answers_500_and_counts_error_when_callback_raises(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/boom', callback=lambda: 1 / 0)
+        handler = make_handler()
+        handler.server = srv
+        handler.path = '/boom'
+        handler.log_error = lambda *args: None
+        handler.do_GET()
+        actual = handler.wfile.getvalue()
+        assert actual.startswith('HTTP/1.1 500'), 'Expected a 500 response, ' \
+                'got "%s"' %(actual)
+        assert srv.endpoints().get('/boom').metrics.errors == 1
+
+@istest
+class Discovery():
+
+    def setup(self):
+        import tempfile
+        self.rundir = tempfile.mkdtemp()
+        self.pidfile = os.path.join(self.rundir, 'webserver.pid')
+        self.lockfile = os.path.join(self.rundir, 'webserver.pid.lock')
+        self.control_socket = os.path.join(self.rundir, 'webserver.sock')
+        self.srv = intweb.MyHTTPServer(port=48004, lockfile=self.lockfile,
+                                       control_socket=self.control_socket)
+        self.srv.server_close()
+
+    def teardown(self):
+        import shutil
+        self.srv.stop_control()
+        self.srv.unlock_instance()
+        shutil.rmtree(self.rundir)
+
+    def status(self):
+        return intweb.status_server(self.pidfile, self.lockfile, self.control_socket)
+
+    def test_read_pid_returns_None_for_missing_or_garbage_pidfile(self):
+        assert intweb.read_pid(self.pidfile) is None
+        with open(self.pidfile, 'w') as pidfile:
+            pidfile.write('garbage\n')
+        assert intweb.read_pid(self.pidfile) is None
+
+    def test_pid_alive(self):
+        assert intweb.pid_alive(os.getpid()) is True
+
+    def test_lock_held_only_while_server_holds_the_lock(self):
+        assert not intweb.lock_held(self.lockfile)
+        self.srv.lock_instance()
+        assert intweb.lock_held(self.lockfile), 'Expected lock_held() to ' \
+                'see the lock taken by lock_instance()'
+        assert intweb.read_pid(self.lockfile) == os.getpid()
+        self.srv.unlock_instance()
+        assert not intweb.lock_held(self.lockfile)
+
+    @raises(RuntimeError)
+    def test_lock_instance_should_raise_RuntimeError_when_already_locked(self):
+        self.srv.lock_instance()
+        other = intweb.MyHTTPServer(port=48005, lockfile=self.lockfile)
+        other.server_close()
+        other.lock_instance()
+
+    def test_status_server_ignores_stale_pidfile_without_lock(self):
+        with open(self.pidfile, 'w') as pidfile:
+            pidfile.write('%s\n' %(os.getppid()))
+        actual = self.status()
+        assert actual is None, 'Expected a pidfile without a held lock to ' \
+                'be ignored, got "%s"' %(actual)
+
+    def test_status_server_ignores_a_pidfile_that_does_not_match_the_lock(self):
+        self.srv.lock_instance()
+        with open(self.pidfile, 'w') as pidfile:
+            pidfile.write('%s\n' %(os.getppid()))
+        actual = self.status()
+        assert actual is None, 'Expected the live pid in the pidfile to be ' \
+                'ignored when the lock holder recorded another, got "%s"' %(actual)
+
+    def test_status_server_returns_the_pid_recorded_by_the_lock_holder(self):
+        import time
+        import signal
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.srv.lock_instance()
+                time.sleep(30)
+            finally:
+                os._exit(0)
+        try:
+            for i in range(200):
+                if intweb.read_pid(self.lockfile) == pid: break
+                time.sleep(0.01)
+            with open(self.pidfile, 'w') as pidfile:
+                pidfile.write('%s\n' %(os.getppid()))
+            actual = self.status()
+            assert actual == pid, 'Expected the pid of the lock holder %s, ' \
+                    'got "%s"' %(pid, actual)
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+    def test_status_server_never_returns_its_own_pid(self):
+        self.srv.lock_instance()
+        with open(self.pidfile, 'w') as pidfile:
+            pidfile.write('%s\n' %(os.getpid()))
+        actual = self.status()
+        assert actual is None, 'Expected status_server() to not return ' \
+                'its own pid, got "%s"' %(actual)
+
+    def test_control_socket_answers_commands(self):
+        self.srv.register_endpoint('/max', 55)
+        self.srv.start_control()
+        actual = intweb.control_request('pid', self.control_socket)
+        assert actual == str(os.getpid()), 'Expected control socket to ' \
+                'answer "pid" with "%s", got "%s"' %(os.getpid(), actual)
+        actual = intweb.control_request('endpoints', self.control_socket)
+        assert actual == '/max', 'Expected control socket to list ' \
+                'endpoints, got "%s"' %(actual)
+        actual = intweb.control_request('bogus', self.control_socket)
+        assert actual.startswith('error'), 'Expected an error for an ' \
+                'unknown command, got "%s"' %(actual)
+
+    def test_control_request_returns_None_when_nobody_listens(self):
+        assert intweb.control_request('pid', self.control_socket) is None
+
+@istest
+class RuntimeRegistration():
+
+    def setup(self):
+        self.srv = intweb.MyHTTPServer()
+        self.srv.server_close()
+
+    def test_update_endpoint_replaces_a_registered_endpoint(self):
+        self.srv.register_endpoint('/max', 55)
+        self.srv.update_endpoint('/max', 60)
+        endpoint, params = self.srv.route('/max')
+        assert endpoint.value == 60, 'Expected updated value 60, got ' \
+                '"%s"' %(endpoint.value)
+
+    def test_unregister_endpoint_removes_route_and_listing(self):
+        self.srv.register_endpoint('/users/{id}', 1)
+        assert self.srv.unregister_endpoint('/users/{id}') is True
+        assert self.srv.route('/users/1')[0] is None
+        assert not self.srv.endpoints()
+        assert self.srv.unregister_endpoint('/users/{id}') is False
+
+    def test_load_endpoints_merges_specs_and_resolves_named_callbacks(self):
+        self.srv.register_endpoint('/min', 50)
+        loaded = self.srv.load_endpoints([
+            {'path': '/max', 'value': 55},
+            {'path': '/busy', 'callback': 'random_busy'},
+        ])
+        assert loaded == 2
+        assert sorted(self.srv.endpoints()) == ['/busy', '/max', '/min']
+        assert self.srv.route('/busy')[0].callback is intweb.random_busy
+
+    def test_load_endpoints_with_replace_drops_existing_endpoints(self):
+        self.srv.register_endpoint('/min', 50)
+        self.srv.load_endpoints([{'path': '/max', 'value': 55}], replace=True)
+        assert sorted(self.srv.endpoints()) == ['/max']
+        assert self.srv.route('/min')[0] is None
+
+    @parameterized.expand([
+        ({'value': 1}, ),
+        ({'path': '/x', 'callback': 'no_such_callback'}, ),
+        ({'path': '/x', 'colour': 'red'}, ),
+        ('/x', ),
+        ({'path': 5, 'value': 1}, ),
+        ({'path': '/x', 'value': 1, 'faults': {'seed': [1]}}, ),
+    ])
+    @raises(ValueError)
+    def test_load_endpoints_should_raise_ValueError_for_invalid_specs(self, spec):
+        self.srv.load_endpoints([{'path': '/ok', 'value': 1}, spec])
+
+    def test_load_endpoints_is_all_or_nothing(self):
+        try:
+            self.srv.load_endpoints([{'path': '/ok', 'value': 1}, {'value': 2}])
+        except ValueError:
+            pass
+        assert not self.srv.endpoints(), 'Expected an invalid bulk load ' \
+                'to not register any endpoint'
+
+    def test_load_endpoints_is_all_or_nothing_when_a_route_conflicts(self):
+        self.srv.register_endpoint('/users/{id}', 1)
+        try:
+            self.srv.load_endpoints([{'path': '/ok', 'value': 1}, {'path': '/users/{name}', 'value': 2}])
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected ValueError for a conflicting capture name'
+        assert sorted(self.srv.endpoints()) == ['/users/{id}']
+        assert self.srv.route('/ok')[0] is None, 'Expected a failed load to leave no route behind'
+
+    def test_load_endpoints_defers_rendering_and_metrics_to_first_use(self):
+        self.srv.load_endpoints([{'path': '/max', 'value': 55}])
+        endpoint = self.srv.route('/max')[0]
+        assert endpoint.rendered is None and endpoint._metrics is None, \
+                'Expected nothing to be rendered or allocated by a load'
+        assert endpoint.render().body == '55'
+        assert endpoint.rendered is not None, 'Expected the first render to be kept'
+        assert endpoint.metrics.hits == 0
+
+    def test_load_endpoints_loads_a_large_manifest_well_under_a_second(self):
+        import gc
+        import time
+        self.srv.register_endpoint('/min', 50)
+        specs = [{'path': u'/items/%s' %(i), 'value': i} for i in range(50000)]
+        gc.collect()
+        start = time.time()
+        self.srv.load_endpoints(specs)
+        elapsed = time.time() - start
+        assert len(self.srv.endpoints()) == 50001
+        assert self.srv.route('/items/49999')[0].value == 49999
+        assert elapsed < 1.0, 'Expected 50000 endpoints to load in well under a second, took %.3fs' %(elapsed)
+
+    def test_control_socket_applies_changes_to_live_registry(self):
+        import tempfile, shutil
+        rundir = tempfile.mkdtemp()
+        self.srv.control_socket = os.path.join(rundir, 'webserver.sock')
+        self.srv.start_control()
+        try:
+            actual = intweb.control_command('load', [{'path': '/max', 'value': 55}],
+                                            self.srv.control_socket)
+            assert actual == 'ok 1', 'Expected "ok 1", got "%s"' %(actual)
+            assert self.srv.route('/max')[0].value == 55
+            intweb.control_command('delete', ['/max'], self.srv.control_socket)
+            assert not self.srv.endpoints()
+        finally:
+            self.srv.stop_control()
+            shutil.rmtree(rundir)
+
+    def test_add_endpoints_registers_new_paths_and_updates_registered_ones(self):
+        self.srv.register_endpoint('/max', 55)
+        assert self.srv.add_endpoints([{'path': '/min', 'value': 50}]) == 1
+        assert self.srv.add_endpoints([{'path': '/max', 'value': 60}], replace=True) == 1
+        actual = (self.srv.route('/min')[0].value, self.srv.route('/max')[0].value)
+        assert actual == (50, 60), 'Expected /min=50 and /max=60, got "%s"' %(actual,)
+
+    @parameterized.expand([
+        ([{'path': '/max', 'value': 1}], False),
+        ([{'path': '/new', 'value': 1}, {'path': '/new', 'value': 2}], False),
+        ([{'path': '/missing', 'value': 1}], True),
+    ])
+    @raises(ValueError)
+    def test_add_endpoints_should_raise_ValueError_for_conflicting_specs(self, specs, replace):
+        self.srv.register_endpoint('/max', 55)
+        try:
+            self.srv.add_endpoints([{'path': '/ok', 'value': 1}] + specs, replace)
+        finally:
+            assert '/ok' not in self.srv.endpoints(), 'Expected nothing to be added'
+
+    def test_register_into_a_large_registry_does_not_rebuild_the_route_table(self):
+        import gc
+        import time
+        self.srv.load_endpoints([{'path': '/items/%s' %(i), 'value': i} for i in range(20000)])
+        gc.collect()
+        start = time.time()
+        self.srv.control_commands['register']('{"path": "/new", "value": 7}')
+        elapsed = time.time() - start
+        assert self.srv.route('/new')[0].value == 7
+        assert elapsed < 0.05, 'Expected one register in milliseconds, took %.3fs' %(elapsed)
+
+    def control(self, command):
+        # Calls command with the path of a control socket started for it
+        import tempfile, shutil
+        rundir = tempfile.mkdtemp()
+        self.srv.control_socket = os.path.join(rundir, 'webserver.sock')
+        self.srv.start_control()
+        try:
+            return command(self.srv.control_socket)
+        finally:
+            self.srv.stop_control()
+            shutil.rmtree(rundir)
+
+    @raises(RuntimeError)
+    def test_control_command_should_raise_RuntimeError_on_error_reply(self):
+        self.control(lambda path: intweb.control_command('load', [{'value': 1}], path))
+
+    def test_control_socket_replies_with_an_error_when_a_command_fails(self):
+        self.srv.control_commands['boom'] = lambda args: {}['missing']
+        with patch.object(intweb.traceback, 'print_exc'):
+            actual = self.control(lambda path: intweb.control_request('boom', path))
+        assert actual.startswith('error KeyError'), 'Expected an error reply, got "%s"' %(actual)
+
+    @raises(RuntimeError)
+    def test_control_command_should_raise_RuntimeError_on_an_empty_reply(self):
+        self.srv.control_commands['quiet'] = lambda args: ''
+        self.control(lambda path: intweb.control_command('quiet', None, path))
+
+@istest
+class Manifest():
+
+    def setup(self):
+        import tempfile
+        self.rundir = tempfile.mkdtemp()
+        self.srv = intweb.MyHTTPServer()
+        self.srv.server_close()
+
+    def teardown(self):
+        import shutil
+        shutil.rmtree(self.rundir)
+
+    def write(self, name, content):
+        path = os.path.join(self.rundir, name)
+        with open(path, 'w') as manifest:
+            manifest.write(content)
+        return path
+
+    def test_load_manifest_reads_json_with_values_callbacks_and_files(self):
+        self.write('body.txt', 'from a file')
+        path = self.write('endpoints.json', '{"endpoints": ['
+                          '{"path": "/max", "value": 55},'
+                          '{"path": "/busy", "callback": "random_busy", "ttl": 5},'
+                          '{"path": "/file", "file": "body.txt"}]}')
+        actual = self.srv.load_manifest(path)
+        assert actual == 3, 'Expected 3 endpoints loaded not "%s"' %(actual)
+        assert self.srv.route('/max')[0].render().body == '55'
+        assert self.srv.route('/busy')[0].callback is intweb.random_busy
+        assert self.srv.route('/busy')[0].ttl == 5
+        endpoint = self.srv.route('/file')[0]
+        assert isinstance(endpoint, intweb.FileEndpoint), 'Expected a file ' \
+                'body to be served by a FileEndpoint, got "%s"' %(type(endpoint))
+        assert endpoint.filename == os.path.join(self.rundir, 'body.txt')
+
+    def test_load_manifest_streams_json_lines(self):
+        path = self.write('endpoints.jsonl', '# comment\n'
+                          '{"path": "/max", "value": 55}\n\n'
+                          '{"path": "/min", "value": 50}\n')
+        actual = self.srv.load_manifest(path)
+        assert actual == 2
+        assert sorted(self.srv.endpoints()) == ['/max', '/min']
+
+    def test_load_manifest_reads_ini_sections_as_paths(self):
+        path = self.write('endpoints.ini',
+                          '[/twiddle/get.op?objectName=bean:name=datasource&attributeName=MaxPoolSize]\n'
+                          'value = 55\n'
+                          '[/busy]\n'
+                          'callback = random_busy\n'
+                          'ttl = 2.5\n')
+        actual = self.srv.load_manifest(path)
+        assert actual == 2
+        endpoint = self.srv.route('/twiddle/get.op?attributeName=MaxPoolSize&objectName=bean:name=datasource')[0]
+        assert endpoint.render().body == '55'
+        assert self.srv.route('/busy')[0].ttl == 2.5
+
+    def test_load_manifest_reads_ini_faults_as_json(self):
+        path = self.write('endpoints.ini',
+                          '[/x]\n'
+                          'value = hi\n'
+                          'faults = {"error_rate": 1.0}\n')
+        actual = self.srv.load_manifest(path)
+        assert actual == 1
+        actual = self.srv.route('/x')[0].faults
+        assert isinstance(actual, intweb.FaultProfile) and actual.error_rate == 1.0, \
+                'Expected a FaultProfile with error_rate 1.0, got "%s"' %(actual)
+
+    @parameterized.expand([
+        ('endpoints.txt', '[]'),
+        ('endpoints.ini', '[/x]\nvalue = hi\nfaults = often\n'),
+        ('endpoints.json', '{"path": "/max"}'),
+        ('endpoints.jsonl', '{"path": "/max", "value": 1, "callback": "random_busy"}\n'),
+        ('endpoints.jsonl', '{"path": "/max", "ttl": "soon"}\n'),
+        ('endpoints.jsonl', 'not json\n'),
+        ('endpoints.json', '[{"path": "/missing", "file": "missing.txt"}]'),
+    ])
+    @raises(ValueError)
+    def test_load_manifest_should_raise_ValueError_for_invalid_manifests(self, name, content):
+        self.srv.load_manifest(self.write(name, content))
+
+@parameterized.expand([
+    ('bytes=0-9', (0, 9)),
+    ('bytes=90-', (90, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=95-200', (95, 99)),
+    ('bytes=100-', False),
+    ('bytes=9-0', False),
+    ('bytes=0-1,5-6', None),
+    ('lines=0-1', None),
+    (None, None),
+])
+def test_parse_range_handles_single_byte_ranges(header, expected):
+    actual = intweb.parse_range(header, 100)
+    assert actual == expected, 'Expected parse_range(%s) to return "%s" ' \
+            'not "%s"' %(header, expected, actual)
+
+@istest
+class LargeBodies():
+
+    def setup(self):
+        import tempfile
+        self.rundir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.rundir, 'body.bin')
+        with open(self.filename, 'wb') as body:
+            body.write(''.join(chr(i % 256) for i in range(200000)))
+
+    def teardown(self):
+        import shutil
+        shutil.rmtree(self.rundir)
+
+    def test_file_response_streams_whole_file_in_bounded_chunks(self):
+        response = intweb.FileResponse(self.filename, 'application/octet-stream')
+        chunks = list(response.chunks())
+        assert chunks[0].startswith('HTTP/1.1 200 OK\r\n')
+        assert 'Content-Length: 200000\r\n' in chunks[0]
+        assert max(len(chunk) for chunk in chunks[1:]) <= intweb.STREAM_CHUNK
+        assert ''.join(chunks[1:]) == open(self.filename, 'rb').read()
+
+    def test_file_response_serves_partial_content_for_range(self):
+        response = intweb.FileResponse(self.filename, 'application/octet-stream', 'bytes=70000-70009')
+        chunks = list(response.chunks('close'))
+        assert chunks[0].startswith('HTTP/1.1 206 Partial Content\r\n'), \
+                'Expected a 206, got "%s"' %(chunks[0])
+        assert 'Content-Range: bytes 70000-70009/200000\r\n' in chunks[0]
+        assert ''.join(chunks[1:]) == open(self.filename, 'rb').read()[70000:70010]
+
+    def test_file_response_answers_416_for_unsatisfiable_range(self):
+        response = intweb.FileResponse(self.filename, 'application/octet-stream', 'bytes=300000-')
+        chunks = list(response.chunks())
+        assert chunks == [response.head()], 'Expected headers only'
+        assert chunks[0].startswith('HTTP/1.1 416')
+        assert 'Content-Range: bytes */200000\r\n' in chunks[0]
+
+    @raises(ValueError)
+    def test_file_endpoint_should_raise_ValueError_for_missing_file(self):
+        intweb.FileEndpoint('/missing', os.path.join(self.rundir, 'missing'))
+
+    def test_do_GET_serves_registered_file_with_range(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_file('/body.bin', self.filename)
+        handler = make_handler()
+        handler.server = srv
+        handler.path = '/body.bin'
+        handler.headers = {'range': 'bytes=0-3'}
+        handler.do_GET()
+        actual = handler.wfile.getvalue()
+        assert actual.startswith('HTTP/1.1 206'), 'Expected a 206, got "%s"' %(actual)
+        assert actual.endswith('\r\n\r\n\x00\x01\x02\x03')
+
+    def test_generator_callbacks_are_sent_chunked(self):
+        def body():
+            yield 'ab'
+            yield ''
+            yield 'cde'
+        handler = make_handler()
+        handler.send_valid_response(body)
+        actual = handler.wfile.getvalue()
+        assert 'Transfer-Encoding: chunked\r\n' in actual
+        assert actual.endswith('\r\n\r\n2\r\nab\r\n3\r\ncde\r\n0\r\n\r\n'), \
+                'Expected chunked body, got "%s"' %(actual)
+        assert not handler.close_connection
+
+    def test_generator_callbacks_close_HTTP_1_0_connections_instead_of_chunking(self):
+        handler = make_handler('HTTP/1.0')
+        handler.send_valid_response(lambda: iter(['ab', 'cde']))
+        actual = handler.wfile.getvalue()
+        assert 'Transfer-Encoding' not in actual
+        assert actual.endswith('Connection: close\r\n\r\nabcde'), \
+                'Expected raw body ended by close, got "%s"' %(actual)
+        assert handler.close_connection
+
+@istest
+class Methods(ServingTest):
+    port = 48006
+
+    def test_request_body_reads_content_length_in_pieces(self):
+        from StringIO import StringIO
+        body = intweb.RequestBody(StringIO('abcdefgh' + 'GET /next'), 8)
+        actual = [body.read(3), body.read(3), body.read(3), body.read(3)]
+        assert actual == ['abc', 'def', 'gh', ''], 'Expected the body in ' \
+                'pieces and nothing past Content-Length, got "%s"' %(actual)
+
+    def test_request_body_decodes_chunked_transfer_coding(self):
+        from StringIO import StringIO
+        rfile = StringIO('3\r\nabc\r\n5;ext=1\r\ndefgh\r\n0\r\nTrailer: x\r\n\r\nGET /next')
+        body = intweb.RequestBody(rfile, chunked=True)
+        actual = ''.join(body)
+        assert actual == 'abcdefgh', 'Expected "abcdefgh" not "%s"' %(actual)
+        assert rfile.read() == 'GET /next', 'Expected the trailer to be consumed'
+
+    def test_body_decoder_decodes_chunked_body_fed_a_byte_at_a_time(self):
+        decoder = intweb.BodyDecoder(chunked=True)
+        raw = '3\r\nabc\r\nA\r\n0123456789\r\n0\r\n\r\nGET'
+        pieces = []
+        rest = ''
+        for byte in raw:
+            decoded, rest = decoder.feed(rest + byte)
+            pieces.extend(decoded)
+            if decoder.done: break
+        assert ''.join(pieces) == 'abc0123456789', 'Expected the decoded ' \
+                'body, got "%s"' %(pieces)
+        assert decoder.done and rest == '', 'Expected the decoder to stop ' \
+                'at the end of the body, rest="%s"' %(rest)
+
+    @raises(ValueError)
+    def test_body_decoder_should_raise_ValueError_for_bad_chunk_size(self):
+        intweb.BodyDecoder(chunked=True).feed('zz\r\nabc\r\n')
+
+    @raises(ValueError)
+    def test_endpoint_should_raise_ValueError_for_unknown_method(self):
+        intweb.Endpoint('/foo', 1, methods=('BREW',))
+
+    def test_register_endpoint_per_method_shares_the_path(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/items', 'list')
+        srv.register_endpoint('/items', callback=lambda body: 'created', methods=('POST', 'PUT'))
+        srv.register_endpoint('/items', 'ignored', methods=('POST',))
+        endpoint = srv.endpoints()['/items']
+        actual = endpoint.allowed_methods()
+        assert actual == ['GET', 'HEAD', 'POST', 'PUT'], 'Expected GET, HEAD, ' \
+                'POST and PUT on /items not "%s"' %(actual)
+        post = endpoint.for_method('POST')
+        assert post.accept(intweb.RequestBody(None)).body == 'created', \
+                'Expected the first POST registration to be kept'
+        assert endpoint.for_method('DELETE') is None
+
+    def test_load_endpoints_merges_specs_for_the_same_path(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.load_endpoints([{'path': '/items', 'value': 'list'},
+                            {'path': '/items', 'value': 'gone', 'methods': ['DELETE']}])
+        endpoint, params = srv.route('/items')
+        actual = endpoint.for_method('DELETE').value
+        assert actual == 'gone', 'Expected DELETE to answer "gone" not "%s"' %(actual)
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_large_upload_is_streamed_to_the_callback(self, mode):
+        received = []
+        def upload(body):
+            for piece in body:
+                received.append(len(piece))
+            return sum(received)
+        self.serve(mode).register_endpoint('/upload', callback=upload, methods=('POST',))
+        size = 3 * 1024 * 1024
+        actual = self.request('POST /upload HTTP/1.1\r\nContent-Length: %d\r\n'
+                              'Connection: close\r\n\r\n' %(size), 'x' * size)
+        assert actual.startswith('HTTP/1.1 200'), 'Expected 200 not "%s"' %(actual[:200])
+        assert actual.endswith('\r\n\r\n%d' %(size)), 'Expected the callback ' \
+                'to read %s bytes, got "%s"' %(size, actual[-200:])
+        assert max(received) <= intweb.STREAM_CHUNK, 'Expected the body in ' \
+                'pieces of at most STREAM_CHUNK bytes, got %s' %(max(received))
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_chunked_upload_and_unread_body_keep_the_connection_usable(self, mode):
+        srv = self.serve(mode)
+        srv.register_endpoint('/echo', callback=lambda body: ''.join(body), methods=('PUT',))
+        srv.register_endpoint('/ignore', 'ignored', methods=('POST',))
+        actual = self.request('PUT /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                              '4\r\nabcd\r\n2\r\nef\r\n0\r\n\r\n',
+                              'POST /ignore HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello',
+                              'GET /ignore HTTP/1.1\r\nConnection: close\r\n\r\n')
+        import re
+        statuses = re.findall('HTTP/1.1 (\d+)', actual)
+        assert statuses == ['200', '200', '405'], 'Expected PUT, POST then ' \
+                'a 405 for GET, got "%s"' %(actual)
+        assert '\r\n\r\nabcdef' in actual, 'Expected the chunked body echoed, got "%s"' %(actual)
+        assert 'Allow: POST\r\n' in actual, 'Expected an Allow header, got "%s"' %(actual)
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_head_reuses_get_without_a_body(self, mode):
+        self.serve(mode).register_endpoint('/max', 55)
+        actual = self.request('HEAD /max HTTP/1.1\r\n\r\n',
+                              'GET /max HTTP/1.1\r\nConnection: close\r\n\r\n')
+        head, sep, rest = actual.partition('\r\n\r\n')
+        assert head.endswith('Content-Length: 2'), 'Expected the GET Content-Length, got "%s"' %(head)
+        assert rest.startswith('HTTP/1.1 200'), 'Expected no body after the ' \
+                'HEAD response, got "%s"' %(rest)
+        assert rest.endswith('\r\n\r\n55')
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_expect_100_continue_is_answered_before_the_body(self, mode):
+        self.serve(mode).register_endpoint('/upload', callback=lambda body: len(body.read()),
+                                           methods=('POST',))
+        sock = self.connect('POST /upload HTTP/1.1\r\nContent-Length: 3\r\nExpect: 100-continue\r\n'
+                            'Connection: close\r\n\r\n')
+        actual = sock.recv(4096)
+        assert actual == 'HTTP/1.1 100 Continue\r\n\r\n', 'Expected a 100 ' \
+                'Continue before sending the body, got "%s"' %(actual)
+        sock.sendall('abc')
+        actual = sock.recv(4096)
+        sock.close()
+        assert actual.startswith('HTTP/1.1 200') and actual.endswith('\r\n\r\n3')
+
+@istest
+class Faults(ServingTest):
+    port = 48007
+
+    def get(self, path):
+        return self.request('GET %s HTTP/1.1\r\nConnection: close\r\n\r\n' %(path))
+
+    def test_plan_is_None_for_a_profile_that_does_nothing(self):
+        assert intweb.FaultProfile().plan() is None
+
+    def test_plan_is_repeatable_with_a_seed(self):
+        first = intweb.FaultProfile(latency=('uniform', 0.1, 0.2), error_rate=0.5, seed=7)
+        second = intweb.FaultProfile(latency=('uniform', 0.1, 0.2), error_rate=0.5, seed=7)
+        actual = [first.plan() for i in range(20)]
+        expected = [second.plan() for i in range(20)]
+        assert actual == expected, 'Expected seeded profiles to plan alike'
+        assert all(0.1 <= fault.delay <= 0.2 for fault in actual)
+        assert set(fault.status for fault in actual) == set([None, 500])
+
+    @parameterized.expand([
+        ({'error_rate': 1.5},),
+        ({'latency': ('gamma', 1, 2)},),
+        ({'latency': ('uniform', 0.1)},),
+        ({'bandwidth': 0},),
+        ({'error_status': 999},),
+        ({'jitter': 0.1},),
+    ])
+    @raises(ValueError)
+    def test_faults_from_spec_should_raise_ValueError_for_bad_spec(self, spec):
+        intweb.faults_from_spec(spec)
+
+    def test_cut_response_keeps_the_head_and_part_of_the_body(self):
+        response = intweb.format_response(200, 'abcdefghij')
+        actual = intweb.cut_response(response, 0.5)
+        assert actual == response[:-5], 'Expected half the body, got "%s"' %(actual)
+
+    def test_latency_is_held_on_timers_without_stalling_healthy_endpoints(self):
+        import time
+        srv = self.serve('eventloop', workers=1)
+        srv.register_endpoint('/slow', 'slow', faults={'latency': 0.5})
+        srv.register_endpoint('/fast', 'fast')
+        start = time.time()
+        slow = [self.connect('GET /slow HTTP/1.1\r\nConnection: close\r\n\r\n') for i in range(50)]
+        actual = self.get('/fast')
+        fast = time.time() - start
+        assert actual.endswith('\r\n\r\nfast') and fast < 0.4, 'Expected /fast to ' \
+                'be served while /slow is held, took %.3fs' %(fast)
+        for sock in slow:
+            assert read_until_close(sock).endswith('\r\n\r\nslow')
+        elapsed = time.time() - start
+        assert 0.45 <= elapsed < 2.0, 'Expected 50 concurrent 0.5s delays to ' \
+                'overlap, took %.3fs' %(elapsed)
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_error_rate_answers_the_error_status(self, mode):
+        self.serve(mode).register_endpoint('/flaky', 55, faults={'error_rate': 1.0, 'error_status': 503})
+        actual = self.get('/flaky')
+        assert actual.startswith('HTTP/1.1 503'), 'Expected a 503, got "%s"' %(actual)
+        metrics = self.srv.endpoints()['/flaky'].metrics.snapshot()
+        assert metrics['faults'] == 1, 'Expected the fault to be counted, got "%s"' %(metrics)
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_reset_rate_resets_the_connection(self, mode):
+        import errno
+        import socket
+        self.serve(mode).register_endpoint('/reset', 55, faults={'reset_rate': 1.0})
+        sock = self.connect('GET /reset HTTP/1.1\r\n\r\n')
+        try:
+            actual = sock.recv(65536)
+        except socket.error as e:
+            actual = e.args[0]
+        sock.close()
+        assert actual == errno.ECONNRESET, 'Expected the connection to be ' \
+                'reset, got "%s"' %(actual)
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_partial_rate_cuts_the_body_and_closes(self, mode):
+        self.serve(mode).register_endpoint('/partial', 'x' * 1000, faults={'partial_rate': 1.0, 'seed': 1})
+        actual = self.get('/partial')
+        head, sep, body = actual.partition('\r\n\r\n')
+        assert 'Content-Length: 1000' in head, 'Expected the full head, got "%s"' %(head)
+        assert len(body) < 1000, 'Expected a cut body, got %s bytes' %(len(body))
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_bandwidth_throttles_the_response(self, mode):
+        import time
+        self.serve(mode).register_endpoint('/throttled', 'x' * 2000, faults={'bandwidth': 4000})
+        start = time.time()
+        actual = self.get('/throttled')
+        elapsed = time.time() - start
+        assert actual.endswith('x' * 2000), 'Expected the whole body'
+        assert elapsed >= 0.4, 'Expected ~2100 bytes at 4000 bytes/sec to ' \
+                'take about half a second, took %.3fs' %(elapsed)
+
+    def test_set_faults_heals_an_endpoint(self):
+        srv = self.serve('eventloop')
+        srv.register_endpoint('/flaky', 55, faults={'error_rate': 1.0})
+        srv.set_faults('/flaky', None)
+        actual = self.get('/flaky')
+        assert actual.startswith('HTTP/1.1 200'), 'Expected a 200, got "%s"' %(actual)
+
+@istest
+class Recording(ServingTest):
+    port = 48008
+
+    def setup(self):
+        ServingTest.setup(self)
+        self.log = os.path.join(self.rundir, 'requests.jsonl')
+
+    def entries(self):
+        with open(self.log) as log:
+            return [intweb.decode_record(line) for line in log]
+
+    def test_encode_record_round_trips_binary_bodies_and_headers(self):
+        request = (12.5, 'PUT', '/caf\xe9', 'HTTP/1.1', {'x-name': 'caf\xe9'})
+        line = intweb.encode_record(request, ('\x00\xff' * 3, 10))
+        actual = intweb.decode_record(line)
+        assert line.endswith('\n') and '\n' not in line[:-1]
+        assert actual['path'] == '/caf\xe9', 'Expected the raw path, got "%r"' %(actual['path'])
+        assert actual['headers'] == {'x-name': 'caf\xe9'}
+        assert actual['body'] == '\x00\xff' * 3
+        assert actual['body_length'] == 10, 'Expected the full body length ' \
+                'of a truncated body, got "%s"' %(actual)
+
+    def test_recorder_counts_dropped_requests_when_the_queue_is_full(self):
+        recorder = intweb.Recorder(self.log)
+        with patch.object(recorder._queue, 'put_nowait', side_effect=intweb.Queue.Full):
+            recorder.record((0, 'GET', '/', 'HTTP/1.1', {}))
+        recorder.close()
+        assert recorder.dropped == 1, 'Expected 1 dropped request, got %s' %(recorder.dropped)
+        assert self.entries() == [], 'Expected the dropped request to be left out'
+
+    def test_do_GET_records_requests_while_recording(self):
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/max', 55)
+        srv.start_recording(self.log)
+        handler = make_handler()
+        handler.server = srv
+        handler.path = '/max'
+        handler.headers = {'user-agent': 'test'}
+        handler.do_GET()
+        handler.path = '/missing'
+        handler.do_GET()
+        srv.stop_recording()
+        handler.do_GET()
+        actual = [(entry['method'], entry['path'], entry['headers']) for entry in self.entries()]
+        expected = [('GET', '/max', {'user-agent': 'test'}), ('GET', '/missing', {'user-agent': 'test'})]
+        assert actual == expected, 'Expected "%s" recorded, got "%s"' %(expected, actual)
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_request_bodies_are_recorded_as_read_up_to_max_body(self, mode):
+        self.serve(mode)
+        self.srv.register_endpoint('/upload', callback=lambda body: len(body.read()), methods=('POST',))
+        self.srv.start_recording(self.log, max_body=4)
+        self.request('POST /upload HTTP/1.1\r\nContent-Length: 10\r\nConnection: close\r\n\r\n0123456789')
+        self.srv.stop_recording()
+        actual = self.entries()
+        assert len(actual) == 1, 'Expected one recorded request, got "%s"' %(actual)
+        assert actual[0]['body'] == '0123' and actual[0]['body_length'] == 10, \
+                'Expected the first 4 of 10 body bytes, got "%s"' %(actual[0])
+
+    def test_prefork_workers_record_requests(self):
+        srv = self.make_server('prefork')
+        srv.register_endpoint('/max', 55)
+        self.run_server(srv)
+        srv.start_recording(self.log)
+        for i in range(5):
+            self.request('GET /max HTTP/1.1\r\n\r\n')
+        srv.stop_recording()
+        actual = len(self.entries())
+        assert actual == 5, 'Expected 5 requests recorded by prefork workers, got %s' %(actual)
+
+    def test_control_socket_starts_and_stops_recording(self):
+        srv = self.make_server()
+        srv.server_close()
+        actual = srv.control_commands['record']('"%s"' %(self.log))
+        assert actual.startswith('ok recording') and srv.recorder is not None
+        actual = srv.control_commands['record']('')
+        assert actual == 'ok recorded=0 dropped=0', 'Expected recorder counters, got "%s"' %(actual)
+        assert srv.recorder is None
+
+@istest
+class Supervisor():
+
+    def setup(self):
+        import tempfile
+        import threading
+        self.rundir = tempfile.mkdtemp()
+        self.sup = intweb.Supervisor('127.0.0.1', workers=2,
+                                     lockfile=os.path.join(self.rundir, 'webserver.lock'),
+                                     control_socket=os.path.join(self.rundir, 'webserver.sock'))
+        self.first = self.sup.add_server(48009)
+        self.second = self.sup.add_server(48010)
+        self.first.register_endpoint('/max', 55)
+        self.second.register_endpoint('/max', 60)
+        self.thread = threading.Thread(target=self.sup.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        import shutil
+        self.sup.shutdown()
+        self.sup.server_close()
+        self.thread.join()
+        shutil.rmtree(self.rundir)
+
+    def get(self, port, path='/max'):
+        import socket
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall('GET %s HTTP/1.1\r\nConnection: close\r\n\r\n' %(path))
+        return read_until_close(sock)
+
+    def control(self, command):
+        return intweb.control_request(command, self.sup.control_socket)
+
+    def test_hosted_servers_keep_their_own_registry_on_one_loop(self):
+        for port, expected in ((48009, '55'), (48010, '60')):
+            actual = self.get(port)
+            assert actual.startswith('HTTP/1.1 200') and actual.endswith('\r\n\r\n' + expected), \
+                    'Expected "%s" from port %s, got "%s"' %(expected, port, actual)
+        self.first.register_endpoint('/slow', callback=lambda: 'slow')
+        actual = self.get(48009, '/slow')
+        assert actual.endswith('slow'), 'Expected the worker pool to answer, got "%s"' %(actual)
+        actual = [len(self.sup._pool), len(self.first._pool), len(self.second._pool)]
+        assert actual == [2, 0, 0], 'Expected one shared pool of 2 workers, got "%s"' %(actual)
+
+    def test_hosted_servers_do_not_register_signal_handlers(self):
+        actual = self.first._sig_handler.getActions()
+        assert not actual, 'Expected no signal handlers on a hosted server, got "%s"' %(actual)
+
+    def test_add_server_should_raise_ValueError_when_port_is_taken(self):
+        try:
+            self.sup.add_server(48009)
+        except ValueError:
+            return
+        assert False, 'Expected ValueError for a port already hosted'
+
+    def test_servers_are_added_and_removed_while_running(self):
+        import socket
+        self.sup.add_server(48011).register_endpoint('/max', 65)
+        actual = self.get(48011)
+        assert actual.endswith('65'), 'Expected the added server to answer, got "%s"' %(actual)
+        self.sup.remove_server(48010)
+        try:
+            self.get(48010)
+        except socket.error:
+            pass
+        else:
+            assert False, 'Expected the removed server to stop listening'
+        assert sorted(self.sup.servers) == [48009, 48011]
+
+    def test_control_socket_reports_status_and_forwards_commands(self):
+        import json
+        import time
+        self.get(48009)
+        for i in range(50):
+            if self.control('pid') is not None: break
+            time.sleep(0.05)
+        actual = self.control('on 48010 load {"path": "/min", "value": 50}')
+        assert actual == 'ok 1', 'Expected the load to be forwarded, got "%s"' %(actual)
+        status = dict((instance['port'], instance) for instance in json.loads(self.control('status')))
+        assert status[48009]['requests'] == 1 and status[48009]['endpoints'] == 1, \
+                'Expected one request on one endpoint for 48009, got "%s"' %(status)
+        assert status[48010]['endpoints'] == 2, 'Expected the loaded endpoint ' \
+                'on 48010 only, got "%s"' %(status)
+        actual = self.control('on 48012 endpoints')
+        assert actual.startswith('error'), 'Expected an error for an unknown port, got "%s"' %(actual)
+        assert self.control('stop') == 'ok stopping'
+        self.thread.join(5)
+        assert not self.thread.is_alive(), 'Expected stop to end the event loop'
+
+    def test_stop_on_an_instance_removes_only_that_instance(self):
+        import socket
+        self.get(48009)
+        actual = self.control('on 48010 stop')
+        assert actual == 'ok stopped', 'Expected the instance to stop, got "%s"' %(actual)
+        try:
+            self.get(48010)
+        except socket.error:
+            pass
+        else:
+            assert False, 'Expected the stopped instance to stop listening'
+        actual = self.get(48009)
+        assert actual.endswith('55'), 'Expected 48009 to keep serving, got "%s"' %(actual)
+        assert sorted(self.sup.servers) == [48009]
+
+    def test_reload_on_an_instance_reloads_only_its_manifest(self):
+        manifest = os.path.join(self.rundir, 'manifest.json')
+        with open(manifest, 'w') as f:
+            f.write('[{"path": "/min", "value": 50}]')
+        self.get(48009)
+        actual = self.control('on 48010 reload')
+        assert actual.startswith('error'), 'Expected an error without a manifest, got "%s"' %(actual)
+        self.second.manifest = manifest
+        actual = self.control('on 48010 reload')
+        assert actual == 'ok 1', 'Expected the manifest to be reloaded, got "%s"' %(actual)
+        actual = self.get(48010, '/min')
+        assert actual.endswith('50'), 'Expected the reloaded endpoint, got "%s"' %(actual)
+        assert '/min' not in self.first.endpoints(), 'Expected 48009 to be left as it was'
+
+@istest
+class AccessLogging(ServingTest):
+    port = 48012
+
+    def setup(self):
+        ServingTest.setup(self)
+        self.log = os.path.join(self.rundir, 'access.log')
+
+    def entries(self):
+        import json
+        with open(self.log) as log:
+            return [json.loads(line) for line in log]
+
+    @parameterized.expand([(0,), (1.5,), ('all',)])
+    @raises(ValueError)
+    def test_access_log_should_raise_ValueError_for_invalid_sample(self, sample):
+        intweb.AccessLog(self.log, sample)
+
+    def test_access_log_keeps_a_repeatable_sample(self):
+        counts = []
+        for i in range(2):
+            access_log = intweb.AccessLog(self.log, 0.1, seed=7)
+            for j in range(1000):
+                access_log.log(48000, '127.0.0.1', 'GET', '/max', '/max', 200, 2, 0.0)
+            access_log.close()
+            counts.append(access_log.written)
+        assert counts[0] == counts[1], 'Expected the same sample per seed, got "%s"' %(counts)
+        assert 50 < counts[0] < 150, 'Expected about 100 of 1000 logged, got %s' %(counts[0])
+
+    def test_access_log_counts_dropped_entries_when_the_queue_is_full(self):
+        access_log = intweb.AccessLog(self.log)
+        with patch.object(access_log._queue, 'put_nowait', side_effect=intweb.Queue.Full):
+            access_log.log(48000, '127.0.0.1', 'GET', '/max', '/max', 200, 2, 0.0)
+        access_log.close()
+        assert access_log.dropped == 1, 'Expected 1 dropped entry, got %s' %(access_log.dropped)
+        assert self.entries() == []
+
+    @parameterized.expand([('threaded',), ('eventloop',)])
+    def test_responses_are_logged_with_endpoint_status_bytes_and_duration(self, mode):
+        srv = self.make_server(mode)
+        srv.access_log_path = self.log
+        srv.register_endpoint('/items/{id}', 'item')
+        self.run_server(srv)
+        self.request('GET /items/7 HTTP/1.1\r\n\r\nGET /missing HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.srv.shutdown()
+        self.srv.server_close()
+        self.thread.join(5)
+        self.srv = None
+        actual = [(e['method'], e['path'], e['endpoint'], e['status'], e['bytes'], e['port'])
+                  for e in self.entries()]
+        expected = [('GET', '/items/7', '/items/{id}', 200, 4, 48012),
+                    ('GET', '/missing', None, 404, 0, 48012)]
+        assert actual == expected, 'Expected "%s" logged, got "%s"' %(expected, actual)
+        durations = [e['duration_ms'] for e in self.entries()]
+        assert all(d is not None and d >= 0 for d in durations), \
+                'Expected durations for every response, got "%s"' %(durations)
+
+    def test_prefork_workers_write_the_access_log(self):
+        srv = self.make_server('prefork')
+        srv.access_log_path = self.log
+        srv.register_endpoint('/max', 55)
+        self.run_server(srv)
+        for i in range(20):
+            self.request('GET /max HTTP/1.1\r\n\r\n')
+        srv.shutdown()
+        srv.server_close()
+        self.srv = None
+        actual = [(e['path'], e['status']) for e in self.entries()]
+        assert actual == [('/max', 200)] * 20, 'Expected 20 entries from prefork ' \
+                'workers, got "%s"' %(actual)
+
+    def test_nothing_is_logged_per_request_without_an_access_log(self):
+        from StringIO import StringIO
+        srv = intweb.MyHTTPServer()
+        srv.server_close()
+        srv.register_endpoint('/max', 55)
+        handler = make_handler()
+        del handler.log_request
+        handler.server = srv
+        handler.path = '/max'
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            handler.do_GET()
+            actual = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        assert actual == '', 'Expected no per-request output, got "%s"' %(actual)
+
+    def test_control_socket_starts_and_stops_the_access_log(self):
+        srv = self.make_server()
+        srv.server_close()
+        actual = srv.control_commands['access']('{"path": "%s", "sample": 0.5}' %(self.log))
+        assert actual.startswith('ok logging') and srv.access_log.sample == 0.5, \
+                'Expected a sampled access log, got "%s"' %(actual)
+        actual = srv.control_commands['access']('')
+        assert actual == 'ok logged=0 dropped=0', 'Expected log counters, got "%s"' %(actual)
+        assert srv.access_log is None
+
+@istest
+class Scripts():
+
+    def setup(self):
+        self.srv = intweb.MyHTTPServer()
+        self.srv.server_close()
+
+    def serve(self, path, method='GET', headers=None):
+        endpoint, params = self.srv.route(path)
+        request = intweb.Request(method, path, headers or {}, params)
+        rendered = intweb.render_request(endpoint.for_method(method), request)
+        return rendered.code, rendered.body
+
+    def test_sequence_answers_steps_in_order_then_its_final_step(self):
+        self.srv.register_endpoint('/seq', intweb.Sequence([10, 20, 30], then={'status': 404}))
+        actual = [self.serve('/seq') for i in range(5)]
+        expected = [(200, '10'), (200, '20'), (200, '30'), (404, ''), (404, '')]
+        assert actual == expected, 'Expected "%s" not "%s"' %(expected, actual)
+
+    def test_cycle_wraps_around(self):
+        self.srv.register_endpoint('/cycle', intweb.Cycle(['a', {'status': 503, 'value': 'b'}]))
+        actual = [self.serve('/cycle') for i in range(3)]
+        expected = [(200, 'a'), (503, 'b'), (200, 'a')]
+        assert actual == expected, 'Expected "%s" not "%s"' %(expected, actual)
+
+    def test_state_machine_moves_after_requests_and_on_methods(self):
+        states = {'up':   {'value': 'up', 'after': 2, 'next': 'down'},
+                  'down': {'status': 503, 'on': {'POST': 'up'}}}
+        self.srv.register_endpoint('/health', intweb.StateMachine(states, 'up'), methods=('GET', 'POST'))
+        actual = [self.serve('/health') for i in range(3)] + [self.serve('/health', 'POST')]
+        expected = [(200, 'up'), (200, 'up'), (503, ''), (200, 'up')]
+        assert actual == expected, 'Expected "%s" not "%s"' %(expected, actual)
+
+    def test_seeded_scripts_repeat(self):
+        runs = []
+        for i in range(2):
+            self.srv.update_endpoint('/random', intweb.RandomValue(1, 40, seed=3))
+            self.srv.update_endpoint('/choice', intweb.Choice(['a', 'b'], weights=[1, 3], seed=3))
+            runs.append([self.serve('/random') for j in range(10)] + [self.serve('/choice') for j in range(10)])
+        assert runs[0] == runs[1], 'Expected the same answers per seed, got "%s"' %(runs)
+        assert all(1 <= int(body) <= 40 for code, body in runs[0][:10])
+
+    def test_counters_are_shared_across_endpoints_from_a_manifest(self):
+        self.srv.load_endpoints([
+            {'path': '/max', 'value': 55},
+            {'path': '/busy', 'script': {'counter': 'busy', 'random': [1, 40], 'seed': 5}},
+            {'path': '/idle', 'script': {'counter': 'busy', 'offset': 55, 'scale': -1}},
+        ])
+        for i in range(5):
+            busy = int(self.serve('/busy')[1])
+            idle = int(self.serve('/idle')[1])
+            assert busy + idle == 55, 'Expected busy + idle == 55, got %s + %s' %(busy, idle)
+        assert self.srv.counter('busy').value == busy
+
+    def test_counter_adds_on_every_request_under_concurrency(self):
+        import threading
+        self.srv.register_endpoint('/hits', intweb.CounterValue(self.srv.counter('hits'), add=1))
+        threads = [threading.Thread(target=lambda: [self.serve('/hits') for j in range(200)])
+                   for i in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        actual = self.srv.counter('hits').value
+        assert actual == 1600, 'Expected 1600 hits counted, got %s' %(actual)
+
+    @parameterized.expand([
+        ({'sequence': []},),
+        ({'sequence': [1], 'cycle': [2]},),
+        ({'cycle': [{'status': 999}]},),
+        ({'states': {'up': {'next': 'gone'}}, 'start': 'up'},),
+        ({'random': [5, 1]},),
+        ({'counter': 'busy', 'bogus': 1},),
+    ])
+    @raises(ValueError)
+    def test_load_endpoints_should_raise_ValueError_for_invalid_scripts(self, script):
+        self.srv.load_endpoints([{'path': '/script', 'script': script}])
+
+    def test_callbacks_marked_takes_request_get_headers_query_and_params(self):
+        @intweb.takes_request
+        def echo(request):
+            return '%s %s %s %s' %(request.method, request.params['id'], request.query.get('v'),
+                                   request.headers.get('x-name'))
+        self.srv.register_endpoint('/items/{id}', callback=echo, methods=('GET', 'PUT'))
+        actual = self.serve('/items/7?v=2', headers={'x-name': 'abc'})
+        assert actual == (200, 'GET 7 2 abc'), 'Expected the request passed through, got "%s"' %(actual,)
+        actual = self.serve('/items/8', 'PUT')
+        assert actual == (200, 'PUT 8 None None'), 'Expected the request passed through, got "%s"' %(actual,)
+
+@istest
+class ControlCommands():
+
+    def test_control_commands_do_not_import_the_server_stack(self):
+        import subprocess
+        script = 'import sys; import control; print("webserver" in sys.modules)'
+        actual = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=intweb.get_execution_path()).strip()
+        assert actual == 'False', 'Expected control to load without webserver, got "%s"' %(actual)
+
+    def test_load_reads_its_manifest_without_the_server_stack(self):
+        import subprocess
+        import tempfile
+        import shutil
+        rundir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(rundir, 'endpoints.ini')
+            with open(path, 'w') as manifest:
+                manifest.write('[/x]\nvalue = hi\nfaults = {"error_rate": 1.0}\n')
+            script = 'import sys; import json; import control; ' \
+                     'print(json.dumps(list(control.read_manifest(sys.argv[1])), sort_keys=True)); ' \
+                     'print("webserver" in sys.modules)'
+            actual = subprocess.check_output([sys.executable, '-c', script, path],
+                                             cwd=intweb.get_execution_path()).splitlines()
+        finally:
+            shutil.rmtree(rundir)
+        assert actual[-1] == 'False', 'Expected the manifest to be read without webserver'
+        expected = '[{"faults": {"error_rate": 1.0}, "path": "/x", "value": "hi"}]'
+        assert actual[0] == expected, 'Expected "%s" not "%s"' %(expected, actual[0])
+        assert 'load' in intweb.control.COMMANDS and 'load' not in intweb.control.SERVER_ACTIONS
+
+    @parameterized.expand([
+        ('48001', [48001]),
+        ('48001-48003', [48001, 48002, 48003]),
+    ])
+    def test_parse_ports_accepts_a_port_or_a_range(self, value, expected):
+        actual = list(intweb.parse_ports(value))
+        assert actual == expected, 'Expected "%s" not "%s"' %(expected, actual)
+
+    @raises(ValueError)
+    def test_parse_ports_rejects_a_reversed_range(self):
+        intweb.parse_ports('48003-48001')
+
+    def test_wait_ready_returns_once_the_port_accepts_connections(self):
+        import socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        try:
+            assert intweb.wait_ready([sock.getsockname()[1]], '127.0.0.1', timeout=1.0)
+        finally:
+            sock.close()
+
+    def test_wait_ready_gives_up_after_the_timeout(self):
+        import time
+        start = time.time()
+        actual = intweb.wait_ready([48013], '127.0.0.1', timeout=0.2)
+        assert actual is False, 'Expected wait_ready to fail on a closed port'
+        assert time.time() - start < 2.0, 'Expected wait_ready to give up after its timeout'
+
+    @raises(SystemExit)
+    def test_main_exits_after_a_control_command(self):
+        with patch.object(intweb.control, 'status_server', return_value=None):
+            capture_stdout(lambda: intweb.control.main(['integration_webserver.py', 'status']))
+
+    def test_main_returns_for_a_server_action(self):
+        actual = intweb.control.main(['integration_webserver.py', 'start'])
+        assert actual is None, 'Expected start to be left to webserver, got "%s"' %(actual)
+
+@istest
+class Lifecycle(ServingTest):
+    port = 48014
+
+    def make_server(self, mode=None, workers=2):
+        srv = ServingTest.make_server(self, mode, workers)
+        srv.drain_timeout = 5.0
+        return srv
+
+    def get_later(self, path):
+        # Sends a request from another thread, the result lands in a list
+        import threading
+        result = []
+        def get():
+            result.append(self.request('GET %s HTTP/1.1\r\n\r\n' %(path)))
+        thread = threading.Thread(target=get)
+        thread.daemon = True
+        thread.start()
+        return thread, result
+
+    def test_list_endpoints_does_not_reenter_run(self):
+        srv = intweb.MyHTTPServer()
+        srv.running = True
+        with patch.object(srv, 'run') as mock_run:
+            capture_stdout(srv.list_endpoints)
+        srv.server_close()
+        assert mock_run.call_count == 0, 'Expected list_endpoints() to leave ' \
+                'the serve loop alone, run() was called "%s" times' %(mock_run.call_count)
+
+    def test_stop_only_sets_flags_and_never_signals_the_process(self):
+        srv = intweb.MyHTTPServer()
+        with patch.object(intweb.os, 'kill') as mock_kill:
+            srv.stop()
+        srv.server_close()
+        assert mock_kill.call_count == 0, 'Expected stop() not to send a signal'
+        assert srv.draining is True, 'Expected stop() to start draining'
+
+    @parameterized.expand([
+        ('threaded',),
+        ('eventloop',),
+    ])
+    def test_stop_drains_requests_in_flight(self, mode):
+        import time
+        srv = self.serve(mode)
+        srv.register_endpoint('/slow', callback=lambda: time.sleep(0.5) or 'slow')
+        thread, result = self.get_later('/slow')
+        time.sleep(0.2)
+        srv.stop()
+        thread.join(5.0)
+        self.thread.join(5.0)
+        assert result and result[0].startswith('HTTP/1.1 200') and result[0].endswith('slow'), \
+                'Expected the request in flight to be answered, got "%s"' %(result)
+        assert not self.thread.is_alive(), 'Expected run() to return once drained'
+
+    @parameterized.expand([
+        ('threaded',),
+        ('eventloop',),
+    ])
+    def test_idle_keepalive_connections_do_not_hold_up_a_stop(self, mode):
+        import time
+        srv = self.serve(mode)
+        srv.register_endpoint('/max', 55)
+        sock = self.connect('GET /max HTTP/1.1\r\n\r\n')
+        time.sleep(0.1)
+        sock.recv(4096)
+        start = time.time()
+        srv.shutdown()
+        elapsed = time.time() - start
+        sock.settimeout(2.0)
+        actual = sock.recv(4096)
+        sock.close()
+        assert actual == '', 'Expected the idle connection to be closed, got "%s"' %(actual)
+        assert elapsed < 2.0, 'Expected the stop to skip idle connections, took %.2fs' %(elapsed)
+
+    def test_runtime_changes_reach_prefork_workers(self):
+        srv = self.serve('prefork')
+        actual = intweb.control_command('register', {'path': '/new', 'value': 7}, srv.control_socket)
+        assert actual == 'ok 1', 'Expected "ok 1", got "%s"' %(actual)
+        actual = self.request('GET /new HTTP/1.1\r\n\r\n')
+        assert actual.startswith('HTTP/1.1 200') and actual.endswith('\r\n\r\n7'), \
+                'Expected the registered value from a prefork worker, got "%s"' %(actual)
+        intweb.control_command('delete', ['/new'], srv.control_socket)
+        actual = self.request('GET /new HTTP/1.1\r\n\r\n')
+        assert actual.startswith('HTTP/1.1 404'), 'Expected the deleted path to be gone ' \
+                'from the prefork workers, got "%s"' %(actual)
+        assert srv.generation == 2, 'Expected a worker generation per change, got "%s"' %(srv.generation)
+
+    def test_prefork_metrics_total_every_worker_across_generations(self):
+        srv = self.make_server('prefork')
+        srv.register_endpoint('/max', 55)
+        self.run_server(srv)
+        for i in range(5):
+            self.request('GET /max HTTP/1.1\r\n\r\n')
+        self.request('GET /missing HTTP/1.1\r\n\r\n')
+        # a new worker generation, the first one exits with its counters
+        intweb.control_command('register', {'path': '/new', 'value': 7}, srv.control_socket)
+        for i in range(3):
+            self.request('GET /max HTTP/1.1\r\n\r\n')
+        served = self.request('GET %s HTTP/1.1\r\n\r\n' %(intweb.METRICS_PATH))
+        for actual in (intweb.control_command('metrics', control_socket=srv.control_socket), served):
+            for line in ('intweb_requests_total{path="/max"} 8',
+                         'intweb_request_duration_seconds_count{path="/max"} 8',
+                         'intweb_not_found_total 1'):
+                assert line in actual.split('\n'), 'Expected "%s" totalled over ' \
+                        'the prefork workers, got "%s"' %(line, actual)
+
+    def test_reload_reads_the_manifest_and_starts_a_new_worker_generation(self):
+        import json
+        import time
+        import threading
+        import integration_webserver.benchmark as bench
+        manifest = os.path.join(self.rundir, 'endpoints.json')
+        with open(manifest, 'w') as out:
+            json.dump([{'path': '/max', 'value': 55}], out)
+        # a worker to spare, so the clients below keep their connections
+        srv = self.serve('threaded', workers=5)
+        srv.load_manifest(manifest)
+        srv.manifest = manifest
+        with open(manifest, 'w') as out:
+            json.dump([{'path': '/max', 'value': 60}], out)
+        errors = []
+        reloading = threading.Event()
+        reloading.set()
+        def load():
+            while reloading.is_set():
+                errors.append(bench.drive('127.0.0.1', self.port, '/max', 4, 100, True)['errors'])
+        loader = threading.Thread(target=load)
+        loader.start()
+        for i in range(3):
+            srv.reload()
+            deadline = time.time() + 2.0
+            while srv.generation <= i and time.time() < deadline:
+                time.sleep(0.02)
+        reloading.clear()
+        loader.join()
+        assert srv.generation == 3, 'Expected 3 worker generations, got "%s"' %(srv.generation)
+        assert sum(errors) == 0, 'Expected no errors across reloads, got "%s"' %(errors)
+        actual = srv.endpoints()['/max'].value
+        assert actual == 60, 'Expected the reloaded value 60, got "%s"' %(actual)
+
+@istest
+class TLS(ServingTest):
+    port = 48015
+
+    def setup(self):
+        ServingTest.setup(self)
+        self.certfile = os.path.join(self.rundir, 'webserver.crt')
+        self.keyfile = os.path.join(self.rundir, 'webserver.key')
+
+    def make_server(self, mode=None, workers=2):
+        srv = ServingTest.make_server(self, mode, workers)
+        srv.enable_tls(self.certfile, self.keyfile)
+        srv.register_endpoint('/max', 55)
+        return srv
+
+    def fetch(self, request, tls=True):
+        import ssl
+        import socket
+        sock = socket.create_connection(('127.0.0.1', self.port), 5.0)
+        if tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(self.certfile)
+            sock = context.wrap_socket(sock)
+        sock.sendall(request)
+        try:
+            return read_until_close(sock)
+        except socket.error:
+            return ''
+
+    def test_ensure_certificate_generates_once(self):
+        actual = intweb.ensure_certificate(self.certfile, self.keyfile)
+        assert actual is True, 'Expected a certificate to be generated, got "%s"' %(actual)
+        assert os.path.isfile(self.certfile) and os.path.isfile(self.keyfile)
+        actual = intweb.ensure_certificate(self.certfile, self.keyfile)
+        assert actual is False, 'Expected the certificate to be reused, got "%s"' %(actual)
+
+    @parameterized.expand([
+        ('threaded',),
+        ('eventloop',),
+    ])
+    def test_serves_https(self, mode):
+        self.serve(mode)
+        actual = self.fetch('GET /max HTTP/1.1\r\nConnection: close\r\n\r\n')
+        assert actual.startswith('HTTP/1.1 200') and actual.endswith('55'), \
+                'Expected 55 over HTTPS, got "%s"' %(actual)
+
+    @parameterized.expand([
+        ('threaded',),
+        ('eventloop',),
+    ])
+    def test_plain_http_is_a_failed_handshake(self, mode):
+        import time
+        srv = self.serve(mode)
+        actual = self.fetch('GET /max HTTP/1.1\r\n\r\n', tls=False)
+        assert '55' not in actual, 'Expected no answer over plain HTTP, got "%s"' %(actual)
+        deadline = time.time() + 2.0
+        while srv.metrics.handshake_failures < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        actual = srv.metrics.handshake_failures
+        assert actual == 1, 'Expected one failed handshake, not the readiness probe, got "%s"' %(actual)
+
+    def test_enable_tls_checks_the_certificate_once(self):
+        srv = intweb.MyHTTPServer('127.0.0.1', self.port)
+        try:
+            with patch.object(intweb.os.path, 'isfile', wraps=os.path.isfile) as mock_isfile:
+                srv.enable_tls(self.certfile, self.keyfile)
+        finally:
+            srv.server_close()
+        actual = [call for call in mock_isfile.call_args_list if call[0] == (self.certfile,)]
+        assert len(actual) == 1, 'Expected the certificate to be checked once, got "%s"' %(actual)
+
+    @parameterized.expand([
+        ('threaded',),
+        ('eventloop',),
+    ])
+    def test_openssl_client_resumes_its_session(self, mode):
+        import subprocess
+        srv = self.serve(mode)
+        session = os.path.join(self.rundir, 'session.pem')
+        replies = []
+        for option in ('-sess_out', '-sess_in'):
+            process = subprocess.Popen(['openssl', 's_client', '-connect', '127.0.0.1:%s' %(self.port),
+                                        '-CAfile', self.certfile, '-ign_eof', option, session],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            replies.append(process.communicate('GET /max HTTP/1.1\r\nConnection: close\r\n\r\n')[0])
+        assert '\nNew, ' in replies[0] and '\r\n\r\n55' in replies[0], \
+                'Expected a full handshake first, got "%s"' %(replies[0])
+        assert '\nReused, ' in replies[1] and '\r\n\r\n55' in replies[1], \
+                'Expected the second connection to resume the session, got "%s"' %(replies[1])
+        actual = srv.render_metrics()
+        assert 'intweb_tls_resumed_total 1' in actual, 'Expected one resumed handshake in "%s"' %(actual)
+
+    @parameterized.expand([
+        ('threaded',),
+        ('prefork',),
+    ])
+    def test_render_metrics_reports_handshakes(self, mode):
+        srv = self.serve(mode)
+        for i in range(2):
+            self.fetch('GET /max HTTP/1.1\r\nConnection: close\r\n\r\n')
+        actual = srv.render_metrics()
+        for line in ('intweb_tls_handshakes_total 2', 'intweb_tls_handshake_failures_total 0'):
+            assert line in actual, 'Expected "%s" in "%s"' %(line, actual)
+        assert 'intweb_tls_resumed_total' in actual
@@ -0,0 +1,51 @@
+import os
+import time
+import integration_webserver.replay as replay
+import integration_webserver.benchmark as bench
+from nose.tools import istest
+
+def test_prepare_orders_requests_and_drops_connection_headers():
+    entries = [
+        {'time': 12.0, 'method': 'POST', 'path': '/b', 'headers': {'content-length': '2', 'x-id': '2'}, 'body': 'hi'},
+        {'time': 10.0, 'method': 'GET', 'path': '/a', 'headers': {'host': 'x', 'connection': 'close'}, 'body': None},
+    ]
+    actual = replay.prepare(entries)
+    expected = [(0.0, 'GET', '/a', [], None), (2.0, 'POST', '/b', [('x-id', '2')], 'hi')]
+    assert actual == expected, 'Expected "%s" not "%s"' %(expected, actual)
+
+@istest
+class Replay():
+
+    def setup(self):
+        self.srv = bench.start_inprocess(bench.BENCH_HOST, 48102, 'eventloop', 2)
+        self.srv.register_endpoint('/echo', callback=lambda body: body.read(), methods=('POST',))
+
+    def teardown(self):
+        bench.stop_inprocess(self.srv)
+
+    def test_replay_reissues_recorded_requests(self):
+        log = os.path.join(os.path.dirname(self.srv.lockfile), 'requests.jsonl')
+        self.srv.start_recording(log)
+        client = bench.BenchClient(bench.BENCH_HOST, 48102)
+        for path in (bench.ENDPOINTS['static'], bench.ENDPOINTS['notfound']):
+            client.get(path)
+        client.request('POST', '/echo', body='hello')
+        client.close()
+        self.srv.stop_recording()
+        requests = replay.prepare(replay.read_log(log))
+        assert [request[1] for request in requests] == ['GET', 'GET', 'POST']
+        actual = replay.replay(requests, bench.BENCH_HOST, 48102, connections=2, speed=None)
+        assert actual['requests'] == 3 and actual['errors'] == 0, 'Expected 3 ' \
+                'requests without errors, got "%s"' %(actual)
+        assert actual['statuses'] == {'200': 2, '404': 1}, 'Expected the ' \
+                'recorded statuses, got "%s"' %(actual['statuses'])
+
+    def test_replay_keeps_the_original_pacing(self):
+        path = bench.ENDPOINTS['static']
+        requests = [(0.0, 'GET', path, [], None), (0.3, 'GET', path, [], None)]
+        start = time.time()
+        actual = replay.replay(requests, bench.BENCH_HOST, 48102, connections=2, speed=1.0)
+        elapsed = time.time() - start
+        assert actual['requests'] == 2 and elapsed >= 0.3, 'Expected the second ' \
+                'request 0.3s after the first, took %.3fs' %(elapsed)
+        assert actual['max_lag_ms'] is not None
@@ -0,0 +1,3851 @@
+from __future__ import print_function
+import os
+import sys
+import signal
+import errno
+import fcntl
+import select
+import socket
+import ssl
+import subprocess
+import threading
+import traceback
+import gc
+import bisect
+import heapq
+import itertools
+import struct
+import collections
+import json
+import marshal
+import base64
+import mmap
+import mimetypes
+import Queue
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import BaseServer
+from email.utils import formatdate
+from signalhandler.SignalHandler import SignalHandler
+from daemon.daemon import Daemon
+import random
+import time
+from control import get_execution_path, LISTEN, PORT, PIDFILE, STDOUT_LOG, STDERR_LOG, LOCKFILE, \
+        ACCESS_LOG, CONTROL_SOCKET, DRAIN_TIMEOUT, control_request, parse_ports, usage, read_manifest
+
+SERVE_MODES   = ('single', 'threaded', 'prefork', 'eventloop')
+SERVE_MODE    = 'single'
+WORKERS       = 8
+MAX_IN_FLIGHT = 256
+
+KEEPALIVE_TIMEOUT      = 15
+MAX_KEEPALIVE_REQUESTS = 1000
+MAX_REQUEST_HEAD       = 65536
+STREAM_CHUNK           = 65536
+STREAM_WINDOW          = 16 * STREAM_CHUNK
+MAX_CHUNK_LINE         = 4096
+BODY_QUEUE_DEPTH       = 16
+THROTTLE_TICK          = 0.05
+RECORD_QUEUE           = 65536
+MAX_RECORDED_BODY      = 1 << 20
+ACCESS_LOG_QUEUE       = 65536
+LOG_BATCH              = 1024
+
+METHODS      = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE')
+RENDER_METHODS = ('GET', 'HEAD')
+
+TLS_CERT     = get_execution_path() + '/webserver.crt'
+TLS_KEY      = get_execution_path() + '/webserver.key'
+TLS_HOSTNAME = 'localhost'
+
+METRICS_PATH    = '/metrics'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class EndpointMetrics(object):
+    # Counters and a cumulative latency histogram for one endpoint.  A
+    # request costs one lock round trip and a bisect over LATENCY_BUCKETS.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.errors = 0
+        self.faults = 0
+        self.bytes_sent = 0
+        self.duration = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration, nbytes):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        with self._lock:
+            self.hits += 1
+            self.bytes_sent += nbytes
+            self.duration += duration
+            self.buckets[bucket] += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_fault(self):
+        with self._lock:
+            self.faults += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'hits':       self.hits,
+                'errors':     self.errors,
+                'faults':     self.faults,
+                'bytes_sent': self.bytes_sent,
+                'duration':   self.duration,
+                'buckets':    list(self.buckets),
+            }
+
+    def merge(self, delta):
+        # Adds what a prefork worker reported, see metrics_delta().
+        with self._lock:
+            self.hits += delta['hits']
+            self.errors += delta['errors']
+            self.faults += delta['faults']
+            self.bytes_sent += delta['bytes_sent']
+            self.duration += delta['duration']
+            self.buckets = [hits + gained for hits, gained in zip(self.buckets, delta['buckets'])]
+
+METRICS_LOCK = threading.Lock()
+
+class ServerMetrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.not_found = 0
+        self.handshake_failures = 0
+        # what prefork workers reported of their TLS session stats, the
+        # parent's own SSLContext never handshakes
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+
+    def record_not_found(self):
+        with self._lock:
+            self.not_found += 1
+
+    def record_handshake_failure(self):
+        with self._lock:
+            self.handshake_failures += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'not_found':          self.not_found,
+                'handshake_failures': self.handshake_failures,
+                'tls_handshakes':     self.tls_handshakes,
+                'tls_resumed':        self.tls_resumed,
+            }
+
+    def merge(self, delta):
+        with self._lock:
+            self.not_found += delta['not_found']
+            self.handshake_failures += delta['handshake_failures']
+            self.tls_handshakes += delta['tls_handshakes']
+            self.tls_resumed += delta['tls_resumed']
+
+def metrics_delta(current, base):
+    # What the counters of a snapshot() gained since base, None when
+    # nothing did.
+    if current == base:
+        return None
+    delta = {}
+    for key, value in current.items():
+        if isinstance(value, list):
+            delta[key] = [now - then for now, then in zip(value, base[key])]
+        else:
+            delta[key] = value - base[key]
+    return delta
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METHOD_SETS = {}
+
+def method_set(methods):
+    # Endpoints share one frozenset per list of methods instead of building
+    # one each, a manifest mostly repeats the same few.
+    key = tuple(methods)
+    methods = METHOD_SETS.get(key)
+    if methods is None:
+        methods = METHOD_SETS.setdefault(key, frozenset(method.upper() for method in key))
+    return methods
+
+class Endpoint(object):
+    def __init__(self, path, value=None, callback=None, ttl=None, content_type='text/plain',
+                 methods=('GET',), faults=None):
+        self.path = path
+        self.value = value
+        self.callback = callback
+        self.ttl = ttl
+        self.content_type = content_type
+        self.faults = faults
+        self.methods = method_set(methods)
+        if not self.methods.issubset(METHODS):
+            unknown = self.methods.difference(METHODS)
+            raise ValueError('unsupported methods %s for %s, expected some of %s' %(sorted(unknown), path, METHODS))
+        self.siblings = {}
+        self._metrics = None
+        if isinstance(value, Script):
+            value.compile(content_type)
+        self.invalidate()
+
+    def __repr__(self):
+        tostring = 'Class=%s' %(self.__class__.__name__)
+        for key, value in self.__dict__.items():
+            tostring += " %s=%s" %(key, value)
+        return 'Class=%s path=%s value=%s callback=%s' \
+                %(self.__class__.__name__, \
+                  self.path, self.value, self.callback)
+
+    @property
+    def metrics(self):
+        # Allocated on first use, a bulk load does not pay for a lock and a
+        # histogram per endpoint that may never be requested.
+        metrics = self._metrics
+        if metrics is None:
+            with METRICS_LOCK:
+                if self._metrics is None:
+                    self._metrics = EndpointMetrics()
+                metrics = self._metrics
+        return metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._metrics = metrics
+
+    def handles(self, method):
+        return method in self.methods or method in self.siblings
+
+    def for_method(self, method):
+        # The endpoint answering method on this path, HEAD falls back to
+        # whatever answers GET.
+        endpoint = self if method in self.methods else self.siblings.get(method)
+        if endpoint is None and method == 'HEAD':
+            return self.for_method('GET')
+        return endpoint
+
+    def allowed_methods(self):
+        methods = self.methods.union(self.siblings)
+        if 'GET' in methods:
+            methods = methods.union(('HEAD',))
+        return [method for method in METHODS if method in methods]
+
+    def attach(self, endpoint):
+        # Answers endpoint's methods on this path with endpoint.  Siblings
+        # count towards the metrics of the path they were attached to.
+        endpoint.metrics = self.metrics
+        for method in endpoint.methods:
+            self.siblings[method] = endpoint
+
+    def plan_fault(self):
+        if self.faults is None: return None
+        fault = self.faults.plan()
+        if fault is not None:
+            self.metrics.record_fault()
+        return fault
+
+    def source(self):
+        if self.callback is not None:
+            return self.callback
+        return self.value
+
+    def is_static(self):
+        source = self.source()
+        return not callable(source) and not isinstance(source, Script)
+
+    def invalidate(self):
+        self.rendered = None
+        self.expires = None
+
+    def cached(self):
+        rendered = self.rendered
+        if rendered is not None and (self.expires is None or time.time() < self.expires):
+            return rendered
+        return None
+
+    def response(self, headers, request=None):
+        return self.render(request)
+
+    def accept(self, body, request=None):
+        # Methods other than GET and HEAD call the callback with the
+        # RequestBody to read from, static values just answer.
+        source = self.source()
+        if isinstance(source, Script):
+            return source.respond(request)
+        if not callable(source):
+            return self.render()
+        result = callback_body(source, request if getattr(source, 'takes_request', False) else body)
+        if is_stream(result):
+            return StreamedResponse(200, result, self.content_type)
+        return RenderedResponse(200, result, self.content_type)
+
+    def render(self, request=None):
+        # Static values are rendered once and kept for the life of the
+        # endpoint, callbacks are rendered on every call unless they were
+        # registered with a ttl.  A callback returning an iterator is
+        # streamed and never cached.  Scripts answer with their next
+        # precompiled response.
+        rendered = self.cached()
+        if rendered is not None:
+            return rendered
+        source = self.source()
+        if isinstance(source, Script):
+            return source.respond(request)
+        if getattr(source, 'takes_request', False):
+            body = callback_body(source, request)
+        else:
+            body = callback_body(source)
+        if is_stream(body):
+            return StreamedResponse(200, body, self.content_type)
+        rendered = RenderedResponse(200, body, self.content_type)
+        if self.is_static():
+            self.rendered, self.expires = rendered, None
+        elif self.ttl:
+            self.rendered, self.expires = rendered, time.time() + self.ttl
+        return rendered
+
+def nonblocking(callback):
+    # Marks a callback as safe to run on the event loop thread.  Callbacks
+    # without the mark are handed to the worker pool so a slow one can not
+    # stall the loop.
+    callback.nonblocking = True
+    return callback
+
+def takes_request(callback):
+    # Marks a callback to be called with the Request instead of no
+    # arguments (GET and HEAD) or the request body (other methods).
+    callback.takes_request = True
+    return callback
+
+class Request(object):
+    # What a callback marked with @takes_request is called with.  Headers
+    # are looked up by lower-case name, params holds the path and query
+    # captures of the route and query is parsed from the path on first use.
+    __slots__ = ('method', 'path', 'headers', 'params', 'body', '_query')
+
+    def __init__(self, method, path, headers, params=None, body=None):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.params = params if params is not None else {}
+        self.body = body
+        self._query = None
+
+    @property
+    def query(self):
+        if self._query is None:
+            self._query = split_path(self.path)[1]
+        return self._query
+
+def is_stream(value):
+    return hasattr(value, '__iter__') and (hasattr(value, 'next') or hasattr(value, '__next__'))
+
+def callback_body(callback, *args):
+    if callback is None:
+        return '20'
+    elif callable(callback):
+        body = callback(*args)
+        return body if is_stream(body) else str(body)
+    return str(callback)
+
+def merge_endpoint(existing, endpoint):
+    # Returns what should sit in the route table once endpoint is
+    # registered on a path existing already holds.  New methods are
+    # attached to the existing endpoint, methods it already answers are
+    # taken over by endpoint.
+    if existing is None:
+        return endpoint
+    if existing.methods.isdisjoint(endpoint.methods):
+        existing.attach(endpoint)
+        return existing
+    for method in existing.methods.difference(endpoint.methods):
+        endpoint.siblings[method] = existing
+    for method, sibling in existing.siblings.items():
+        if method not in endpoint.methods:
+            endpoint.siblings[method] = sibling
+    for sibling in endpoint.siblings.values():
+        sibling.metrics = endpoint.metrics
+    return endpoint
+
+def render_request(endpoint, request):
+    # GET and HEAD render the endpoint, every other method hands it the
+    # request body.  Whatever the callback leaves unread is drained so the
+    # next request on the connection lines up.
+    body = request.body
+    try:
+        if request.method in RENDER_METHODS:
+            rendered = endpoint.response(request.headers, request)
+        else:
+            if body is None:
+                request.body = RequestBody(None)
+            rendered = endpoint.accept(request.body, request)
+        if body is not None:
+            body.drain()
+    finally:
+        if body is not None:
+            body.finish_recording()
+    return rendered
+
+def request_framing(headers):
+    # Returns (length, chunked) for the body announced by the request
+    # headers, raises ValueError on a bad Content-Length.
+    if 'chunked' in (headers.get('transfer-encoding') or '').lower():
+        return 0, True
+    length = headers.get('content-length')
+    if not length:
+        return 0, False
+    length = int(length)
+    if length < 0:
+        raise ValueError('negative Content-Length %s' %(length))
+    return length, False
+
+def parse_chunk_size(line):
+    try:
+        size = int(line.split(';', 1)[0].strip(), 16)
+    except ValueError:
+        raise ValueError('malformed chunk size line %r' %(line))
+    if size < 0:
+        raise ValueError('malformed chunk size line %r' %(line))
+    return size
+
+class BodyReader(object):
+    recorder = None
+
+    def record(self, recorder, request):
+        # Keeps the first recorder.max_body bytes of what is read for the
+        # request log.
+        self.recorder = recorder
+        self.request = request
+        self.recorded = []
+        self.recorded_bytes = 0
+        self.recorded_length = 0
+
+    def finish_recording(self):
+        if self.recorder is None: return
+        recorder, self.recorder = self.recorder, None
+        recorder.record(self.request, (''.join(self.recorded), self.recorded_length))
+
+    def read(self, size=STREAM_CHUNK):
+        data = self.read_piece(size)
+        if self.recorder is not None and data:
+            self.recorded_length += len(data)
+            if self.recorded_bytes < self.recorder.max_body:
+                kept = data[:self.recorder.max_body - self.recorded_bytes]
+                self.recorded.append(kept)
+                self.recorded_bytes += len(kept)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read()
+            if not data: return
+            yield data
+
+    def drain(self):
+        for data in self:
+            pass
+
+class RequestBody(BodyReader):
+    # A request body read off the connection as the callback asks for it,
+    # by Content-Length or chunked transfer coding, so an upload never sits
+    # in memory as a whole.  read() returns at most size bytes and '' once
+    # the body is exhausted, iterating yields STREAM_CHUNK sized pieces.
+    def __init__(self, rfile, length=0, chunked=False):
+        self.rfile = rfile
+        self.chunked = chunked
+        self.remaining = 0 if chunked else length
+        self.done = not chunked and length <= 0
+        self.bytes_read = 0
+
+    def read_piece(self, size):
+        while not self.done:
+            if self.chunked and self.remaining == 0:
+                self.next_chunk()
+                continue
+            data = self.rfile.read(min(size, self.remaining))
+            if not data:
+                raise IOError('connection closed with %d bytes of the request body unread' %(self.remaining))
+            self.remaining -= len(data)
+            self.bytes_read += len(data)
+            if self.remaining == 0:
+                if self.chunked:
+                    self.rfile.readline(MAX_CHUNK_LINE)
+                else:
+                    self.done = True
+            return data
+        return ''
+
+    def next_chunk(self):
+        line = self.rfile.readline(MAX_CHUNK_LINE)
+        if not line.endswith('\n'):
+            raise IOError('truncated chunk size line %r' %(line))
+        self.remaining = parse_chunk_size(line)
+        if self.remaining == 0:
+            while self.rfile.readline(MAX_CHUNK_LINE).strip():
+                pass
+            self.done = True
+
+class BodyDecoder(object):
+    # Incremental Content-Length/chunked decoding for the event loop, which
+    # only ever has whatever bytes the last recv() brought.
+    def __init__(self, length=0, chunked=False):
+        self.chunked = chunked
+        self.remaining = length
+        if chunked:
+            self.state = 'size'
+        else:
+            self.state = 'data' if length > 0 else 'done'
+
+    @property
+    def done(self):
+        return self.state == 'done'
+
+    def feed(self, data):
+        # Returns the decoded pieces and the bytes past the end of the body.
+        pieces = []
+        while data and self.state != 'done':
+            if self.state == 'data':
+                piece = data[:self.remaining]
+                data = data[len(piece):]
+                self.remaining -= len(piece)
+                pieces.append(piece)
+                if self.remaining == 0:
+                    self.state = 'crlf' if self.chunked else 'done'
+                continue
+            line, sep, rest = data.partition('\r\n')
+            if not sep:
+                if len(data) > MAX_CHUNK_LINE:
+                    raise ValueError('chunk framing line longer than %s bytes' %(MAX_CHUNK_LINE))
+                break
+            data = rest
+            if self.state == 'size':
+                self.remaining = parse_chunk_size(line)
+                self.state = 'data' if self.remaining else 'trailer'
+            elif self.state == 'crlf':
+                self.state = 'size'
+            elif not line:
+                self.state = 'done'
+        return pieces, data
+
+class QueuedBody(BodyReader):
+    # The worker side of a request body arriving on the event loop.  The
+    # loop decodes pieces off the socket and puts them here while the
+    # callback reads them on a worker thread; once BODY_QUEUE_DEPTH pieces
+    # are waiting the loop stops reading the socket until the reader has
+    # caught up, so a slow callback never makes an upload pile up.
+    def __init__(self, decoder, resume):
+        self.decoder = decoder
+        self.resume = resume
+        self.pieces = Queue.Queue()
+        self.buffer = ''
+        self.done = False
+        self.paused = False
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def put(self, piece):
+        self.pieces.put(piece)
+
+    def finish(self):
+        self.pieces.put(None)
+
+    def abort(self, error):
+        self.pieces.put(error)
+
+    def pause_if_full(self):
+        with self._lock:
+            self.paused = self.pieces.qsize() >= BODY_QUEUE_DEPTH
+            return self.paused
+
+    def read_piece(self, size):
+        while not self.buffer and not self.done:
+            piece = self.pieces.get()
+            with self._lock:
+                if self.paused and self.pieces.qsize() <= BODY_QUEUE_DEPTH // 2:
+                    self.paused = False
+                    self.resume()
+            if piece is None:
+                self.done = True
+            elif isinstance(piece, Exception):
+                self.done = True
+                raise piece
+            else:
+                self.buffer = piece
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+# What a FaultProfile decided for one request: seconds to hold the
+# response, an error status to answer instead, whether to reset the
+# connection, the fraction of the response to write before closing and a
+# bytes/sec limit for writing it.
+Fault = collections.namedtuple('Fault', 'delay status reset partial bandwidth')
+
+LATENCY_DISTRIBUTIONS = {
+    'fixed':       (1, lambda rng, seconds: seconds),
+    'uniform':     (2, lambda rng, low, high: rng.uniform(low, high)),
+    'normal':      (2, lambda rng, mean, stddev: rng.gauss(mean, stddev)),
+    'lognormal':   (2, lambda rng, mu, sigma: rng.lognormvariate(mu, sigma)),
+    'exponential': (1, lambda rng, mean: rng.expovariate(1.0 / mean)),
+}
+
+def latency_sampler(latency):
+    # latency is a number of seconds or a (distribution, args...) sequence
+    # such as ('uniform', 0.1, 0.5), see LATENCY_DISTRIBUTIONS.
+    if isinstance(latency, (int, long, float)) and not isinstance(latency, bool):
+        latency = ('fixed', latency)
+    if not isinstance(latency, (list, tuple)) or not latency or latency[0] not in LATENCY_DISTRIBUTIONS:
+        raise ValueError('latency must be seconds or one of %s with its arguments, not %s' \
+                %(sorted(LATENCY_DISTRIBUTIONS), latency))
+    nargs, sample = LATENCY_DISTRIBUTIONS[latency[0]]
+    args = latency[1:]
+    if len(args) != nargs or not all(isinstance(arg, (int, long, float)) for arg in args):
+        raise ValueError('%s latency takes %d numbers, not %s' %(latency[0], nargs, list(args)))
+    if latency[0] == 'exponential' and args[0] <= 0:
+        raise ValueError('exponential latency needs a positive mean, not %s' %(args[0]))
+    return lambda rng: sample(rng, *args)
+
+class FaultProfile(object):
+    # Declarative misbehaviour for an endpoint.  Every request draws its
+    # Fault from the profile's own seeded generator, so a run can be
+    # repeated.  The event loop holds, throttles and cuts responses with
+    # timers; blocking modes have to hold the thread that serves them.
+    def __init__(self, latency=None, bandwidth=None, error_rate=0.0, error_status=500,
+                 reset_rate=0.0, partial_rate=0.0, seed=None):
+        for name, rate in (('error_rate', error_rate), ('reset_rate', reset_rate),
+                           ('partial_rate', partial_rate)):
+            if not isinstance(rate, (int, long, float)) or not 0.0 <= rate <= 1.0:
+                raise ValueError('%s must be between 0 and 1, not %s' %(name, rate))
+        if bandwidth is not None and (not isinstance(bandwidth, (int, long, float)) or bandwidth <= 0):
+            raise ValueError('bandwidth must be a positive number of bytes/sec, not %s' %(bandwidth))
+        if error_status not in MyHandler.responses:
+            raise ValueError('error_status must be an HTTP status, not %s' %(error_status))
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reset_rate = reset_rate
+        self.partial_rate = partial_rate
+        self.seed = seed
+        self._sample = latency_sampler(latency) if latency is not None else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Class=%s latency=%s bandwidth=%s error_rate=%s reset_rate=%s partial_rate=%s' \
+                %(self.__class__.__name__, self.latency, self.bandwidth,
+                  self.error_rate, self.reset_rate, self.partial_rate)
+
+    def plan(self):
+        # Returns None when the request is to be served untouched.
+        with self._lock:
+            rng = self._random
+            delay = max(0.0, self._sample(rng)) if self._sample is not None else 0.0
+            status = self.error_status if rng.random() < self.error_rate else None
+            reset = status is None and rng.random() < self.reset_rate
+            partial = None
+            if status is None and not reset and rng.random() < self.partial_rate:
+                partial = rng.random()
+        if not delay and status is None and not reset and partial is None and self.bandwidth is None:
+            return None
+        return Fault(delay, status, reset, partial, self.bandwidth)
+
+FAULT_SPEC_KEYS = frozenset(('latency', 'bandwidth', 'error_rate', 'error_status',
+                             'reset_rate', 'partial_rate', 'seed'))
+
+def faults_from_spec(spec):
+    if spec is None or isinstance(spec, FaultProfile):
+        return spec
+    if not isinstance(spec, dict):
+        raise ValueError('faults must be a dict, not %s=%s' %(type(spec), spec))
+    unknown = [key for key in spec if key not in FAULT_SPEC_KEYS]
+    if unknown:
+        raise ValueError('unknown fault keys %s in %s' %(sorted(unknown), spec))
+    spec = dict((str(key), value) for key, value in spec.items())
+    if isinstance(spec.get('latency'), list) and spec['latency']:
+        spec['latency'] = [to_str(spec['latency'][0])] + spec['latency'][1:]
+    try:
+        return FaultProfile(**spec)
+    except TypeError as e:
+        raise ValueError('invalid faults %s: %s' %(spec, e))
+
+def reset_socket(sock):
+    # Closing with a zero linger sends RST instead of FIN.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+
+def has_input(sock):
+    # True when a request (or EOF) is waiting to be read.  poll() has no
+    # limit on the descriptor number, unlike select().
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLIN)
+    return bool(poller.poll(0))
+
+def cut_response(response, fraction):
+    # The whole head of a response and the first fraction of its body, or
+    # of the first STREAM_CHUNK bytes of a streamed body.  Every response
+    # carries its complete head in its first piece.
+    if isinstance(response, str):
+        head = response.find('\r\n\r\n') + 4
+        return response[:head + int(fraction * (len(response) - head))]
+    return cut_chunks(response, int(fraction * STREAM_CHUNK))
+
+def cut_chunks(chunks, limit):
+    chunks = iter(chunks)
+    yield next(chunks)
+    for chunk in chunks:
+        if limit <= 0: return
+        yield chunk[:limit]
+        limit -= len(chunk)
+
+class ThrottledWriter(object):
+    # Stands in for a handler's wfile to write at most rate bytes/sec and,
+    # given a fraction, to cut the body the way cut_response does.  Used by
+    # the blocking modes only.
+    def __init__(self, wfile, rate=None, fraction=None, length=None):
+        self.wfile = wfile
+        self.rate = rate
+        self.fraction = fraction
+        self.length = length
+        self.budget = None
+        self.written = 0
+
+    def write(self, data):
+        if self.fraction is not None:
+            if self.budget is None:
+                head = data.find('\r\n\r\n') + 4
+                size = self.length if self.length is not None else STREAM_CHUNK
+                self.budget = int(self.fraction * size)
+                data = data[:head + self.budget]
+                self.budget -= len(data) - head
+            else:
+                data = data[:max(0, self.budget)]
+                self.budget -= len(data)
+        self.written += len(data)
+        if not self.rate:
+            self.wfile.write(data)
+            return
+        quantum = max(1, int(self.rate * THROTTLE_TICK))
+        for offset in range(0, len(data), quantum):
+            piece = data[offset:offset + quantum]
+            self.wfile.write(piece)
+            self.wfile.flush()
+            time.sleep(len(piece) / float(self.rate))
+
+    def flush(self):
+        self.wfile.flush()
+
+class BackgroundLog(object):
+    # Appends entries to a log file from a background thread.  Serving
+    # threads only put an entry on a bounded queue, encoding and buffered
+    # writes happen on the writer thread.  When the writer falls behind
+    # entries are left out of the log and counted as dropped instead of
+    # slowing the server down.  Entries are written in batches of whole
+    # lines, one write each, so prefork workers appending to the same log
+    # never split each other's lines.
+    def __init__(self, path, queue_size, name):
+        self.path = path
+        self.written = 0
+        self.dropped = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(queue_size)
+        self._log = open(path, 'ab', 0)
+        self._thread = threading.Thread(target=self.write_entries, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, entry):
+        if self._closed: return
+        try:
+            self._queue.put_nowait(entry)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def encode(self, entry):
+        raise NotImplementedError
+
+    def write_entries(self):
+        batch = []
+        while True:
+            entry = self._queue.get()
+            if entry is None: break
+            try:
+                batch.append(self.encode(entry))
+                self.written += 1
+            except Exception:
+                traceback.print_exc()
+            if len(batch) >= LOG_BATCH or self._queue.empty():
+                self._log.write(''.join(batch))
+                batch = []
+        self._log.write(''.join(batch))
+
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._log.close()
+
+class Recorder(BackgroundLog):
+    # Appends every request a server sees to a JSON lines log that
+    # replay.py can re-issue.
+    def __init__(self, path, max_body=MAX_RECORDED_BODY, queue_size=RECORD_QUEUE):
+        BackgroundLog.__init__(self, path, queue_size, 'recorder')
+        self.max_body = max_body
+
+    @property
+    def recorded(self):
+        return self.written
+
+    def record(self, request, body=None):
+        # request is (time, method, path, version, headers), body the
+        # (kept bytes, full length) of what the callback read.
+        self.put((request, body))
+
+    def encode(self, entry):
+        return encode_record(*entry)
+
+class AccessLog(BackgroundLog):
+    # One JSON line per response: port, client, method, path, the endpoint
+    # it matched, status, body bytes and the time taken to render and
+    # queue it.  With a sample below 1.0 only that fraction of responses
+    # is logged, the decision is made before anything is queued.
+    def __init__(self, path, sample=1.0, queue_size=ACCESS_LOG_QUEUE, seed=None):
+        check_sample(sample)
+        BackgroundLog.__init__(self, path, queue_size, 'access-log')
+        self.sample = sample
+        self._random = random.Random(seed)
+
+    def log(self, port, client, method, path, endpoint, status, nbytes, start=None):
+        if self.sample < 1.0 and self._random.random() >= self.sample: return
+        self.put((time.time(), port, client, method, path, endpoint, status, nbytes, start))
+
+    def encode(self, entry):
+        return encode_access(*entry)
+
+def check_sample(sample):
+    if isinstance(sample, bool) or not isinstance(sample, (int, float)) or not 0.0 < sample <= 1.0:
+        raise ValueError('sample must be a fraction in (0, 1], not %s=%s' %(type(sample), sample))
+
+def encode_access(now, port, client, method, path, endpoint, status, nbytes, start=None):
+    entry = {'time': start or now, 'port': port, 'client': client, 'method': method,
+             'path': path, 'endpoint': endpoint, 'status': status, 'bytes': nbytes,
+             'duration_ms': round((now - start) * 1000.0, 3) if start else None}
+    return json.dumps(entry, sort_keys=True, encoding='latin-1') + '\n'
+
+def encode_record(request, body=None):
+    # Paths and headers are bytes of unknown encoding, latin-1 maps every
+    # byte to a code point and back.  Bodies are base64 encoded, a body
+    # longer than max_body also records its full length.
+    start, method, path, version, headers = request
+    entry = {'time': start, 'method': method, 'path': path, 'version': version,
+             'headers': headers}
+    if body is not None:
+        data, length = body
+        entry['body'] = base64.b64encode(data)
+        if length > len(data):
+            entry['body_length'] = length
+    return json.dumps(entry, sort_keys=True, encoding='latin-1') + '\n'
+
+def decode_record(line):
+    entry = json.loads(line)
+    decode = lambda value: value.encode('latin-1')
+    entry['method'] = decode(entry['method'])
+    entry['path'] = decode(entry['path'])
+    entry['version'] = decode(entry.get('version', 'HTTP/1.1'))
+    entry['headers'] = dict((decode(key), decode(value)) for key, value in entry.get('headers', {}).items())
+    entry['body'] = base64.b64decode(entry['body']) if entry.get('body') is not None else None
+    return entry
+
+def script_step(step):
+    # A step is a value answered with a 200 or {"status": ..., "value": ...}.
+    # Returns (status, body).
+    if not isinstance(step, dict):
+        return 200, str(to_str(step))
+    unknown = set(step).difference(('status', 'value'))
+    if unknown:
+        raise ValueError('unknown script step keys %s in %s' %(sorted(unknown), step))
+    status = step.get('status', 200)
+    if isinstance(status, bool) or not isinstance(status, int) or not 100 <= status <= 599:
+        raise ValueError('script step status must be an HTTP status, not %s=%s' %(type(status), status))
+    return status, str(to_str(step.get('value', '')))
+
+def script_steps(steps):
+    if not isinstance(steps, (list, tuple)) or not steps:
+        raise ValueError('script steps must be a non-empty list, not %s=%s' %(type(steps), steps))
+    return [script_step(step) for step in steps]
+
+class Script(object):
+    # Scripted behaviour registered as an endpoint value.  Steps are
+    # validated when the script is built and rendered once when it is
+    # registered, with the content type of its endpoint, so a request only
+    # advances a cursor under the script's own lock.  Scripts never block
+    # and are answered on the event loop thread.
+    nonblocking = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.content_type = 'text/plain'
+
+    def compile(self, content_type):
+        self.content_type = content_type
+
+    def render_step(self, step):
+        return RenderedResponse(step[0], step[1], self.content_type)
+
+    def respond(self, request=None):
+        raise NotImplementedError
+
+class Sequence(Script):
+    # Answers steps in order, then `then` (default: the last step) forever.
+    def __init__(self, steps, then=None):
+        Script.__init__(self)
+        self.steps = script_steps(steps)
+        self.then = script_step(then) if then is not None else self.steps[-1]
+        self._next = 0
+
+    def compile(self, content_type):
+        Script.compile(self, content_type)
+        self._responses = [self.render_step(step) for step in self.steps] + [self.render_step(self.then)]
+
+    def respond(self, request=None):
+        with self._lock:
+            i = self._next
+            if i < len(self.steps):
+                self._next = i + 1
+        return self._responses[i]
+
+class Cycle(Script):
+    # Answers steps in order, round and round.
+    def __init__(self, steps):
+        Script.__init__(self)
+        self.steps = script_steps(steps)
+        self._next = 0
+
+    def compile(self, content_type):
+        Script.compile(self, content_type)
+        self._responses = [self.render_step(step) for step in self.steps]
+
+    def respond(self, request=None):
+        with self._lock:
+            i = self._next
+            self._next = (i + 1) % len(self._responses)
+        return self._responses[i]
+
+class StateMachine(Script):
+    # states maps a name to a step plus its transitions:
+    #   {"value": ..., "status": ..., "after": 3, "next": "down", "on": {"POST": "up"}}
+    # A request whose method is in `on` moves to that state first and is
+    # answered by it, after `after` requests in a state it moves to `next`.
+    STATE_KEYS = frozenset(('status', 'value', 'after', 'next', 'on'))
+
+    def __init__(self, states, start):
+        Script.__init__(self)
+        if not isinstance(states, dict) or not states:
+            raise ValueError('states must be a non-empty dict, not %s=%s' %(type(states), states))
+        self.states = {}
+        for name, state in states.items():
+            if not isinstance(state, dict):
+                raise ValueError('state %s must be a dict, not %s=%s' %(name, type(state), state))
+            unknown = set(state).difference(self.STATE_KEYS)
+            if unknown:
+                raise ValueError('unknown keys %s in state %s' %(sorted(unknown), name))
+            after = state.get('after')
+            if after is not None and (isinstance(after, bool) or not isinstance(after, int) or after < 1):
+                raise ValueError('after in state %s must be a positive integer, not %s' %(name, after))
+            on = dict((to_str(method).upper(), to_str(target))
+                      for method, target in (state.get('on') or {}).items())
+            target = to_str(state.get('next'))
+            step = script_step(dict((key, state[key]) for key in ('status', 'value') if key in state))
+            self.states[to_str(name)] = (step, after if target is not None else None, target, on)
+        start = to_str(start)
+        for name, (step, after, target, on) in self.states.items():
+            for other in [target] + on.values():
+                if other is not None and other not in self.states:
+                    raise ValueError('state %s moves to unknown state %s' %(name, other))
+        if start not in self.states:
+            raise ValueError('start state %s is not one of %s' %(start, sorted(self.states)))
+        self.start = self.state = start
+        self._count = 0
+
+    def compile(self, content_type):
+        Script.compile(self, content_type)
+        self._responses = dict((name, self.render_step(state[0])) for name, state in self.states.items())
+
+    def respond(self, request=None):
+        with self._lock:
+            step, after, target, on = self.states[self.state]
+            if request is not None and request.method in on:
+                self.state, self._count = on[request.method], 0
+                step, after, target, on = self.states[self.state]
+            response = self._responses[self.state]
+            self._count += 1
+            if after is not None and self._count >= after:
+                self.state, self._count = target, 0
+        return response
+
+def random_bounds(low, high):
+    if not all(isinstance(bound, int) and not isinstance(bound, bool) for bound in (low, high)) or low > high:
+        raise ValueError('random takes integer bounds low <= high, not %s, %s' %(low, high))
+    return low, high
+
+class RandomValue(Script):
+    # A random integer in [low, high], repeatable with a seed.
+    def __init__(self, low, high, seed=None):
+        Script.__init__(self)
+        self.low, self.high = random_bounds(low, high)
+        self._random = random.Random(seed)
+
+    def respond(self, request=None):
+        with self._lock:
+            value = self._random.randint(self.low, self.high)
+        return RenderedResponse(200, str(value), self.content_type)
+
+class Choice(Script):
+    # One of steps at random, in proportion to weights, repeatable with a
+    # seed.
+    def __init__(self, steps, weights=None, seed=None):
+        Script.__init__(self)
+        self.steps = script_steps(steps)
+        weights = weights if weights is not None else [1] * len(self.steps)
+        if not isinstance(weights, (list, tuple)) or len(weights) != len(self.steps) or \
+                not all(isinstance(w, (int, float)) and w >= 0 for w in weights) or not sum(weights):
+            raise ValueError('weights must be one non-negative number per step, not %s' %(weights,))
+        total, running, self._bounds = float(sum(weights)), 0, []
+        for weight in weights:
+            running += weight
+            self._bounds.append(running / total)
+        self._random = random.Random(seed)
+
+    def compile(self, content_type):
+        Script.compile(self, content_type)
+        self._responses = [self.render_step(step) for step in self.steps]
+
+    def respond(self, request=None):
+        with self._lock:
+            r = self._random.random()
+        return self._responses[min(bisect.bisect_right(self._bounds, r), len(self._responses) - 1)]
+
+class Counter(object):
+    # A number shared by the scripts of several endpoints, for example the
+    # busy connections that NumBusyConnections reports and
+    # NumIdleConnections subtracts from the pool size.
+    def __init__(self, value=0):
+        self._lock = threading.Lock()
+        self.value = value
+
+    def add(self, amount):
+        with self._lock:
+            self.value += amount
+            return self.value
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+            return value
+
+class CounterValue(Script):
+    # Answers offset + scale * counter.  Every request first adds `add` to
+    # the counter, or with `between` sets it to a random integer in
+    # [low, high].  Without either the counter is only read.
+    def __init__(self, counter, add=0, between=None, seed=None, offset=0, scale=1):
+        Script.__init__(self)
+        if not isinstance(counter, Counter):
+            raise ValueError('counter must be a Counter, not %s=%s' %(type(counter), counter))
+        if not all(isinstance(n, (int, float)) and not isinstance(n, bool) for n in (add, offset, scale)):
+            raise ValueError('add, offset and scale must be numbers, not %s, %s, %s' %(add, offset, scale))
+        if between is not None and (not isinstance(between, (list, tuple)) or len(between) != 2):
+            raise ValueError('random takes [low, high], not %s' %(between,))
+        self.counter = counter
+        self.add = add
+        self.offset = offset
+        self.scale = scale
+        self.between = random_bounds(*between) if between is not None else None
+        self._random = random.Random(seed)
+
+    def respond(self, request=None):
+        if self.between is not None:
+            with self._lock:
+                value = self._random.randint(*self.between)
+            value = self.counter.set(value)
+        elif self.add:
+            value = self.counter.add(self.add)
+        else:
+            value = self.counter.value
+        return RenderedResponse(200, str(self.offset + self.scale * value), self.content_type)
+
+SCRIPT_KINDS = ('sequence', 'cycle', 'states', 'random', 'choice', 'counter')
+
+def script_from_spec(spec, counters):
+    # The "script" of an endpoint spec, one of
+    #   {"sequence": [10, 20, 30], "then": {"status": 404}}
+    #   {"cycle": [10, 20, 30]}
+    #   {"states": {"up": {...}, "down": {...}}, "start": "up"}
+    #   {"random": [1, 40], "seed": 42}
+    #   {"choice": ["ok", {"status": 503}], "weights": [9, 1], "seed": 42}
+    #   {"counter": "busy", "random": [1, 40], "seed": 42} or
+    #   {"counter": "busy", "offset": 55, "scale": -1} or {"counter": "hits", "add": 1}
+    # Counters are looked up by name in counters and created on first use.
+    if not isinstance(spec, dict):
+        raise ValueError('script must be a dict, not %s=%s' %(type(spec), spec))
+    # a counter script takes "random" as an option
+    kinds = ['counter'] if 'counter' in spec else [kind for kind in SCRIPT_KINDS if kind in spec]
+    if len(kinds) != 1:
+        raise ValueError('script must set exactly one of %s, got %s' %(SCRIPT_KINDS, spec))
+    kind = kinds[0]
+    options = dict((to_str(key), value) for key, value in spec.items() if key != kind)
+    try:
+        if kind == 'sequence':
+            return Sequence(spec[kind], **options)
+        elif kind == 'cycle':
+            return Cycle(spec[kind], **options)
+        elif kind == 'states':
+            return StateMachine(spec[kind], **options)
+        elif kind == 'random':
+            bounds = spec[kind]
+            if not isinstance(bounds, list) or len(bounds) != 2:
+                raise ValueError('random takes [low, high], not %s' %(bounds,))
+            return RandomValue(bounds[0], bounds[1], **options)
+        elif kind == 'choice':
+            return Choice(spec[kind], **options)
+        name = spec[kind]
+        if not isinstance(name, basestring) or not name:
+            raise ValueError('counter must be a name, not %s=%s' %(type(name), name))
+        if 'random' in options:
+            options['between'] = options.pop('random')
+        counter = counters.setdefault(to_str(name), Counter())
+        return CounterValue(counter, **options)
+    except TypeError as e:
+        raise ValueError('invalid %s script %s: %s' %(kind, spec, e))
+
+CALLBACKS = {}
+
+def named_callback(callback):
+    # Makes a callback addressable by name from endpoint specs sent to the
+    # control socket or loaded from a manifest.
+    CALLBACKS[callback.__name__] = callback
+    return callback
+
+ENDPOINT_SPEC_KEYS = frozenset(('path', 'value', 'callback', 'file', 'script', 'ttl', 'content_type',
+                                'methods', 'faults'))
+ENDPOINT_SOURCE_KEYS = ('value', 'callback', 'file', 'script')
+ENDPOINT_SOURCES = frozenset(ENDPOINT_SOURCE_KEYS)
+
+def endpoint_from_spec(spec, callbacks=CALLBACKS, counters=None):
+    if not isinstance(spec, dict):
+        raise ValueError('endpoint spec must be a dict, not %s=%s' %(type(spec), spec))
+    if not ENDPOINT_SPEC_KEYS.issuperset(spec):
+        unknown = [key for key in spec if key not in ENDPOINT_SPEC_KEYS]
+        raise ValueError('unknown endpoint spec keys %s in %s' %(sorted(unknown), spec))
+    # manifests hold tens of thousands of specs, most of them a path and a
+    # value, so optional keys are only validated when they are present
+    get = spec.get
+    path = get('path')
+    if not path or not isinstance(path, basestring):
+        raise ValueError('endpoint spec requires a path string, got %s' %(spec))
+    if len(ENDPOINT_SOURCES.intersection(spec)) > 1:
+        sources = [key for key in ENDPOINT_SOURCE_KEYS if get(key) is not None]
+        if len(sources) > 1:
+            raise ValueError('endpoint spec for %s sets more than one of %s' %(path, sources))
+    value = get('value')
+    callback = get('callback')
+    if callback is not None:
+        if callback not in callbacks:
+            raise ValueError('unknown callback %s for %s' %(callback, path))
+        callback = callbacks[callback]
+    ttl = get('ttl')
+    if ttl is not None and (isinstance(ttl, bool) or not isinstance(ttl, (int, long, float))):
+        raise ValueError('ttl for %s must be a number, not %s=%s' %(path, type(ttl), ttl))
+    if 'methods' in spec:
+        methods = spec['methods']
+        if isinstance(methods, basestring):
+            methods = methods.replace(',', ' ').split()
+        if not isinstance(methods, list) or not methods or \
+                not all(isinstance(method, basestring) for method in methods):
+            raise ValueError('methods for %s must be a list of methods, not %s=%s' %(path, type(methods), methods))
+        methods = [to_str(method) for method in methods]
+    else:
+        methods = ('GET',)
+    faults = faults_from_spec(get('faults'))
+    if get('file') is not None:
+        endpoint = FileEndpoint(to_str(path), to_str(spec['file']), to_str(get('content_type')), methods)
+        endpoint.faults = faults
+        return endpoint
+    if get('script') is not None:
+        value = script_from_spec(spec['script'], counters if counters is not None else {})
+    return Endpoint(to_str(path), to_str(value), callback, ttl,
+                    to_str(get('content_type', 'text/plain')), methods, faults)
+
+def to_str(value):
+    # json hands back unicode, the wire format is utf-8 encoded str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+_date_cache = (None, None)
+
+def date_line():
+    # formatdate() is comparatively slow, the Date header only changes once
+    # a second.
+    global _date_cache
+    now = int(time.time())
+    second, line = _date_cache
+    if second != now:
+        line = 'Date: %s\r\n' %(formatdate(now, usegmt=True))
+        _date_cache = (now, line)
+    return line
+
+def connection_header(version, close):
+    if close:
+        return 'close'
+    elif version == 'HTTP/1.0':
+        return 'keep-alive'
+    return None
+
+_status_heads = {}
+
+def status_head(code):
+    head = _status_heads.get(code)
+    if head is None:
+        head = _status_heads[code] = '%s %d %s\r\nServer: %s %s\r\n' \
+                %(MyHandler.protocol_version, code, MyHandler.responses.get(code, ('',))[0],
+                  MyHandler.server_version, MyHandler.sys_version)
+    return head
+
+class RenderedResponse(object):
+    # A response serialized to wire bytes.  Only the Date line is spliced in
+    # per write, the tail for each Connection header variant is built the
+    # first time it is needed.
+    chunked = False
+
+    def __init__(self, code, body, content_type='text/plain', headers=()):
+        self.code = code
+        self.body = body
+        self.length = len(body)
+        self.content_type = content_type
+        self.headers = headers
+        self.head = status_head(code)
+        self._tails = {}
+
+    def tail(self, connection=None):
+        tail = self._tails.get(connection)
+        if tail is None:
+            tail = 'Content-type: %s\r\nContent-Length: %d\r\n' %(self.content_type, len(self.body))
+            for header in self.headers:
+                tail += '%s: %s\r\n' %(header)
+            if connection:
+                tail += 'Connection: %s\r\n' %(connection)
+            tail += '\r\n' + self.body
+            self._tails[connection] = tail
+        return tail
+
+    def wire(self, connection=None):
+        return self.head + date_line() + self.tail(connection)
+
+    def headers_only(self, connection=None):
+        tail = self.tail(connection)
+        return self.head + date_line() + tail[:len(tail) - self.length]
+
+    def chunks(self, connection=None):
+        return iter((self.wire(connection),))
+
+    def send(self, wfile, connection=None):
+        response = self.wire(connection)
+        wfile.write(response)
+        return len(response)
+
+class StreamedResponse(object):
+    # A body of unknown length produced by an iterator.  Kept-alive
+    # connections get chunked transfer encoding, a closing connection gets
+    # the raw body and the close marks its end.
+    chunked = True
+
+    def __init__(self, code, body, content_type='text/plain'):
+        self.code = code
+        self.body = body
+        self.content_type = content_type
+        self.length = None
+
+    def chunks(self, connection=None):
+        chunked = connection != 'close'
+        head = status_head(self.code) + date_line() + 'Content-type: %s\r\n' %(self.content_type)
+        if chunked:
+            head += 'Transfer-Encoding: chunked\r\n'
+        if connection:
+            head += 'Connection: %s\r\n' %(connection)
+        yield head + '\r\n'
+        for chunk in self.body:
+            chunk = str(chunk)
+            if not chunk: continue
+            yield '%x\r\n%s\r\n' %(len(chunk), chunk) if chunked else chunk
+        if chunked:
+            yield '0\r\n\r\n'
+
+    def headers_only(self, connection=None):
+        return next(self.chunks(connection))
+
+    def send(self, wfile, connection=None):
+        sent = 0
+        for chunk in self.chunks(connection):
+            wfile.write(chunk)
+            sent += len(chunk)
+        return sent
+
+def parse_range(header, size):
+    # Returns (start, end) inclusive for a single "bytes=" range, None when
+    # the header should be ignored and False when it can not be satisfied.
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0: return False
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+class FileResponse(object):
+    # Streams (a range of) a file without holding it in memory: through
+    # os.sendfile where the platform has it, otherwise as STREAM_CHUNK
+    # slices of a memory mapped window.
+    chunked = False
+
+    def __init__(self, filename, content_type, range_header=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = os.path.getsize(filename)
+        self.code = 200
+        self.start, self.end = 0, self.size - 1
+        byte_range = parse_range(range_header, self.size)
+        if byte_range is False:
+            self.code = 416
+            self.start, self.end = 0, -1
+        elif byte_range is not None:
+            self.code = 206
+            self.start, self.end = byte_range
+        self.length = self.end - self.start + 1
+
+    def head(self, connection=None):
+        head = status_head(self.code) + date_line() + \
+                'Content-type: %s\r\nContent-Length: %d\r\nAccept-Ranges: bytes\r\n' \
+                %(self.content_type, self.length)
+        if self.code == 206:
+            head += 'Content-Range: bytes %d-%d/%d\r\n' %(self.start, self.end, self.size)
+        elif self.code == 416:
+            head += 'Content-Range: bytes */%d\r\n' %(self.size)
+        if connection:
+            head += 'Connection: %s\r\n' %(connection)
+        return head + '\r\n'
+
+    headers_only = head
+
+    def chunks(self, connection=None):
+        # Only STREAM_WINDOW bytes are mapped at a time, so resident memory
+        # stays flat however large the file is.
+        yield self.head(connection)
+        if self.length <= 0: return
+        offset, end = self.start, self.end + 1
+        with open(self.filename, 'rb') as body:
+            while offset < end:
+                base = offset - offset % mmap.ALLOCATIONGRANULARITY
+                size = min(STREAM_WINDOW, end - base)
+                window = mmap.mmap(body.fileno(), size, access=mmap.ACCESS_READ, offset=base)
+                try:
+                    while offset < base + size:
+                        stop = min(offset + STREAM_CHUNK, base + size)
+                        yield window[offset - base:stop - base]
+                        offset = stop
+                finally:
+                    window.close()
+
+    def send(self, wfile, connection=None):
+        # TLS is encrypted in user space, sendfile would bypass it
+        if not hasattr(os, 'sendfile') or self.length <= 0 or \
+                isinstance(getattr(wfile, '_sock', None), ssl.SSLSocket):
+            sent = 0
+            for chunk in self.chunks(connection):
+                wfile.write(chunk)
+                sent += len(chunk)
+            return sent
+        head = self.head(connection)
+        wfile.write(head)
+        wfile.flush()
+        out = wfile.fileno()
+        offset, remaining = self.start, self.length
+        with open(self.filename, 'rb') as body:
+            while remaining > 0:
+                try:
+                    sent = os.sendfile(out, body.fileno(), offset, min(remaining, 1 << 30))
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): raise
+                    select.select([], [out], [], KEEPALIVE_TIMEOUT)
+                    continue
+                if sent == 0: break
+                offset += sent
+                remaining -= sent
+        return len(head) + self.length - remaining
+
+class FileEndpoint(Endpoint):
+    # An endpoint whose body is a file on disk, served with Range support
+    # and never read into memory as a whole.
+    def __init__(self, path, filename, content_type=None, methods=('GET',)):
+        if not os.path.isfile(filename):
+            raise ValueError('%s for %s is not a file' %(filename, path))
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        Endpoint.__init__(self, path, content_type=content_type, methods=methods)
+        self.filename = filename
+
+    def is_static(self):
+        return False
+
+    def response(self, headers, request=None):
+        return FileResponse(self.filename, self.content_type, headers.get('range'))
+
+    def render(self, request=None):
+        return FileResponse(self.filename, self.content_type)
+
+def format_response(code, body, content_type='text/plain', version='HTTP/1.1', close=False, headers=()):
+    return RenderedResponse(code, body, content_type, headers).wire(connection_header(version, close))
+
+def allow_header(endpoint):
+    return (('Allow', ', '.join(endpoint.allowed_methods())),)
+
+def split_path(path):
+    # parse_qsl/unquote are only needed when something is actually escaped,
+    # plain paths and queries take the cheap str.split route.
+    path, sep, query = path.partition('?')
+    segments = [urllib.unquote(seg) if '%' in seg else seg for seg in path.split('/') if seg]
+    if not query:
+        query = {}
+    elif '%' in query or '+' in query or ';' in query:
+        query = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+    else:
+        query = dict(pair.partition('=')[::2] for pair in query.split('&') if pair)
+    return segments, query
+
+NO_QUERY = ((), ())
+
+def is_capture(value):
+    return len(value) > 2 and value.startswith('{') and value.endswith('}')
+
+class Route(object):
+    # A compiled route pattern such as
+    #   /users/{id}/roles?active=1&scope={scope}
+    #   /static/*
+    # Path segments are literals, {name} captures or a trailing * that
+    # matches any remainder.  Query parameters are predicates that must be
+    # present in the request, in any order, with either a literal value or
+    # a {name} capture that accepts any value.
+    __slots__ = ('pattern', 'target', 'segments', 'literals', 'captures', 'literal_keys',
+                 'literal_values', 'group')
+
+    def __init__(self, pattern, target):
+        self.pattern = pattern
+        self.target = target
+        self.segments, query = split_path(pattern)
+        if '*' in self.segments[:-1]:
+            raise ValueError('wildcard "*" is only allowed as the last path segment, not in %s' %(pattern))
+        self.literals = {}
+        self.captures = {}
+        if not query:
+            # most routes test no query, they skip the sorting below
+            self.literal_keys = self.literal_values = ()
+            self.group = NO_QUERY
+            return
+        for key, value in query.items():
+            if value[:1] == '{' and is_capture(value):
+                self.captures[key] = value[1:-1]
+            else:
+                self.literals[key] = value
+        self.literal_keys = tuple(sorted(self.literals))
+        self.literal_values = tuple(map(self.literals.__getitem__, self.literal_keys))
+        self.group = (self.literal_keys, tuple(sorted(self.captures)))
+
+    def query_params(self, query):
+        params = {}
+        for key, name in self.captures.items():
+            params[name] = query[key]
+        return params
+
+class RouteNode(object):
+    # One path segment of the route trie.  Routes ending at a node are
+    # grouped by the set of query keys they test, and every group is a hash
+    # of literal query values to route, so matching costs one dict lookup
+    # per distinct key set instead of one comparison per route.
+    __slots__ = ('children', 'param', 'param_name', 'wildcard', 'groups', 'order')
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_name = None
+        self.wildcard = None
+        self.groups = {}
+        self.order = []
+
+    def add(self, route):
+        group = self.groups.get(route.group)
+        if group is None:
+            group = self.groups[route.group] = {}
+            if len(self.groups) == 1:
+                self.order = [route.group]
+            else:
+                self.order = sorted(self.groups, key=lambda g: len(g[0]) + len(g[1]), reverse=True)
+        if route.literal_values in group:
+            raise ValueError('route %s conflicts with %s' %(route.pattern, group[route.literal_values].pattern))
+        group[route.literal_values] = route
+
+    def remove(self, route):
+        group = self.groups.get(route.group, {})
+        if group.get(route.literal_values) is route:
+            del group[route.literal_values]
+        if not group:
+            self.groups.pop(route.group, None)
+            self.order = [g for g in self.order if g != route.group]
+
+    def find(self, query):
+        for literal_keys, capture_keys in self.order:
+            try:
+                values = tuple(query[key] for key in literal_keys)
+            except KeyError:
+                continue
+            route = self.groups[(literal_keys, capture_keys)].get(values)
+            if route is not None and all(key in query for key in capture_keys):
+                return route
+        return None
+
+class Router(object):
+    def __init__(self):
+        self._root = RouteNode()
+        self._routes = {}
+
+    def __len__(self):
+        return len(self._routes)
+
+    def lookup(self, pattern):
+        entry = self._routes.get(pattern)
+        if entry is None: return None
+        return entry[0].target
+
+    def add(self, pattern, target, replace=False):
+        if pattern in self._routes:
+            if not replace:
+                raise ValueError('route %s is already registered' %(pattern))
+            route = self._routes[pattern][0]
+            route.target = target
+            return route
+        route = Route(pattern, target)
+        node = self._root
+        for segment in route.segments:
+            if segment == '*':
+                if node.wildcard is None: node.wildcard = RouteNode()
+                node = node.wildcard
+            elif segment[:1] == '{' and is_capture(segment):
+                name = segment[1:-1]
+                if node.param is None:
+                    node.param = RouteNode()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise ValueError('route %s captures {%s} where {%s} is already registered' %(pattern, name, node.param_name))
+                node = node.param
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = RouteNode()
+                node = child
+        node.add(route)
+        self._routes[pattern] = (route, node)
+        return route
+
+    def remove(self, pattern):
+        route, node = self._routes.pop(pattern, (None, None))
+        if route is not None:
+            node.remove(route)
+
+    def match(self, path):
+        segments, query = split_path(path)
+        params = {}
+        route = self._match(self._root, segments, 0, query, params)
+        if route is None:
+            return None, {}
+        params.update(route.query_params(query))
+        return route.target, params
+
+    def _match(self, node, segments, i, query, params):
+        if i == len(segments):
+            route = node.find(query)
+            if route is not None: return route
+        else:
+            child = node.children.get(segments[i])
+            if child is not None:
+                route = self._match(child, segments, i + 1, query, params)
+                if route is not None: return route
+            if node.param is not None:
+                route = self._match(node.param, segments, i + 1, query, params)
+                if route is not None:
+                    params[node.param_name] = segments[i]
+                    return route
+        if node.wildcard is not None:
+            route = node.wildcard.find(query)
+            if route is not None:
+                params['*'] = '/'.join(segments[i:])
+                return route
+        return None
+
+def ensure_certificate(certfile=TLS_CERT, keyfile=TLS_KEY, hostname=TLS_HOSTNAME, days=3650):
+    # Generates a self-signed certificate for hostname and 127.0.0.1 with
+    # the openssl command line tool, unless certfile and keyfile already
+    # exist, so every start after the first reuses them.  Returns True when
+    # it generated them.  A P-256 key makes a full handshake several times
+    # cheaper than RSA 2048.
+    if os.path.isfile(certfile) and os.path.isfile(keyfile):
+        return False
+    suffix = '.%s.tmp' %(os.getpid())
+    command = ['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+               '-nodes', '-keyout', keyfile + suffix, '-out', certfile + suffix, '-days', str(days),
+               '-subj', '/CN=%s' %(hostname), '-addext', 'subjectAltName=DNS:%s,IP:127.0.0.1' %(hostname)]
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise RuntimeError('unable to run openssl to generate %s: %s' %(certfile, e))
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('openssl failed to generate %s: %s' %(certfile, err.strip()))
+    # the key first, a certificate is never found without its key
+    os.chmod(keyfile + suffix, 0o600)
+    os.rename(keyfile + suffix, keyfile)
+    os.rename(certfile + suffix, certfile)
+    return True
+
+def tls_context(certfile=TLS_CERT, keyfile=TLS_KEY):
+    # OpenSSL hands out session tickets by default, a returning client
+    # resumes with one instead of paying for a full handshake.  The ticket
+    # keys belong to the context, so one context for every connection (and
+    # every prefork child, which inherits it) honours all of them.
+    # certfile and keyfile must exist, see ensure_certificate().
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    if ssl.OPENSSL_VERSION_INFO >= (3,):
+        # a client closing without a close_notify reads as EOF, not an error
+        context.options |= getattr(ssl, 'OP_IGNORE_UNEXPECTED_EOF', 0x80)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+def close_notify(sock):
+    # Ends a TLS connection on purpose.  OpenSSL clients take a close
+    # without one for a truncation and drop the session, so the next
+    # connection could not resume it.  Never waits for the client's reply.
+    try:
+        sock.setblocking(0)
+        sock.unwrap()
+    except (ssl.SSLError, socket.error, ValueError, AttributeError):
+        pass
+
+# A client that closes before its hello, a readiness probe for instance,
+# is not a failed handshake.
+TLS_CLOSED = (ssl.SSL_ERROR_ZERO_RETURN, ssl.SSL_ERROR_EOF)
+
+def tls_metrics(context, metrics):
+    # (name, kind, help, value) for render_metrics()
+    stats = context.session_stats()
+    return (('tls_handshakes_total', 'counter', 'Completed TLS handshakes.',
+             stats['accept_good'] + metrics.tls_handshakes),
+            ('tls_resumed_total', 'counter', 'TLS handshakes that resumed a session.',
+             stats['hits'] + metrics.tls_resumed),
+            ('tls_handshake_failures_total', 'counter', 'Failed TLS handshakes.', metrics.handshake_failures))
+
+def encode_report(path, delta):
+    # A prefork worker's report on one endpoint, or on the server wide
+    # counters when path is None.  Parent and worker are the same
+    # interpreter, marshal is several times cheaper to read than JSON.
+    data = marshal.dumps((path, delta))
+    return struct.pack('!I', len(data)) + data
+
+def decode_reports(data):
+    # The (path, delta) reports in data and what is left of an incomplete one.
+    reports = []
+    offset = 0
+    while len(data) - offset >= 4:
+        size, = struct.unpack_from('!I', data, offset)
+        if len(data) - offset - 4 < size: break
+        reports.append(marshal.loads(data[offset + 4:offset + 4 + size]))
+        offset += 4 + size
+    return reports, data[offset:]
+
+class WorkerPoolMixIn:
+    # Serves requests in one of SERVE_MODES:
+    #   single   - one request at a time from the serving thread
+    #   threaded - a fixed pool of worker threads fed from a queue, requests
+    #              beyond max_in_flight are answered with a 503
+    #   prefork  - worker processes forked after bind that all accept from
+    #              the shared listening socket, each reports its metrics
+    #              to the parent after every connection
+    # stop() and reload() only set flags, the serving thread acts on them:
+    # a stop stops accepting and drains what is in flight for up to
+    # drain_timeout seconds, a reload starts a new generation of workers on
+    # the same listening socket and lets the old one finish its requests.
+    mode          = SERVE_MODE
+    workers       = WORKERS
+    max_in_flight = MAX_IN_FLIGHT
+    drain_timeout = DRAIN_TIMEOUT
+
+    def set_serve_mode(self, mode=None, workers=None, max_in_flight=None):
+        if mode is not None:
+            if mode not in SERVE_MODES:
+                raise ValueError('mode must be one of %s, not %s' %(SERVE_MODES, mode))
+            self.mode = mode
+        if workers is not None:
+            if not isinstance(workers, int) or workers < 1:
+                raise ValueError('workers must be a positive integer, not %s=%s' %(type(workers), workers))
+            self.workers = workers
+        if max_in_flight is not None:
+            if not isinstance(max_in_flight, int) or max_in_flight < 1:
+                raise ValueError('max_in_flight must be a positive integer, not %s=%s' %(type(max_in_flight), max_in_flight))
+            self.max_in_flight = max_in_flight
+
+    def init_workers(self):
+        self._pool = []
+        self._children = []
+        self._requests = Queue.Queue()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._handlers = set()
+        self.rejected = 0
+        self.generation = 0
+        self.draining = False
+        self.reload_requested = False
+        self.respawn_requested = False
+        self.worker_process = False
+        # prefork parent: the read end of each worker's metrics pipe and
+        # what was read of its last report
+        self._reports = {}
+        self._reports_lock = threading.Lock()
+        # prefork worker: its end of the pipe, the counters as last
+        # reported and the endpoints served since
+        self._report_fd = None
+        self._reported = {}
+        self._touched = {}
+        self._outbox = ''
+
+    def queue_depth(self):
+        return self._requests.qsize()
+
+    def in_flight(self):
+        return self._in_flight
+
+    def start_workers(self):
+        if self.mode not in ('threaded', 'eventloop') or self._pool: return
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.process_request_worker, args=(self._requests,),
+                                      name='worker-%s-%s' %(self.generation, i))
+            worker.daemon = True
+            worker.start()
+            self._pool.append(worker)
+
+    def stop_workers(self, deadline=None):
+        # Workers finish what is queued first, a worker still busy at the
+        # deadline is left behind (they are daemon threads).
+        for worker in self._pool:
+            self._requests.put(None)
+        for worker in self._pool:
+            worker.join(None if deadline is None else max(0.0, deadline - time.time()))
+        self._pool = []
+
+    def process_request_worker(self, requests):
+        while True:
+            task = requests.get()
+            if task is None: return
+            task()
+
+    def next_generation(self):
+        # Serving thread only, so nothing is submitted to the old queue
+        # while it is retired.  The new workers get a queue of their own,
+        # the old ones finish what was queued for them and exit.
+        self.generation += 1
+        if self.mode == 'prefork':
+            retiring = list(self._children)
+            self._children.extend(self.fork_workers())
+            self.stop_preforked(retiring, sig=signal.SIGHUP)
+        elif self._pool:
+            retiring, requests = self._pool, self._requests
+            self._pool, self._requests = [], Queue.Queue()
+            self.start_workers()
+            for worker in retiring:
+                requests.put(None)
+
+    def respawn_workers(self, timeout=None):
+        # prefork children serve the registry they were forked with.  Has
+        # the serving thread fork a new generation from this process and
+        # waits until the old one has exited, so a request sent afterwards
+        # sees every change made before.  False if that takes longer than
+        # timeout seconds (drain_timeout by default).  Never call it from
+        # the serving thread.
+        if self.mode != 'prefork' or not self._children:
+            return True
+        retiring = set(self._children)
+        generation = self.generation
+        self.respawn_requested = True
+        deadline = time.time() + (self.drain_timeout if timeout is None else timeout)
+        while self.generation == generation or not retiring.isdisjoint(self._children):
+            if self.draining or time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def forks_workers(self):
+        # True in a prefork parent, whose worker processes serve requests
+        return self.mode == 'prefork' and not self.worker_process
+
+    def keepalive_allowed(self):
+        # A handler waiting for the next request on a keep-alive connection
+        # holds its thread (its process in prefork, the serving thread in
+        # single mode) for up to KEEPALIVE_TIMEOUT.  Only the threaded pool
+        # keeps connections open, and only while a worker is left for new
+        # connections, so an idle client never holds up the others.  The
+        # event loop gives idle connections back to its poller instead.
+        return self.mode == 'threaded' and self._in_flight < len(self._pool)
+
+    def handler_started(self, handler):
+        self._handlers.add(handler)
+
+    def handler_finished(self, handler):
+        self._handlers.discard(handler)
+
+    def release_idle_handlers(self):
+        # Ends the keep-alive connections waiting for their next request,
+        # their handlers read EOF and return.  A request that has already
+        # arrived is answered first.  Safe in a signal handler.
+        for handler in list(self._handlers):
+            if handler.idle and not has_input(handler.connection):
+                try:
+                    handler.connection.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+
+    def serve_until_stopped(self, poll_interval=0.5):
+        # serve_forever() that also answers reload requests.  Both only set
+        # flags, a signal handler can not call shutdown() on the thread it
+        # interrupted without deadlocking.
+        while not self.draining:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload_now()
+            try:
+                readable, writable, errors = select.select([self], [], [], poll_interval)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            if readable:
+                self._handle_request_noblock()
+
+    def drain_workers(self, deadline):
+        # Waits for the requests handed to the pool, keep-alive connections
+        # are closed once their current response has been sent.
+        while self._in_flight and time.time() < deadline:
+            self.release_idle_handlers()
+            time.sleep(0.05)
+        self.stop_workers(deadline)
+
+    def submit(self, task):
+        self._requests.put(task)
+
+    def process_request_task(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+    def process_request(self, request, client_address):
+        if not self._pool:
+            return BaseServer.process_request(self, request, client_address)
+        with self._in_flight_lock:
+            if self._in_flight >= self.max_in_flight:
+                self.rejected += 1
+                self.reject_request(request)
+                return
+            self._in_flight += 1
+        self.submit(lambda: self.process_request_task(request, client_address))
+
+    def reject_request(self, request):
+        try:
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Content-Length: 0\r\n\r\n')
+        except Exception:
+            pass
+        self.shutdown_request(request)
+
+    def retire(self):
+        # Stops accepting but leaves keep-alive connections open until
+        # their next response, which closes them.  Unlike stop() no idle
+        # connection is cut while its client may be sending a request.
+        self.draining = True
+
+    def fork_workers(self):
+        # A child sent a SIGTERM drains and exits, one sent a SIGHUP by a
+        # reload retires and exits.  Threads do not survive the fork, every
+        # child opens logs of its own and writes out what they hold before
+        # it exits.  No worker is forked while metrics are merged, a lock
+        # held by another thread would stay locked in the child.
+        children = []
+        with self._reports_lock:
+            for i in range(self.workers):
+                report_r, report_w = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(report_r)
+                    self._children = []
+                    self.worker_process = True
+                    self.start_reporting(report_w)
+                    signal.signal(signal.SIGTERM, lambda *args: self.stop())
+                    signal.signal(signal.SIGINT,  lambda *args: self.stop())
+                    signal.signal(signal.SIGHUP,  lambda *args: self.retire())
+                    # a callback's reads and writes restart instead of failing
+                    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                        signal.siginterrupt(sig, False)
+                    try:
+                        self.start_logs()
+                        self.serve_until_stopped()
+                        self.stop_logs()
+                        self.report_metrics(wait=True)
+                    finally:
+                        os._exit(0)
+                os.close(report_w)
+                set_nonblocking(report_r)
+                self._reports[report_r] = ''
+                children.append(pid)
+        return children
+
+    def start_reporting(self, fd):
+        # prefork workers, after the fork.  The counters they were forked
+        # with are the parent's, only what they gain is reported.
+        for other in list(self._reports):
+            os.close(other)
+        self._reports = {}
+        set_nonblocking(fd)
+        self._report_fd = fd
+        self._reported = {None: self.server_snapshot()}
+        self._touched = {}
+        self._outbox = ''
+
+    def server_snapshot(self):
+        # The server wide counters of this process, its TLS session stats
+        # included.
+        snapshot = self.metrics.snapshot()
+        if self.tls is not None:
+            stats = self.tls.session_stats()
+            snapshot['tls_handshakes'] += stats['accept_good']
+            snapshot['tls_resumed'] += stats['hits']
+        return snapshot
+
+    def watch_metrics(self, endpoint):
+        # prefork workers, before a request counts towards endpoint's
+        # metrics.  Remembers the counters as the worker found them.
+        if self._report_fd is None: return
+        path = endpoint.path
+        if path not in self._reported:
+            self._reported[path] = endpoint.metrics.snapshot()
+        self._touched[path] = endpoint.metrics
+
+    def report_metrics(self, wait=False):
+        # prefork workers, after every connection: what the server counters
+        # and the endpoints served since the last report gained goes to the
+        # parent, see collect_metrics().  Whatever a full pipe does not take
+        # waits for the next report, unless wait is set.
+        if self._report_fd is None: return
+        touched, self._touched = self._touched, {}
+        snapshots = [(path, metrics.snapshot()) for path, metrics in touched.items()]
+        for path, current in [(None, self.server_snapshot())] + snapshots:
+            delta = metrics_delta(current, self._reported[path])
+            if delta is not None:
+                self._reported[path] = current
+                self._outbox += encode_report(path, delta)
+        while self._outbox:
+            try:
+                written = os.write(self._report_fd, self._outbox)
+            except OSError as e:
+                if e.errno == errno.EINTR: continue
+                if e.errno != errno.EAGAIN:
+                    # the parent is gone, nobody is left to read it
+                    self._outbox = ''
+                    return
+                # a parent that stopped reading is not waited for forever
+                if not wait or not select.select([], [self._report_fd], [], self.drain_timeout)[1]:
+                    return
+                continue
+            self._outbox = self._outbox[written:]
+
+    def collect_metrics(self, blocking=True):
+        # prefork parent: merges what the workers reported into the counters
+        # of this process, which render_metrics() and list_endpoints() read
+        # and every new generation of workers is forked with, so the totals
+        # outlive the workers.  The pipe of a worker that exited is read to
+        # the end and closed.  Not blocking on the lock, for a signal handler
+        # that may have interrupted a collection, skips collecting instead.
+        if not self._reports_lock.acquire(blocking): return
+        try:
+            for fd in list(self._reports):
+                data, closed = self._reports[fd], False
+                while True:
+                    try:
+                        chunk = os.read(fd, 65536)
+                    except OSError as e:
+                        if e.errno == errno.EINTR: continue
+                        if e.errno == errno.EAGAIN: break
+                        raise
+                    if not chunk:
+                        closed = True
+                        break
+                    data += chunk
+                reports, self._reports[fd] = decode_reports(data)
+                for path, delta in reports:
+                    self.merge_report(path, delta)
+                if closed:
+                    os.close(fd)
+                    del self._reports[fd]
+        finally:
+            self._reports_lock.release()
+
+    def merge_report(self, path, delta):
+        if path is None:
+            self.metrics.merge(delta)
+            return
+        # an endpoint deleted meanwhile takes its metrics with it
+        endpoint = self.endpoints().get(path)
+        if endpoint is not None:
+            endpoint.metrics.merge(delta)
+
+    def serve_preforked(self, poll_interval=0.1):
+        self._children = self.fork_workers()
+        deadline = None
+        while self._children:
+            if self.draining and deadline is None:
+                deadline = time.time() + self.drain_timeout
+                self.stop_preforked()
+            elif deadline is not None and time.time() >= deadline:
+                self.stop_preforked(sig=signal.SIGKILL)
+            elif self.reload_requested and deadline is None:
+                self.reload_requested = False
+                self.reload_now()
+            elif self.respawn_requested and deadline is None:
+                self.respawn_requested = False
+                self.next_generation()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR: continue
+                if e.errno == errno.ECHILD: break
+                raise
+            if pid == 0:
+                self.collect_metrics()
+                time.sleep(poll_interval)
+            elif pid in self._children:
+                self._children.remove(pid)
+        self._children = []
+        self.collect_metrics()
+
+    def stop_preforked(self, children=None, sig=signal.SIGTERM):
+        for pid in self._children if children is None else children:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+class EventPoller(object):
+    # epoll where the platform has it, poll everywhere else.  Both scale to
+    # thousands of idle connections, unlike select().
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+
+    def register(self, fd, events):
+        self._poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self._poller.poll(timeout * self._scale)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR: return []
+            raise
+
+    def close(self):
+        if hasattr(self._poller, 'close'): self._poller.close()
+
+class EventLoopConnection(object):
+    def __init__(self, sock, client_address, server=None):
+        self.sock = sock
+        self.server = server
+        self.fd = sock.fileno()
+        self.client_address = client_address
+        self.inbuf = ''
+        self.outbuf = ''
+        self.producers = collections.deque()
+        self.writing = False
+        self.pending = False
+        self.close_after_write = False
+        self.body = None
+        self.paused = False
+        self.rate = None
+        self.throttled = False
+        self.requests_served = 0
+        self.last_active = time.time()
+        self.tls = isinstance(sock, ssl.SSLSocket)
+        self.handshaking = self.tls
+        # the length of a TLS write that has to be retried as it was
+        self.tls_retry = 0
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class EventLoopMixIn:
+    # Serves every connection from one thread with a readiness loop.  Static
+    # values and callbacks marked @nonblocking are answered inline, any other
+    # callback runs on the worker pool and its response is handed back to
+    # the loop through a wake-up pipe.  Pipelined requests on a connection
+    # are answered in order.  Request bodies are decoded on the loop and
+    # handed to the callback's worker through a QueuedBody.  Injected
+    # latency and throttling run off a timer heap, never a sleep.  Past
+    # max_in_flight callbacks on the pool a request is answered with a 503.
+    # A Supervisor runs one loop for many servers: every server's listening
+    # socket is polled by it and each connection dispatches to the server
+    # that accepted it.
+    READ  = select.POLLIN | select.POLLPRI
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+    # state a Supervisor's loop shares with the servers it hosts
+    LOOP_STATE = ('_poller', '_connections', '_completed', '_calls', '_timers', '_timer_seq',
+                  '_wake_r', '_wake_w', '_requests')
+
+    def init_eventloop(self):
+        self._loop_stopped = False
+        self._loop_done = threading.Event()
+        self._loop_done.set()
+        self._connections = {}
+        self._listeners = {}
+
+    def listening_servers(self):
+        return [self]
+
+    def serve_eventloop(self, poll_interval=0.5):
+        self._loop_done.clear()
+        self._completed = collections.deque()
+        self._calls = collections.deque()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._wake_r, self._wake_w = os.pipe()
+        set_nonblocking(self._wake_r)
+        set_nonblocking(self._wake_w)
+        self._poller = EventPoller()
+        self._poller.register(self._wake_r, self.READ)
+        for server in self.listening_servers():
+            self.listen_on(server)
+        next_sweep = time.time() + poll_interval
+        deadline = None
+        try:
+            while not self._loop_stopped:
+                if self.draining:
+                    if deadline is None:
+                        deadline = time.time() + self.drain_timeout
+                        self.stop_accepting()
+                    if not self.drain_connections() or time.time() >= deadline:
+                        break
+                elif self.reload_requested:
+                    self.reload_requested = False
+                    self.reload_now()
+                timeout = poll_interval
+                if self._timers:
+                    timeout = max(0.0, min(timeout, self._timers[0][0] - time.time()))
+                if deadline is not None:
+                    timeout = max(0.0, min(timeout, deadline - time.time()))
+                for fd, events in self._poller.poll(timeout):
+                    server = self._listeners.get(fd)
+                    if server is not None:
+                        server.accept_connections()
+                    elif fd == self._wake_r:
+                        self.drain_completed()
+                    else:
+                        conn = self._connections.get(fd)
+                        if conn is not None and events & (self.READ | self.ERROR):
+                            self.read_connection(conn)
+                        if conn is not None and events & self.WRITE:
+                            self.write_connection(conn)
+                self.run_timers()
+                if time.time() >= next_sweep:
+                    self.close_idle_connections()
+                    next_sweep = time.time() + poll_interval
+        finally:
+            for server in self._listeners.values():
+                self.stop_listening(server)
+            self._poller.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._loop_stopped = False
+            self._loop_done.set()
+
+    def stop_eventloop(self):
+        self._loop_stopped = True
+        self._loop_done.wait()
+
+    def wake_eventloop(self):
+        # Safe in a signal handler, makes a sleeping loop look at its flags.
+        if not self._loop_done.is_set():
+            self.wake()
+
+    def listen_on(self, server):
+        # Loop thread only.  A hosted server shares this loop's state, so
+        # whatever it queues, schedules or registers lands here.
+        if server is not self:
+            for name in self.LOOP_STATE:
+                setattr(server, name, getattr(self, name))
+        server.socket.setblocking(0)
+        self._poller.register(server.socket.fileno(), self.READ)
+        self._listeners[server.socket.fileno()] = server
+
+    def stop_listening(self, server):
+        # Loop thread only.
+        fd = server.socket.fileno()
+        if self._listeners.pop(fd, None) is None: return
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+        for conn in self._connections.values():
+            if conn.server is server:
+                self.close_connection(conn)
+        server.socket.setblocking(1)
+
+    def stop_accepting(self):
+        # Loop thread only.  Connections already accepted are still served.
+        for fd in self._listeners:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def drain_connections(self):
+        # Loop thread only.  Closes every connection that is not waiting on
+        # or receiving a response and returns how many still are.  One
+        # with a request waiting to be read is kept until it is answered.
+        busy = 0
+        for conn in self._connections.values():
+            if conn.pending or conn.outbuf or conn.producers or conn.body is not None or \
+                    has_input(conn.sock):
+                busy += 1
+            else:
+                self.close_connection(conn)
+        return busy
+
+    def connection_count(self):
+        return sum(1 for conn in self._connections.values() if conn.server is self)
+
+    def call_soon(self, callback):
+        # Runs callback on the loop thread, safe to call from any thread.
+        self._calls.append(callback)
+        self.wake()
+
+    def call_later(self, delay, callback):
+        # Loop thread only, workers hand results back through the wake pipe.
+        heapq.heappush(self._timers, (time.time() + delay, next(self._timer_seq), callback))
+
+    def run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, callback = heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+                raise
+            sock.setblocking(0)
+            if self.tls is not None:
+                sock = self.tls.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            conn = EventLoopConnection(sock, client_address, self)
+            self._connections[conn.fd] = conn
+            self._poller.register(conn.fd, self.READ)
+
+    def handshake_connection(self, conn):
+        # Drives a TLS handshake from READ and WRITE events, True once it
+        # is done.
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._poller.modify(conn.fd, self.READ)
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._poller.modify(conn.fd, self.READ | self.WRITE)
+            else:
+                if e.args[0] not in TLS_CLOSED:
+                    conn.server.metrics.record_handshake_failure()
+                self.close_connection(conn)
+            return False
+        except socket.error:
+            conn.server.metrics.record_handshake_failure()
+            self.close_connection(conn)
+            return False
+        conn.handshaking = False
+        self.watch(conn)
+        return True
+
+    def close_connection(self, conn, notify=True):
+        if self._connections.get(conn.fd) is not conn: return
+        del self._connections[conn.fd]
+        try:
+            self._poller.unregister(conn.fd)
+        except (IOError, OSError, ValueError):
+            pass
+        if conn.tls and notify and not conn.handshaking:
+            close_notify(conn.sock)
+        conn.sock.close()
+        if conn.body is not None:
+            conn.body.abort(IOError('connection closed before the request body was read'))
+            conn.body = None
+
+    def close_idle_connections(self):
+        deadline = time.time() - KEEPALIVE_TIMEOUT
+        for conn in self._connections.values():
+            if not conn.pending and not conn.outbuf and conn.last_active < deadline:
+                self.close_connection(conn)
+
+    def read_connection(self, conn):
+        if conn.handshaking and not self.handshake_connection(conn): return
+        try:
+            data = conn.sock.recv(65536)
+            # a record larger than one recv stays decrypted inside OpenSSL,
+            # where poll() can not see it
+            while conn.tls and data and conn.sock.pending():
+                data += conn.sock.recv(conn.sock.pending())
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE): return
+            data = ''
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+            data = ''
+        if not data:
+            self.close_connection(conn)
+            return
+        conn.last_active = time.time()
+        conn.inbuf += data
+        self.process_connection(conn)
+
+    def refill_outbuf(self, conn):
+        # Pulls from streamed and file responses only as fast as the client
+        # reads, so a large body never sits in memory as a whole.
+        while len(conn.outbuf) < STREAM_CHUNK and conn.producers:
+            try:
+                conn.outbuf += next(conn.producers[0])
+            except StopIteration:
+                conn.producers.popleft()
+            except Exception:
+                traceback.print_exc()
+                conn.producers.clear()
+                conn.outbuf = ''
+                conn.close_after_write = True
+
+    def write_connection(self, conn):
+        if conn.throttled: return
+        if conn.handshaking and not self.handshake_connection(conn): return
+        self.refill_outbuf(conn)
+        if conn.outbuf:
+            data = conn.outbuf
+            if conn.rate:
+                data = data[:max(1, int(conn.rate * THROTTLE_TICK))]
+            if conn.tls_retry:
+                # OpenSSL insists on a write it could not finish being
+                # retried with the same length
+                data = conn.outbuf[:conn.tls_retry]
+            try:
+                sent = conn.sock.send(data)
+            except ssl.SSLError as e:
+                if e.args[0] not in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    self.close_connection(conn)
+                    return
+                sent = 0
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.close_connection(conn)
+                    return
+                sent = 0
+            if conn.tls:
+                conn.tls_retry = 0 if sent else len(data)
+            conn.outbuf = conn.outbuf[sent:]
+            self.refill_outbuf(conn)
+            if conn.rate and conn.outbuf:
+                conn.throttled = True
+                self.call_later(max(THROTTLE_TICK, sent / float(conn.rate)),
+                                lambda: self.unthrottle(conn))
+        if not conn.outbuf:
+            conn.rate = None
+        writing = bool(conn.outbuf) and not conn.throttled
+        if writing != conn.writing:
+            conn.writing = writing
+            self.watch(conn)
+        if not conn.outbuf and conn.close_after_write:
+            self.close_connection(conn)
+
+    def unthrottle(self, conn):
+        if self._connections.get(conn.fd) is not conn: return
+        conn.throttled = False
+        self.write_connection(conn)
+
+    def watch(self, conn):
+        events = 0 if conn.paused else self.READ
+        if conn.writing:
+            events |= self.WRITE
+        self._poller.modify(conn.fd, events)
+
+    def respond(self, conn, response, close):
+        if isinstance(response, str) and not conn.producers:
+            conn.outbuf += response
+        else:
+            conn.producers.append(iter((response,)) if isinstance(response, str) else response)
+        conn.close_after_write = conn.close_after_write or close
+        self.write_connection(conn)
+
+    def parse_request(self, conn):
+        end = conn.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(conn.inbuf) > MAX_REQUEST_HEAD:
+                raise ValueError('request head larger than %s bytes' %(MAX_REQUEST_HEAD))
+            return None
+        lines = conn.inbuf[:end].split('\r\n')
+        method, path, version = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        conn.inbuf = conn.inbuf[end + 4:]
+        return method, path, version, headers
+
+    def process_connection(self, conn):
+        while conn.fd in self._connections:
+            if conn.body is not None:
+                if not self.feed_body(conn): return
+                continue
+            if not conn.inbuf or conn.pending or conn.close_after_write: return
+            try:
+                request = self.parse_request(conn)
+            except ValueError:
+                self.respond(conn, format_response(400, '', close=True), True)
+                return
+            if request is None: return
+            method, path, version, headers = request
+            conntype = headers.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                close = conntype == 'close'
+            else:
+                close = conntype != 'keep-alive'
+            conn.requests_served += 1
+            if conn.requests_served >= MAX_KEEPALIVE_REQUESTS or self.draining:
+                close = True
+            conn.server.dispatch(conn, method, path, version, headers, close)
+
+    def feed_body(self, conn):
+        # Hands what has arrived of the request body to the worker reading
+        # it, returns True once all of it has been handed over.
+        body = conn.body
+        try:
+            pieces, conn.inbuf = body.decoder.feed(conn.inbuf)
+        except ValueError as e:
+            body.abort(IOError('malformed request body: %s' %(e)))
+            conn.body = None
+            conn.inbuf = ''
+            conn.close_after_write = True
+            return False
+        for piece in pieces:
+            body.put(piece)
+        if body.decoder.done:
+            body.finish()
+            conn.body = None
+            return True
+        if body.pause_if_full():
+            conn.paused = True
+            self.watch(conn)
+        return False
+
+    def resume_reading(self, conn):
+        self.call_soon(lambda: self.unpause(conn))
+
+    def unpause(self, conn):
+        if self._connections.get(conn.fd) is not conn: return
+        conn.paused = False
+        self.watch(conn)
+
+    def dispatch(self, conn, method, path, version, headers, close):
+        # Requests with a body are recorded by the worker once it has been
+        # read.
+        start = time.time()
+        body = self.dispatch_request(conn, method, path, version, headers, close, start)
+        if self.recorder is not None and body is None:
+            self.recorder.record((start, method, path, version, headers))
+
+    def dispatch_request(self, conn, method, path, version, headers, close, start):
+        if method not in METHODS:
+            self.respond(conn, format_response(501, '', version=version, close=True), True)
+            self.log_access(conn, method, path, None, 501, 0, start)
+            return
+        try:
+            length, chunked = request_framing(headers)
+        except ValueError:
+            self.respond(conn, format_response(400, '', version=version, close=True), True)
+            self.log_access(conn, method, path, None, 400, 0, start)
+            return
+        endpoint, params = self.route(path)
+        handler = endpoint.for_method(method) if endpoint is not None else None
+        if handler is None:
+            # the body is not read, the connection can not be reused
+            close = close or bool(length or chunked)
+            if endpoint is None:
+                self.metrics.record_not_found()
+                response = format_response(404, '', version=version, close=close)
+                self.log_access(conn, method, path, None, 404, 0, start)
+            else:
+                response = format_response(405, '', version=version, close=close,
+                                           headers=allow_header(endpoint))
+                self.log_access(conn, method, path, endpoint.path, 405, 0, start)
+            self.respond(conn, response, close)
+            return
+        fault = handler.plan_fault()
+        if fault is not None and fault.status is not None:
+            close = close or bool(length or chunked)
+            response = format_response(fault.status, '', version=version, close=close)
+            self.log_access(conn, method, path, handler.path, fault.status, 0, start)
+            self.deliver(conn, response, close, fault, start)
+            return
+        if length or chunked:
+            # draining the body blocks, so it is always read on a worker
+            if not self.admit():
+                self.reject_callback(conn, method, path, handler, version, start)
+                return
+            body = conn.body = QueuedBody(BodyDecoder(length, chunked), lambda: self.resume_reading(conn))
+            if self.recorder is not None:
+                body.record(self.recorder, (start, method, path, version, headers))
+            if version == 'HTTP/1.1' and headers.get('expect', '').lower() == '100-continue':
+                self.respond(conn, 'HTTP/1.1 100 Continue\r\n\r\n', False)
+            conn.pending = True
+            request = Request(method, path, headers, params, body)
+            self.submit(lambda: self.run_callback(conn, handler, request, version, close, start, fault))
+            return body
+        rendered = handler.cached() if method in RENDER_METHODS else None
+        if rendered is not None:
+            connection = connection_header(version, close)
+            response = rendered.headers_only(connection) if method == 'HEAD' else rendered.wire(connection)
+            handler.metrics.record(time.time() - start, len(response))
+            self.log_access(conn, method, path, handler.path, rendered.code, rendered.length, start)
+            self.deliver(conn, response, close, fault, start)
+        elif handler.is_static() or getattr(handler.source(), 'nonblocking', False):
+            response, close = self.render_endpoint(conn, handler, Request(method, path, headers, params),
+                                                   version, close, start)
+            self.deliver(conn, response, close, fault, start)
+        elif not self.admit():
+            self.reject_callback(conn, method, path, handler, version, start)
+        else:
+            conn.pending = True
+            request = Request(method, path, headers, params)
+            self.submit(lambda: self.run_callback(conn, handler, request, version, close, start, fault))
+
+    def admit(self):
+        # Counts a callback handed to the worker pool.  Past max_in_flight
+        # the loop answers a 503 instead, like reject_request(), rather than
+        # queueing callbacks without bound.
+        with self._in_flight_lock:
+            if self._in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def reject_callback(self, conn, method, path, handler, version, start):
+        # the body, if any, is never read, the connection can not be reused
+        self.respond(conn, format_response(503, '', version=version, close=True), True)
+        self.log_access(conn, method, path, handler.path, 503, 0, start)
+
+    def deliver(self, conn, response, close, fault=None, start=None):
+        # Carries out what a fault profile planned for a response: hold it
+        # on a timer until its latency has passed, then reset the
+        # connection, cut the response short or throttle it.
+        if fault is None:
+            self.respond(conn, response, close)
+            return
+        delay = start + fault.delay - time.time()
+        if delay > 0:
+            conn.pending = True
+            fault = fault._replace(delay=0.0)
+            self.call_later(delay, lambda: self.deliver_held(conn, response, close, fault, start))
+            return
+        if fault.reset:
+            reset_socket(conn.sock)
+            self.close_connection(conn, notify=False)
+            return
+        if fault.partial is not None:
+            response, close = cut_response(response, fault.partial), True
+        if fault.bandwidth:
+            conn.rate = fault.bandwidth
+        self.respond(conn, response, close)
+
+    def deliver_held(self, conn, response, close, fault, start):
+        if self._connections.get(conn.fd) is not conn: return
+        conn.pending = False
+        self.deliver(conn, response, close, fault, start)
+        self.process_connection(conn)
+
+    def render_endpoint(self, conn, endpoint, request, version, close, start):
+        body = request.body
+        try:
+            rendered = render_request(endpoint, request)
+        except Exception:
+            traceback.print_exc()
+            endpoint.metrics.record_error()
+            self.log_access(conn, request.method, request.path, endpoint.path, 500, 0, start)
+            close = close or (body is not None and not body.done)
+            return format_response(500, '', version=version, close=close), close
+        if rendered.chunked and version == 'HTTP/1.0':
+            close = True
+        connection = connection_header(version, close)
+        if request.method == 'HEAD':
+            response = rendered.headers_only(connection)
+            nbytes = len(response)
+        elif isinstance(rendered, RenderedResponse):
+            response = rendered.wire(connection)
+            nbytes = len(response)
+        else:
+            response = rendered.chunks(connection)
+            nbytes = rendered.length or 0
+        endpoint.metrics.record(time.time() - start, nbytes)
+        self.log_access(conn, request.method, request.path, endpoint.path, rendered.code,
+                        rendered.length, start)
+        return response, close
+
+    def log_access(self, conn, method, path, endpoint, status, nbytes, start):
+        access_log = self.access_log
+        if access_log is not None:
+            access_log.log(self.server_port, conn.client_address[0], method, path, endpoint,
+                           status, nbytes, start)
+
+    def run_callback(self, conn, endpoint, request, version, close, start, fault=None):
+        try:
+            response, close = self.render_endpoint(conn, endpoint, request, version, close, start)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+        self._completed.append((conn, response, close, fault, start))
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def drain_completed(self):
+        try:
+            while os.read(self._wake_r, 4096): pass
+        except OSError:
+            pass
+        while self._calls:
+            try:
+                self._calls.popleft()()
+            except Exception:
+                traceback.print_exc()
+        while self._completed:
+            conn, response, close, fault, start = self._completed.popleft()
+            if self._connections.get(conn.fd) is not conn: continue
+            conn.pending = False
+            self.deliver(conn, response, close, fault, start)
+            self.process_connection(conn)
+
+class ControlMixIn:
+    # Makes a running server discoverable without scanning the process
+    # table: an exclusive flock on lockfile (which also records the pid) and
+    # a unix control socket that answers one line commands.
+    lockfile       = LOCKFILE
+    control_socket = CONTROL_SOCKET
+
+    def init_control(self):
+        self._lock_fd = None
+        self._control = None
+        self.control_commands = {
+            'pid':       lambda args: str(os.getpid()),
+            'endpoints': lambda args: '\n'.join(sorted(self.endpoints())),
+            'metrics':   lambda args: self.render_metrics(),
+            'register':  self.control_change(lambda args: self.control_register(args, replace=False)),
+            'update':    self.control_change(lambda args: self.control_register(args, replace=True)),
+            'load':      self.control_change(lambda args: self.control_load(args, replace=False)),
+            'replace':   self.control_change(lambda args: self.control_load(args, replace=True)),
+            'delete':    self.control_change(self.control_delete),
+            'faults':    self.control_change(self.control_faults),
+            'record':    self.control_record,
+            'access':    self.control_access,
+            'stop':      self.control_stop,
+            'reload':    self.control_reload,
+        }
+
+    def control_change(self, change):
+        # Registry changes are made in this process and reach prefork
+        # children through a new worker generation, the reply waits for it.
+        def command(args):
+            reply = change(args)
+            if not self.respawn_workers():
+                raise ValueError('%s, but the prefork workers were not replaced within %ss'
+                                 %(reply, self.drain_timeout))
+            return reply
+        return command
+
+    def control_stop(self, args):
+        self.stop()
+        return 'ok stopping'
+
+    def control_reload(self, args):
+        self.reload()
+        return 'ok reloading'
+
+    def control_register(self, args, replace):
+        # register adds new paths and update replaces registered ones in
+        # the live route table, load and replace rebuild it
+        specs = json.loads(args)
+        if isinstance(specs, dict): specs = [specs]
+        return 'ok %s' %(self.add_endpoints(specs, replace))
+
+    def control_load(self, args, replace):
+        specs = json.loads(args)
+        if isinstance(specs, dict): specs = [specs]
+        return 'ok %s' %(self.load_endpoints(specs, replace))
+
+    def control_faults(self, args):
+        spec = json.loads(args)
+        if not isinstance(spec, dict) or not spec.get('path'):
+            raise ValueError('faults takes {"path": ..., "faults": {...}}, not %s' %(args))
+        self.set_faults(to_str(spec['path']), spec.get('faults'), to_str(spec.get('method', 'GET')))
+        return 'ok'
+
+    def control_record(self, args):
+        # record "<path>" starts a request log, record without a path stops it
+        path = json.loads(args) if args else None
+        if not path:
+            recording = self.record_path is not None
+            recorder = self.stop_recording()
+            if recorder is None:
+                # prefork workers keep their own counts
+                return 'ok stopped recording' if recording else 'ok not recording'
+            return 'ok recorded=%s dropped=%s' %(recorder.recorded, recorder.dropped)
+        try:
+            self.start_recording(to_str(path))
+        except IOError as e:
+            raise ValueError('unable to record to %s: %s' %(path, e))
+        return 'ok recording to %s' %(path)
+
+    def control_access(self, args):
+        # access "<path>" or {"path": ..., "sample": ...} starts an access
+        # log, access without a path stops it
+        spec = json.loads(args) if args else None
+        if not isinstance(spec, dict): spec = {'path': spec}
+        path, sample = spec.get('path'), spec.get('sample', 1.0)
+        if not path:
+            logging = self.access_log_path is not None
+            access_log = self.stop_access_log()
+            if access_log is None:
+                return 'ok stopped logging' if logging else 'ok not logging'
+            return 'ok logged=%s dropped=%s' %(access_log.written, access_log.dropped)
+        try:
+            self.start_access_log(to_str(path), sample)
+        except IOError as e:
+            raise ValueError('unable to log to %s: %s' %(path, e))
+        return 'ok logging to %s' %(path)
+
+    def control_delete(self, args):
+        paths = json.loads(args)
+        if not isinstance(paths, list): paths = [paths]
+        return 'ok %s' %(self.unregister_endpoints(paths))
+
+    def lock_instance(self):
+        fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            raise RuntimeError('another server holds the lock on %s' %(self.lockfile))
+        os.ftruncate(fd, 0)
+        os.write(fd, '%s\n' %(os.getpid()))
+        self._lock_fd = fd
+
+    def unlock_instance(self):
+        if self._lock_fd is None: return
+        try:
+            os.unlink(self.lockfile)
+        except OSError:
+            pass
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def start_control(self):
+        if control_request('pid', self.control_socket) is not None:
+            raise RuntimeError('another server is listening on %s' %(self.control_socket))
+        try:
+            os.unlink(self.control_socket)
+        except OSError:
+            pass
+        self._control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._control.bind(self.control_socket)
+        self._control.listen(16)
+        thread = threading.Thread(target=self.serve_control, args=(self._control,), name='control')
+        thread.daemon = True
+        thread.start()
+
+    def stop_control(self):
+        if self._control is None: return
+        control, self._control = self._control, None
+        try:
+            control.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        control.close()
+        try:
+            os.unlink(self.control_socket)
+        except OSError:
+            pass
+
+    def serve_control(self, control):
+        while self._control is control:
+            try:
+                conn, address = control.accept()
+            except socket.error:
+                continue
+            try:
+                self.handle_control(conn)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                # prefork children forked meanwhile hold a copy of conn, the
+                # client only sees the end of the reply after a shutdown
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                conn.close()
+
+    def handle_control(self, conn):
+        conn.settimeout(5.0)
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk: break
+            chunks.append(chunk)
+            if '\n' in chunk: break
+        command, sep, args = ''.join(chunks).strip().partition(' ')
+        handler = self.control_commands.get(command)
+        if handler is None:
+            conn.sendall('error unknown command %s' %(command))
+            return
+        try:
+            reply = handler(args)
+        except ValueError as e:
+            reply = 'error %s' %(e)
+        except Exception as e:
+            # every command gets a reply, an unexpected failure included
+            traceback.print_exc()
+            reply = 'error %s: %s' %(type(e).__name__, e)
+        conn.sendall(reply)
+
+class MyHTTPServer(ControlMixIn, EventLoopMixIn, WorkerPoolMixIn, HTTPServer):
+    request_queue_size = 1024
+
+    def __init__(self, host=LISTEN, port=PORT, mode=None, workers=None, max_in_flight=None,
+                 lockfile=None, control_socket=None, signals=True):
+        HTTPServer.__init__(self, (host, port), MyHandler)
+        self._endpoints = {}
+        self._router = Router()
+        self._registry_lock = threading.Lock()
+        self.callbacks = dict(CALLBACKS)
+        self.counters = {}
+        self.reset_requests = set()
+        self.recorder = None
+        self.access_log = None
+        # opened by run(), after daemonizing, when set.  In prefork mode
+        # every worker process opens its own, see start_logs().
+        self.access_log_path = None
+        self.access_sample = 1.0
+        self.record_path = None
+        self.record_max_body = MAX_RECORDED_BODY
+        # read again by reload(), when set
+        self.manifest = None
+        # an ssl.SSLContext once enable_tls() is called
+        self.tls = None
+        self.metrics = ServerMetrics()
+        self._metrics_endpoint = Endpoint(METRICS_PATH, callback=self.render_metrics,
+                                          content_type='text/plain; version=0.0.4')
+        self._sig_handler = SignalHandler()
+        if signals: self.register_default_sig_handlers()
+        self.set_serve_mode(mode, workers, max_in_flight)
+        self.init_workers()
+        self.init_eventloop()
+        self.init_control()
+        if lockfile is not None: self.lockfile = lockfile
+        if control_socket is not None: self.control_socket = control_socket
+        self.running = False
+        self._run_done = threading.Event()
+        self._run_done.set()
+
+    def endpoints(self):
+        return self._endpoints
+
+    def register_default_sig_handlers(self):
+        self._sig_handler.register(signal.SIGTERM, self.stop)
+        self._sig_handler.register(signal.SIGINT,  self.stop)
+        self._sig_handler.register(signal.SIGHUP,  self.reload)
+        self._sig_handler.register(signal.SIGUSR1, self.list_endpoints)
+
+    def run(self):
+        # Serves until stop(), then drains and returns.
+        if self.running: return
+        self._run_done.clear()
+        try:
+            self.running = True
+            self.lock_instance()
+            self.start_control()
+            if self.access_log_path is not None:
+                self.start_access_log(self.access_log_path, self.access_sample)
+            if self.mode == 'prefork':
+                self.serve_preforked()
+            elif self.mode == 'eventloop':
+                self.start_workers()
+                self.serve_eventloop()
+                self.stop_workers(time.time() + self.drain_timeout)
+            else:
+                self.start_workers()
+                self.serve_until_stopped()
+                self.drain_workers(time.time() + self.drain_timeout)
+        except Exception as e:
+            traceback.print_exc()
+            self.stop_preforked()
+            self.stop_workers()
+            self.server_close()
+        finally:
+            self.stop_logs()
+            self.stop_control()
+            self.unlock_instance()
+            self.draining = False
+            self.running = False
+            self._run_done.set()
+
+    def stop(self):
+        # Only sets flags and wakes the serving thread, so it is safe in a
+        # signal handler or a request callback.  run() stops accepting,
+        # drains and returns.
+        self.draining = True
+        self.release_idle_handlers()
+        self.wake_eventloop()
+
+    def reload(self):
+        # SIGHUP.  The serving thread reads the manifest again and hands the
+        # listening socket to a new generation of workers.
+        self.reload_requested = True
+        self.wake_eventloop()
+
+    def reload_now(self):
+        # Serving thread only.  A manifest that fails to load leaves the
+        # endpoints and the workers as they were.
+        if self.manifest is not None:
+            try:
+                loaded = self.load_manifest(self.manifest)
+            except Exception:
+                traceback.print_exc()
+                return
+            print('reloaded %s endpoints from %s' %(loaded, self.manifest))
+        self.next_generation()
+        sys.stdout.flush()
+
+    def list_endpoints(self):
+        # SIGUSR1, which may interrupt the prefork parent collecting
+        if self.forks_workers():
+            self.collect_metrics(blocking=False)
+        for path, endpoint in sorted(self.endpoints().items()):
+            metrics = endpoint.metrics.snapshot()
+            mean = metrics['duration'] / metrics['hits'] if metrics['hits'] else 0.0
+            print('listing endpoint: %s hits=%s errors=%s faults=%s bytes_sent=%s mean_ms=%.3f' \
+                    %(path, metrics['hits'], metrics['errors'], metrics['faults'],
+                      metrics['bytes_sent'], mean * 1000))
+        print('not_found=%s rejected=%s in_flight=%s queue_depth=%s connections=%s' \
+                %(self.metrics.not_found, self.rejected, self.in_flight(),
+                  self.queue_depth(), self.connection_count()))
+        sys.stdout.flush()
+
+    def render_metrics(self):
+        # A prefork worker answers with the totals of every worker, which the
+        # parent holds, and only falls back to its own counters without it.
+        if self.worker_process:
+            self.report_metrics(wait=True)
+            combined = control_request('metrics', self.control_socket)
+            if combined is not None and not combined.startswith('error '):
+                return combined
+        elif self.forks_workers():
+            self.collect_metrics()
+        lines = []
+        def family(name, kind, help):
+            lines.append('# HELP intweb_%s %s' %(name, help))
+            lines.append('# TYPE intweb_%s %s' %(name, kind))
+        snapshots = [(metric_label(path), endpoint.metrics.snapshot())
+                     for path, endpoint in sorted(self.endpoints().items())]
+        for name, key, help in (('requests_total', 'hits', 'Requests served per endpoint.'),
+                                ('errors_total', 'errors', 'Callback errors per endpoint.'),
+                                ('faults_total', 'faults', 'Injected faults per endpoint.'),
+                                ('response_bytes_total', 'bytes_sent', 'Response bytes sent per endpoint.')):
+            family(name, 'counter', help)
+            for path, metrics in snapshots:
+                lines.append('intweb_%s{path="%s"} %s' %(name, path, metrics[key]))
+        family('request_duration_seconds', 'histogram', 'Time to render and queue a response.')
+        for path, metrics in snapshots:
+            count = 0
+            for bound, hits in zip(LATENCY_BUCKETS + ('+Inf',), metrics['buckets']):
+                count += hits
+                lines.append('intweb_request_duration_seconds_bucket{path="%s",le="%s"} %s' %(path, bound, count))
+            lines.append('intweb_request_duration_seconds_sum{path="%s"} %r' %(path, metrics['duration']))
+            lines.append('intweb_request_duration_seconds_count{path="%s"} %s' %(path, count))
+        for name, kind, help, value in (
+                ('not_found_total', 'counter', 'Requests that matched no endpoint.', self.metrics.not_found),
+                ('rejected_total', 'counter', 'Requests rejected beyond max_in_flight.', self.rejected),
+                ('in_flight', 'gauge', 'Requests handed to the worker pool.', self.in_flight()),
+                ('queue_depth', 'gauge', 'Requests waiting for a worker.', self.queue_depth()),
+                ('connections', 'gauge', 'Open event loop connections.', self.connection_count())) + \
+                (tls_metrics(self.tls, self.metrics) if self.tls is not None else ()):
+            family(name, kind, help)
+            lines.append('intweb_%s %s' %(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def enable_tls(self, certfile=TLS_CERT, keyfile=TLS_KEY):
+        # Serves HTTPS on this server's port, with a self-signed certificate
+        # generated on first use unless certfile and keyfile exist.
+        if ensure_certificate(certfile, keyfile):
+            print('generated a self-signed certificate %s' %(certfile))
+        self.tls = tls_context(certfile, keyfile)
+        return self.tls
+
+    def get_request(self):
+        sock, client_address = self.socket.accept()
+        if self.tls is not None:
+            # the handshake runs in finish_request(), on a worker
+            sock = self.tls.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, client_address
+
+    def finish_request(self, request, client_address):
+        # a prefork worker reports before the connection is closed, so a
+        # client that saw it close finds its request in the parent's metrics
+        try:
+            if self.tls is not None and not self.tls_handshake(request): return
+            HTTPServer.finish_request(self, request, client_address)
+        finally:
+            if self.worker_process:
+                self.report_metrics()
+
+    def tls_handshake(self, request):
+        request.settimeout(MyHandler.timeout)
+        try:
+            request.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] not in TLS_CLOSED:
+                self.metrics.record_handshake_failure()
+            return False
+        except socket.error:
+            self.metrics.record_handshake_failure()
+            return False
+        return True
+
+    def shutdown(self):
+        # Stops a server running in another thread and waits until run()
+        # has drained and returned.
+        self.stop()
+        self._run_done.wait()
+
+    def shutdown_request(self, request):
+        # A connection reset by a fault profile is closed without the FIN
+        # shutdown() would send first.
+        if request in self.reset_requests:
+            self.reset_requests.discard(request)
+            self.close_request(request)
+        else:
+            if self.tls is not None:
+                close_notify(request)
+            HTTPServer.shutdown_request(self, request)
+
+    def register_endpoint(self, path, return_val=None, callback=None, ttl=None, methods=('GET',),
+                          faults=None):
+        # A path can be registered once per method, callbacks for methods
+        # other than GET and HEAD are called with the request body.
+        if not path: return
+        endpoint = Endpoint(path, return_val, callback, ttl, methods=methods,
+                            faults=faults_from_spec(faults))
+        existing = self.endpoints().get(path)
+        if existing is None or not any(existing.handles(method) for method in endpoint.methods):
+            self.add_endpoint(endpoint)
+
+    def add_endpoint(self, endpoint, replace=False):
+        # Single changes are applied to the live route table in place, a
+        # reader sees either the old or the new endpoint.
+        if endpoint.is_static():
+            endpoint.render()
+        with self._registry_lock:
+            existing = self._endpoints.get(endpoint.path)
+            if existing is not None and existing.methods.isdisjoint(endpoint.methods):
+                existing.attach(endpoint)
+                return
+            if existing is not None and not replace:
+                raise ValueError('route %s is already registered' %(endpoint.path))
+            endpoint = merge_endpoint(existing, endpoint)
+            self._router.add(endpoint.path, endpoint, replace)
+            self._endpoints[endpoint.path] = endpoint
+
+    def add_endpoints(self, specs, replace=False):
+        # Applies a few changes to a large registry at the cost of each
+        # change, load_endpoints() rebuilds the whole route table.  With
+        # replace every path must already be registered, without it none
+        # may already answer the methods it is registered for.  Nothing is
+        # changed unless every spec is valid.
+        endpoints = [endpoint_from_spec(spec, self.callbacks, self.counters) for spec in specs]
+        registered = self._endpoints
+        claimed = set()
+        for endpoint in endpoints:
+            routes = set((endpoint.path, method) for method in endpoint.methods)
+            if not claimed.isdisjoint(routes):
+                raise ValueError('route %s is given more than once' %(endpoint.path))
+            claimed.update(routes)
+            existing = registered.get(endpoint.path)
+            if replace and existing is None:
+                raise ValueError('no endpoint is registered at %s' %(endpoint.path))
+            if not replace and existing is not None and \
+                    any(existing.handles(method) for method in endpoint.methods):
+                raise ValueError('route %s is already registered' %(endpoint.path))
+        for endpoint in endpoints:
+            self.add_endpoint(endpoint, replace)
+        return len(endpoints)
+
+    def update_endpoint(self, path, return_val=None, callback=None, ttl=None, methods=('GET',),
+                        faults=None):
+        self.add_endpoint(Endpoint(path, return_val, callback, ttl, methods=methods,
+                                   faults=faults_from_spec(faults)), replace=True)
+
+    def start_recording(self, path, max_body=MAX_RECORDED_BODY):
+        # Appends every request from now on to path, see Recorder.  A
+        # prefork parent only checks that it can append to path and returns
+        # None, a new generation of workers records, see start_logs().
+        self.record_path, self.record_max_body = path, max_body
+        if self.forks_workers():
+            open(path, 'ab').close()
+            self.respawn_workers()
+            return None
+        recorder = Recorder(path, max_body)
+        previous, self.recorder = self.recorder, recorder
+        if previous is not None:
+            previous.close()
+        return recorder
+
+    def stop_recording(self):
+        self.record_path = None
+        if self.forks_workers():
+            self.respawn_workers()
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+        return recorder
+
+    def start_access_log(self, path, sample=1.0):
+        # Logs every response (or a sample of them) from now on to path,
+        # see AccessLog.  Without an access log nothing is written per
+        # request.  Like start_recording() a prefork parent leaves the
+        # logging to its workers and returns None.
+        self.access_log_path, self.access_sample = path, sample
+        if self.forks_workers():
+            check_sample(sample)
+            open(path, 'ab').close()
+            self.respawn_workers()
+            return None
+        access_log = AccessLog(path, sample)
+        previous, self.access_log = self.access_log, access_log
+        if previous is not None:
+            previous.close()
+        return access_log
+
+    def stop_access_log(self):
+        self.access_log_path = None
+        if self.forks_workers():
+            self.respawn_workers()
+        access_log, self.access_log = self.access_log, None
+        if access_log is not None:
+            access_log.close()
+        return access_log
+
+    def start_logs(self):
+        # prefork workers, after the fork.  The parent's logs lost their
+        # writer threads in the fork, every worker appends to the same
+        # files through logs of its own.
+        self.recorder = self.access_log = None
+        if self.access_log_path is not None:
+            self.start_access_log(self.access_log_path, self.access_sample)
+        if self.record_path is not None:
+            self.start_recording(self.record_path, self.record_max_body)
+
+    def stop_logs(self):
+        # Writes out and closes the logs of this process, unlike
+        # stop_recording() and stop_access_log() a later run() or worker
+        # generation opens them again.
+        for log in (self.recorder, self.access_log):
+            if log is not None:
+                log.close()
+        self.recorder = self.access_log = None
+
+    def set_faults(self, path, faults, method='GET'):
+        # Swaps the fault profile of a registered endpoint, None heals it.
+        endpoint = self._endpoints.get(path)
+        endpoint = endpoint.for_method(method) if endpoint is not None else None
+        if endpoint is None:
+            raise ValueError('no endpoint answers %s %s' %(method, path))
+        endpoint.faults = faults_from_spec(faults)
+
+    def unregister_endpoint(self, path):
+        return self.unregister_endpoints([path]) == 1
+
+    def unregister_endpoints(self, paths):
+        removed = 0
+        with self._registry_lock:
+            for path in paths:
+                if self._endpoints.pop(path, None) is not None:
+                    self._router.remove(path)
+                    removed += 1
+        return removed
+
+    def load_manifest(self, path, replace=False):
+        return self.load_endpoints(read_manifest(path), replace)
+
+    def register_file(self, path, filename, content_type=None):
+        if path and path not in self.endpoints():
+            self.add_endpoint(FileEndpoint(path, filename, content_type))
+
+    def counter(self, name):
+        # The Counter scripts loaded from manifests share under name.
+        return self.counters.setdefault(name, Counter())
+
+    def register_callback(self, name, callback):
+        self.callbacks[name] = callback
+
+    def load_endpoints(self, specs, replace=False):
+        # With replace a new route table is built off to the side and
+        # swapped in with one assignment, in-flight requests keep the table
+        # they started with and never see a partially loaded one.  Without
+        # it the endpoints are added to the live table, see add_loaded().
+        # Static values are rendered by their first request, not here.
+        # The collector is paused while tens of thousands of long lived
+        # objects are allocated, otherwise it rescans them over and over.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            loaded = [endpoint_from_spec(spec, self.callbacks, self.counters) for spec in specs]
+            with self._registry_lock:
+                if replace:
+                    endpoints = {}
+                    for endpoint in loaded:
+                        endpoints[endpoint.path] = merge_endpoint(endpoints.get(endpoint.path), endpoint)
+                    router = Router()
+                    for path, endpoint in endpoints.items():
+                        router.add(path, endpoint)
+                    self._router = router
+                    self._endpoints = endpoints
+                else:
+                    self.add_loaded(loaded)
+        finally:
+            if collecting: gc.enable()
+        return len(loaded)
+
+    def add_loaded(self, loaded):
+        # Registry lock held.  New paths are routed first and taken out
+        # again if one of them is rejected, only then are endpoints loaded
+        # on registered paths merged in, so a failed load changes nothing.
+        endpoints = self._endpoints
+        router = self._router
+        added = {}
+        for endpoint in loaded:
+            if endpoint.path not in endpoints:
+                added[endpoint.path] = merge_endpoint(added.get(endpoint.path), endpoint)
+        routed = []
+        try:
+            for path, endpoint in added.items():
+                router.add(path, endpoint)
+                routed.append(path)
+        except ValueError:
+            for path in routed:
+                router.remove(path)
+            raise
+        for endpoint in loaded:
+            if endpoint.path in added: continue
+            endpoint = merge_endpoint(endpoints[endpoint.path], endpoint)
+            router.add(endpoint.path, endpoint, replace=True)
+            endpoints[endpoint.path] = endpoint
+        endpoints.update(added)
+
+    def invalidate(self, path=None):
+        if path is None:
+            endpoints = self._endpoints.values()
+        else:
+            endpoints = [self._endpoints[path]] if path in self._endpoints else []
+        for endpoint in endpoints:
+            if not endpoint.is_static():
+                endpoint.invalidate()
+
+    def route(self, path):
+        router = self._router
+        endpoint = router.lookup(path)
+        if endpoint is not None:
+            return endpoint, {}
+        if path == METRICS_PATH:
+            return self._metrics_endpoint, {}
+        return router.match(path)
+
+class Supervisor(ControlMixIn, EventLoopMixIn, WorkerPoolMixIn):
+    # Hosts many MyHTTPServer instances in one process, each with its own
+    # port and endpoint registry, all served by one event loop and one
+    # worker pool.  The supervisor owns the lockfile, the signal handlers
+    # and the control socket, a hosted server costs a listening socket and
+    # its registry.  Hosted servers are reached through the control socket
+    # with `on <port> <command> <args>`.
+    mode = 'eventloop'
+
+    def __init__(self, host=LISTEN, workers=None, max_in_flight=None, lockfile=None,
+                 control_socket=None):
+        self.host = host
+        self.servers = {}
+        self._servers_lock = threading.Lock()
+        self._listening = False
+        # one access log for every hosted server, opened by run() when set
+        self.access_log = None
+        self.access_log_path = None
+        self.access_sample = 1.0
+        # one TLS context, and so one set of ticket keys, for every instance
+        self.tls = None
+        self.set_serve_mode(None, workers, max_in_flight)
+        self.init_workers()
+        self.init_eventloop()
+        self.init_control()
+        self.control_commands = {
+            'pid':       lambda args: str(os.getpid()),
+            'status':    lambda args: json.dumps(self.status(), sort_keys=True),
+            'stop':      self.control_stop,
+            'reload':    self.control_reload,
+            'add':       self.control_add,
+            'remove':    self.control_remove,
+            'on':        self.control_on,
+            'access':    self.control_access,
+        }
+        if lockfile is not None: self.lockfile = lockfile
+        if control_socket is not None: self.control_socket = control_socket
+        self._sig_handler = SignalHandler()
+        self._sig_handler.register(signal.SIGTERM, self.stop)
+        self._sig_handler.register(signal.SIGINT,  self.stop)
+        self._sig_handler.register(signal.SIGHUP,  self.reload)
+        self._sig_handler.register(signal.SIGUSR1, self.list_instances)
+        self.running = False
+        self._run_done = threading.Event()
+        self._run_done.set()
+
+    def add_server(self, port, host=None):
+        # Starts serving a new instance on port, also while running.
+        if port in self.servers:
+            raise ValueError('an instance is already listening on port %s' %(port))
+        server = MyHTTPServer(host or self.host, port, mode='eventloop', max_in_flight=self.max_in_flight,
+                              signals=False)
+        server.access_log = self.access_log
+        server.tls = self.tls
+        with self._servers_lock:
+            self.servers[port] = server
+            if self._listening:
+                self.call_soon(lambda: self.listen_on(server))
+        return server
+
+    def remove_server(self, port):
+        with self._servers_lock:
+            server = self.servers.pop(port, None)
+            listening = self._listening
+        if server is None:
+            raise ValueError('no instance is listening on port %s' %(port))
+        if listening:
+            done = threading.Event()
+            def stop_listening():
+                self.stop_listening(server)
+                done.set()
+            self.call_soon(stop_listening)
+            while not done.wait(0.1) and not self._loop_done.is_set():
+                pass
+        server.server_close()
+        return server
+
+    def listening_servers(self):
+        with self._servers_lock:
+            self._listening = True
+            return self.servers.values()
+
+    def serve_eventloop(self, poll_interval=0.5):
+        try:
+            EventLoopMixIn.serve_eventloop(self, poll_interval)
+        finally:
+            with self._servers_lock:
+                self._listening = False
+
+    def run(self):
+        if self.running: return
+        self.running = True
+        self._run_done.clear()
+        try:
+            self.lock_instance()
+            self.start_control()
+            if self.access_log_path is not None:
+                self.start_access_log(self.access_log_path, self.access_sample)
+            self.start_workers()
+            self.serve_eventloop()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.stop_workers(time.time() + self.drain_timeout)
+            self.stop_access_log()
+            self.stop_control()
+            self.unlock_instance()
+            self.draining = False
+            self.running = False
+            self._run_done.set()
+
+    def stop(self):
+        # Only sets a flag, safe to call from a signal handler.  The loop
+        # stops accepting on every port and drains before run() returns.
+        self.draining = True
+        self.wake_eventloop()
+
+    def reload(self):
+        self.reload_requested = True
+        self.wake_eventloop()
+
+    def enable_tls(self, certfile=TLS_CERT, keyfile=TLS_KEY):
+        # Every instance, also those added later, serves HTTPS.
+        if ensure_certificate(certfile, keyfile):
+            print('generated a self-signed certificate %s' %(certfile))
+        self.tls = tls_context(certfile, keyfile)
+        with self._servers_lock:
+            for server in self.servers.values():
+                server.tls = self.tls
+        return self.tls
+
+    def reload_now(self):
+        # Loop thread only.  Every instance reads its manifest again, then
+        # a new worker generation takes over the shared pool.
+        for port, server in sorted(self.servers.items()):
+            if server.manifest is None: continue
+            try:
+                loaded = server.load_manifest(server.manifest)
+            except Exception:
+                traceback.print_exc()
+                continue
+            print('reloaded %s endpoints on port %s from %s' %(loaded, port, server.manifest))
+        self.next_generation()
+        sys.stdout.flush()
+
+    def next_generation(self):
+        WorkerPoolMixIn.next_generation(self)
+        for server in self._listeners.values():
+            server._requests = self._requests
+
+    def start_access_log(self, path, sample=1.0):
+        access_log = AccessLog(path, sample)
+        previous = self.access_log
+        self.set_access_log(access_log)
+        if previous is not None:
+            previous.close()
+        return access_log
+
+    def stop_access_log(self):
+        access_log = self.access_log
+        self.set_access_log(None)
+        if access_log is not None:
+            access_log.close()
+        return access_log
+
+    def set_access_log(self, access_log):
+        with self._servers_lock:
+            self.access_log = access_log
+            for server in self.servers.values():
+                server.access_log = access_log
+
+    def shutdown(self):
+        self.stop()
+        self._run_done.wait()
+
+    def server_close(self):
+        with self._servers_lock:
+            servers, self.servers = self.servers.values(), {}
+        for server in servers:
+            server.server_close()
+
+    def status(self):
+        instances = []
+        for port, server in sorted(self.servers.items()):
+            endpoints = server.endpoints().values()
+            instances.append({
+                'port':        port,
+                'endpoints':   len(endpoints),
+                'requests':    sum(endpoint.metrics.hits for endpoint in endpoints),
+                'not_found':   server.metrics.not_found,
+                'connections': server.connection_count(),
+            })
+        return instances
+
+    def list_instances(self):
+        for instance in self.status():
+            print('listing instance: port=%(port)s endpoints=%(endpoints)s requests=%(requests)s '
+                  'not_found=%(not_found)s connections=%(connections)s' %(instance))
+        print('instances=%s queue_depth=%s connections=%s' \
+                %(len(self.servers), self.queue_depth(), len(self._connections)))
+        sys.stdout.flush()
+
+    def control_add(self, args):
+        port = json.loads(args)
+        if not isinstance(port, int):
+            raise ValueError('add takes a port number, not %s' %(args))
+        try:
+            self.add_server(port)
+        except socket.error as e:
+            raise ValueError('unable to listen on port %s: %s' %(port, e))
+        return 'ok'
+
+    def control_remove(self, args):
+        port = json.loads(args)
+        if not isinstance(port, int):
+            raise ValueError('remove takes a port number, not %s' %(args))
+        self.remove_server(port)
+        return 'ok'
+
+    def control_on(self, args):
+        # on <port> <command> <args> runs a command against one instance.
+        # Hosted servers have no serving loop of their own to act on stop
+        # and reload, so those remove the instance or reload its manifest.
+        port, sep, args = args.partition(' ')
+        command, sep, args = args.strip().partition(' ')
+        server = self.servers.get(int(port)) if port.isdigit() else None
+        if server is None:
+            raise ValueError('no instance is listening on port %s' %(port))
+        if command == 'stop':
+            self.remove_server(int(port))
+            return 'ok stopped'
+        if command == 'reload':
+            if server.manifest is None:
+                raise ValueError('the instance on port %s has no manifest to reload' %(port))
+            return 'ok %s' %(server.load_manifest(server.manifest))
+        handler = server.control_commands.get(command)
+        if handler is None:
+            raise ValueError('unknown command %s' %(command))
+        return handler(args)
+
+class DaemonizeMyHTTPServer(Daemon):
+    def run(self, server):
+        if isinstance(server, (MyHTTPServer, Supervisor)) is False:
+            raise ValueError('server argument must be a MyHTTPServer or Supervisor instance, not %s=%s' %(type(server), server))
+        self.daemonize()
+        server.run()
+
+class MyHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests while the server
+    # has a thread to spare, see keepalive_allowed().  Pipelined requests
+    # are read in order from the buffered rfile and each response is flushed
+    # as a single write once the request has been handled.  Without a
+    # thread to spare the requests the client has already sent are still
+    # answered, the connection closes with the response that leaves nothing
+    # waiting.
+    protocol_version = 'HTTP/1.1'
+    timeout          = KEEPALIVE_TIMEOUT
+    max_requests     = MAX_KEEPALIVE_REQUESTS
+    wbufsize         = -1
+    start            = None
+    endpoint         = None
+    idle             = True
+    keepalive        = True
+
+    def handle_one_request(self):
+        # idle until the request line arrives, a draining server ends the
+        # connection instead of waiting for it
+        self.start = self.endpoint = None
+        self.idle = True
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def parse_request(self):
+        self.idle = False
+        if not BaseHTTPRequestHandler.parse_request(self):
+            return False
+        if self.server.draining:
+            self.close_connection = 1
+        # checked against pipelined() once the request body has been read,
+        # see send_rendered()
+        self.keepalive = self.server.keepalive_allowed()
+        return True
+
+    def pipelined(self):
+        # True when another request is already waiting, in rfile's buffer,
+        # a decrypted TLS record or the socket.
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None and rbuf.tell():
+            return True
+        pending = getattr(self.connection, 'pending', None)
+        if pending is not None and pending():
+            return True
+        return has_input(self.connection)
+
+    def handle(self):
+        self.requests_served = 0
+        self.close_connection = 1
+        self.server.handler_started(self)
+        try:
+            self.handle_one_request()
+            while not self.close_connection:
+                self.handle_one_request()
+        finally:
+            self.server.handler_finished(self)
+
+    def do_GET(self):
+        # Every method is dispatched here, GET and HEAD render the endpoint
+        # and the others stream the request body to it.  A request whose
+        # body was read is recorded once the body has been, see
+        # request_body().
+        self.start = start = time.time()
+        body = self.serve_request(start)
+        recorder = self.server.recorder
+        if recorder is not None and body is None:
+            recorder.record(self.recorded_request(start))
+
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def log_request(self, code='-', size='-'):
+        # Responses go to the server's access log, if it has one, instead
+        # of a line on stderr.
+        access_log = self.server.access_log
+        if access_log is not None:
+            endpoint = self.endpoint.path if self.endpoint is not None else None
+            access_log.log(self.server.server_port, self.client_address[0], self.command,
+                           self.path, endpoint, code, None if size == '-' else size, self.start)
+
+    def recorded_request(self, start):
+        return (start, self.command, self.path, self.request_version, dict(self.headers.items()))
+
+    def serve_request(self, start):
+        try:
+            length, chunked = request_framing(self.headers)
+        except ValueError:
+            self.close_connection = 1
+            self.send_body(400, '')
+            return
+        endpoint, self.params = self.server.route(self.path)
+        self.endpoint = endpoint
+        if endpoint is not None:
+            self.server.watch_metrics(endpoint)
+        handler = endpoint.for_method(self.command) if endpoint is not None else None
+        if handler is None:
+            if length or chunked:
+                self.close_connection = 1
+            if endpoint is None:
+                self.server.metrics.record_not_found()
+                self.send_invalid_response()
+            else:
+                self.send_rendered(RenderedResponse(405, '', headers=allow_header(endpoint)))
+            return
+        fault = handler.plan_fault()
+        if fault is not None and fault.status is not None:
+            if length or chunked:
+                self.close_connection = 1
+            self.send_faulty(RenderedResponse(fault.status, ''), fault, start)
+            return
+        body = self.request_body(length, chunked, start)
+        try:
+            rendered = render_request(handler, Request(self.command, self.path, self.headers,
+                                                       self.params, body))
+        except Exception:
+            handler.metrics.record_error()
+            if body is not None and not body.done:
+                self.close_connection = 1
+            self.log_error('callback for %s failed:\n%s', handler.path, traceback.format_exc())
+            self.send_body(500, '')
+            return body
+        if fault is not None:
+            sent = self.send_faulty(rendered, fault, start)
+        else:
+            sent = self.send_rendered(rendered)
+        handler.metrics.record(time.time() - start, sent)
+        return body
+
+    def request_body(self, length, chunked, start):
+        if not length and not chunked:
+            return None
+        if self.request_version == 'HTTP/1.1' and \
+                (self.headers.get('expect') or '').lower() == '100-continue':
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+            self.wfile.flush()
+        body = RequestBody(self.rfile, length, chunked)
+        if self.server.recorder is not None:
+            body.record(self.server.recorder, self.recorded_request(start))
+        return body
+
+    def send_faulty(self, rendered, fault, start):
+        # Without a timer loop the latency and throttling of a fault hold
+        # the thread serving this connection.
+        delay = start + fault.delay - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if fault.reset:
+            self.close_connection = 1
+            reset_socket(self.connection)
+            self.server.reset_requests.add(self.request)
+            return 0
+        if fault.partial is not None:
+            self.close_connection = 1
+        elif not fault.bandwidth:
+            return self.send_rendered(rendered)
+        wfile, self.wfile = self.wfile, ThrottledWriter(self.wfile, fault.bandwidth,
+                                                        fault.partial, rendered.length)
+        try:
+            self.send_rendered(rendered)
+            return self.wfile.written
+        finally:
+            self.wfile = wfile
+
+    def send_valid_response(self, callback):
+        body = callback_body(callback)
+        if is_stream(body):
+            self.send_rendered(StreamedResponse(200, body))
+        else:
+            self.send_body(200, body)
+        return
+
+    def send_invalid_response(self):
+        self.send_body(404, '')
+        return
+
+    def send_body(self, code, body, content_type='text/plain'):
+        self.send_rendered(RenderedResponse(code, body, content_type))
+
+    def send_rendered(self, rendered):
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests:
+            self.close_connection = 1
+        if rendered.chunked and self.request_version == 'HTTP/1.0':
+            self.close_connection = 1
+        if not self.keepalive and not self.pipelined():
+            self.close_connection = 1
+        self.log_request(rendered.code, '-' if rendered.length is None else rendered.length)
+        connection = connection_header(self.request_version, self.close_connection)
+        if self.command == 'HEAD':
+            head = rendered.headers_only(connection)
+            self.wfile.write(head)
+            return len(head)
+        return rendered.send(self.wfile, connection)
+
+def start_server(daemonize=True, mode=None, workers=None, max_in_flight=None):
+    server.set_serve_mode(mode, workers, max_in_flight)
+    if daemonize:
+        daemon = DaemonizeMyHTTPServer(
+                pidfile = PIDFILE,
+                stdin   = '/dev/null',
+                stdout  = STDOUT_LOG,
+                stderr  = STDERR_LOG
+            )
+        daemon.run(server)
+    else:
+        server.run()
+
+def register_datasource_endpoints(server):
+    server.register_endpoint('/twiddle/get.op?objectName=bean:name=datasource&attributeName=MaxPoolSize', 55)
+    server.register_endpoint('/twiddle/get.op?objectName=bean:name=datasource&attributeName=MinPoolSize', 50)
+    server.register_endpoint('/twiddle/get.op?objectName=bean:name=datasource&attributeName=NumBusyConnections', random_busy)
+    server.register_endpoint('/twiddle/get.op?objectName=bean:name=datasource&attributeName=NumIdleConnections', random_idle)
+
+@named_callback
+def random_busy():
+    return random.randint(1,40)
+
+@named_callback
+def random_idle():
+    return random.randint(41,55)
+
+def enable_tls(server):
+    try:
+        server.enable_tls()
+    except (RuntimeError, ssl.SSLError) as e:
+        print('unable to serve HTTPS: %s' %(e))
+        sys.exit(1)
+
+def main(argv):
+    # The server actions of integration_webserver.py, control.main() has
+    # answered everything else.
+    global server
+    action = argv[1]
+    # a trailing `tls` serves HTTPS with the cached self-signed certificate
+    tls = action in ('start', 'supervise') and argv[-1] == 'tls'
+    if tls:
+        argv = argv[:-1]
+    scheme = 'https' if tls else 'http'
+
+    if action == 'start':
+        server = MyHTTPServer(LISTEN, PORT)
+        server.access_log_path = ACCESS_LOG
+        if tls:
+            enable_tls(server)
+        print('starting up server %s://%s:%s' %(scheme, LISTEN, PORT))
+        register_datasource_endpoints(server)
+        mode = argv[2] if argv[2:] else None
+        workers = int(argv[3]) if argv[3:] else None
+        if argv[4:]:
+            print('loaded %s endpoints from %s' %(server.load_manifest(argv[4]), argv[4]))
+            server.manifest = argv[4]
+        start_server(mode=mode, workers=workers)
+    elif action == 'supervise':
+        if not argv[2:]:
+            usage()
+        try:
+            ports = parse_ports(argv[2])
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        workers = int(argv[3]) if argv[3:] else None
+        specs = list(read_manifest(argv[4])) if argv[4:] else []
+        server = Supervisor(LISTEN, workers)
+        server.access_log_path = ACCESS_LOG
+        if tls:
+            enable_tls(server)
+        for port in ports:
+            instance = server.add_server(port)
+            register_datasource_endpoints(instance)
+            instance.load_endpoints(specs)
+            instance.manifest = argv[4] if argv[4:] else None
+        print('supervising %s servers on %s://%s:%s-%s' %(len(ports), scheme, LISTEN, ports[0], ports[-1]))
+        start_server()
+    return 0